@@ -10,9 +10,13 @@ from nxdrive.client.remote_filtered_file_system_client import RemoteFilteredFile
 
 from nxdrive.client.rest_api_client import RestAPIClient
 
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.client.file_copier import FileCopier
+
 from nxdrive.client.local_client import DEDUPED_BASENAME_PATTERN
 from nxdrive.client.local_client import safe_filename
 from nxdrive.client.local_client import LocalClient
+from nxdrive.client.local_client import DigestCache
 
 
 # Backward compatibility with old remote client name, to be removed
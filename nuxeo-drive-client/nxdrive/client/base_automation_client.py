@@ -3,11 +3,11 @@
 import sys
 import base64
 import json
+import re
 import urllib2
 import random
 import time
 import os
-import hashlib
 import tempfile
 from urllib import urlencode
 from poster.streaminghttp import get_handlers
@@ -18,6 +18,10 @@ from nxdrive.client.common import FILE_BUFFER_SIZE
 from nxdrive.client.common import DEFAULT_IGNORED_PREFIXES
 from nxdrive.client.common import DEFAULT_IGNORED_SUFFIXES
 from nxdrive.client.common import safe_filename
+from nxdrive.client.common import StreamDigester
+from nxdrive.client.connection_pool import get_pooled_handlers
+from nxdrive.client.buffer_pool import hash_file, read_chunks
+from nxdrive.client import json_stream
 from nxdrive.engine.activity import Action, FileAction
 from nxdrive.utils import DEVICE_DESCRIPTIONS
 from nxdrive.utils import TOKEN_PERMISSION
@@ -26,6 +30,8 @@ from nxdrive.utils import guess_digest_algorithm
 from nxdrive.utils import force_decode
 from urllib2 import ProxyHandler
 from urlparse import urlparse
+from threading import Condition, Event, Lock, Thread
+from Queue import Queue, Empty
 import socket
 
 
@@ -36,6 +42,23 @@ DEFAULT_NUXEO_TX_TIMEOUT = 300
 
 DOWNLOAD_TMP_FILE_PREFIX = '.'
 DOWNLOAD_TMP_FILE_SUFFIX = '.nxpart'
+# Validation key of a partial download, saved next to it so the download can be resumed
+DOWNLOAD_KEY_FILE_SUFFIX = '.nxkey'
+# Partial downloads not resumed for this time in seconds are removed by clean_partial_downloads
+PARTIAL_DOWNLOAD_MAX_AGE = 24 * 3600
+# Files larger than a segment are downloaded by several ranges at once when the
+# download_segment_threads config of the upload store is greater than 1
+DOWNLOAD_SEGMENT_SIZE = 20 * 1024 * 1024
+DOWNLOAD_SEGMENT_THREADS = 1
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+
+# Files larger than a chunk are uploaded by chunks when the new upload API is available,
+# the size and the number of chunks uploaded at once are overridden by the
+# upload_chunk_size and upload_chunk_threads config of the upload store
+UPLOAD_CHUNK_SIZE = 20 * 1024 * 1024
+UPLOAD_CHUNK_THREADS = 4
+# Digest of the content identifying its uploaded chunks
+UPLOAD_DIGEST_ALGORITHM = 'md5'
 
 # 1s audit time resolution because of the datetime resolution of MYSQL
 AUDIT_CHANGE_FINDER_TIME_RESOLUTION = 1.0
@@ -43,12 +66,52 @@ AUDIT_CHANGE_FINDER_TIME_RESOLUTION = 1.0
 socket.setdefaulttimeout(DEFAULT_NUXEO_TX_TIMEOUT)
 
 
+class UploadLocks(object):
+    """Content digests being uploaded by chunks
+
+    The chunks of a content are saved by digest to resume its upload, so the uploads
+    of the same content by several processors are done one at a time instead of
+    sharing a batch that only the first one can execute.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._digests = set()
+
+    def acquire(self, digest, check_suspended=None):
+        while True:
+            with self._condition:
+                if digest not in self._digests:
+                    self._digests.add(digest)
+                    return
+                self._condition.wait(1)
+            if check_suspended is not None:
+                check_suspended('Upload of the same content')
+
+    def release(self, digest):
+        with self._condition:
+            self._digests.discard(digest)
+            self._condition.notify_all()
+
+
+# Shared by the clients of all the processors
+upload_locks = UploadLocks()
+
+
 class InvalidBatchException(Exception):
     if (log is not None):
         log.warning("Invalid batch exception")
     pass
 
 
+class UploadInterrupted(Exception):
+    pass
+
+
+class DownloadInterrupted(Exception):
+    pass
+
+
 def get_proxies_for_handler(proxy_settings):
     """Return a pair containing proxy string and exceptions list"""
     if proxy_settings.config == 'None':
@@ -91,6 +154,41 @@ def get_proxy_config(proxies):
         return 'Manual'
 
 
+def clean_partial_downloads(folder, max_age=PARTIAL_DOWNLOAD_MAX_AGE):
+    """Remove the partial downloads left in folder and its subfolders, return their number
+
+    The ones kept to be resumed are only removed once not updated for max_age seconds,
+    the other ones and the validation keys without partial download are abandoned.
+    """
+    removed = 0
+    limit = time.time() - max_age
+    for dir_path, _, file_names in os.walk(folder):
+        names = set(file_names)
+        for name in file_names:
+            if name.endswith(DOWNLOAD_KEY_FILE_SUFFIX):
+                file_name = name[:-len(DOWNLOAD_KEY_FILE_SUFFIX)]
+                if file_name in names:
+                    # Removed with its partial download
+                    continue
+            elif name.startswith(DOWNLOAD_TMP_FILE_PREFIX) and name.endswith(DOWNLOAD_TMP_FILE_SUFFIX):
+                file_name = name
+            else:
+                continue
+            paths = [os.path.join(dir_path, file_name), os.path.join(dir_path, file_name + DOWNLOAD_KEY_FILE_SUFFIX)]
+            try:
+                if (file_name + DOWNLOAD_KEY_FILE_SUFFIX in names and file_name in names
+                        and max([os.path.getmtime(path) for path in paths]) >= limit):
+                    continue
+                for path in paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+                        removed += 1
+            except OSError:
+                # In use, removed next time
+                continue
+    return removed
+
+
 def get_proxy_handler(proxies, proxy_exceptions=None, url=None):
     if proxies is None:
         # No proxies specified, use default proxy detection
@@ -170,12 +268,15 @@ class BaseAutomationClient(BaseClient):
                  password=None, token=None, repository=DEFAULT_REPOSITORY_NAME,
                  ignored_prefixes=None, ignored_suffixes=None,
                  timeout=20, blob_timeout=60, cookie_jar=None,
-                 upload_tmp_dir=None, check_suspended=None):
+                 upload_tmp_dir=None, check_suspended=None,
+                 connection_pool=None, upload_store=None):
         global log
         log = get_logger(__name__)
         # Function to check during long-running processing like upload /
         # download if the synchronization thread needs to be suspended
         self.check_suspended = check_suspended
+        # Engine DAO keeping the uploaded chunks, None to upload the files in a single request
+        self.upload_store = upload_store
 
         if timeout is None or timeout < 0:
             timeout = 20
@@ -217,11 +318,20 @@ class BaseAutomationClient(BaseClient):
                                           proxy_exceptions=proxy_exceptions,
                                           url=self.server_url)
 
-        # Build URL openers
-        self.opener = urllib2.build_opener(cookie_processor, proxy_handler)
-        self.streaming_opener = urllib2.build_opener(cookie_processor,
-                                                     proxy_handler,
-                                                     *get_handlers())
+        # Build URL openers, reusing the connections of the pool if any
+        self.connection_pool = connection_pool
+        if connection_pool is not None:
+            self.opener = urllib2.build_opener(
+                cookie_processor, proxy_handler,
+                *get_pooled_handlers(connection_pool))
+            self.streaming_opener = urllib2.build_opener(
+                cookie_processor, proxy_handler,
+                *get_pooled_handlers(connection_pool, streaming=True))
+        else:
+            self.opener = urllib2.build_opener(cookie_processor, proxy_handler)
+            self.streaming_opener = urllib2.build_opener(cookie_processor,
+                                                         proxy_handler,
+                                                         *get_handlers())
 
         # Set Proxy flag
         self.is_proxy = False
@@ -311,8 +421,13 @@ class BaseAutomationClient(BaseClient):
 
     def execute(self, command, url=None, op_input=None, timeout=-1,
                 check_params=True, void_op=False, extra_headers=None,
-                file_out=None, **params):
-        """Execute an Automation operation"""
+                file_out=None, items_key=None, item_converter=None, **params):
+        """Execute an Automation operation
+
+        If items_key is given, the items of this array of the JSON response
+        are decoded one at a time while reading it and replaced by
+        item_converter(item).
+        """
         if check_params:
             self._check_params(command, params)
 
@@ -379,38 +494,59 @@ class BaseAutomationClient(BaseClient):
                         if buffer_ == '':
                             break
                         if current_action:
-                            current_action.progress += (
-                                                self.get_download_buffer())
+                            current_action.progress += len(buffer_)
                         f.write(buffer_)
                 return None, file_out
             finally:
                 self.lock_path(file_out, locker)
         else:
-            return self._read_response(resp, url)
+            return self._read_response(resp, url, items_key=items_key, item_converter=item_converter)
 
     def execute_with_blob_streaming(self, command, file_path, filename=None,
-                                    mime_type=None, **params):
+                                    mime_type=None, digester=None, **params):
         """Execute an Automation operation using a batch upload as an input
 
-        Upload is streamed.
+        Upload is streamed, the given StreamDigester is updated with the uploaded bytes.
         """
         tick = time.time()
         action = FileAction("Upload", file_path, filename)
+        upload_digest = None
+        locked_digest = None
         try:
-            batch_id = None
-            if self.is_new_upload_api_available():
+            upload_result = None
+            if self.is_chunked_upload(os.path.getsize(file_path)):
+                # The chunks are read out of order, get the digests first
+                if digester is None:
+                    digester = StreamDigester()
+                digester.add(UPLOAD_DIGEST_ALGORITHM)
+                self._digest_file(file_path, digester)
+                upload_digest = digester.hexdigest(UPLOAD_DIGEST_ALGORITHM)
+                digester = None
+                # Until its batch is executed
+                upload_locks.acquire(upload_digest, self.check_suspended)
+                locked_digest = upload_digest
                 try:
-                    # Init resumable upload getting a batch id generated by the server
-                    # This batch id is to be used as a resumable session id
-                    batch_id = self.init_upload()['batchId']
+                    batch_id, upload_result = self.upload_chunks(upload_digest, file_path, filename=filename,
+                                                                 mime_type=mime_type)
                 except NewUploadAPINotAvailable:
                     log.debug('New upload API is not available on server %s', self.server_url)
                     self.new_upload_api_available = False
-            if batch_id is None:
-                # New upload API is not available, generate a batch id
-                batch_id = self._generate_unique_id()
-            upload_result = self.upload(batch_id, file_path, filename=filename,
-                                        mime_type=mime_type)
+                    upload_digest = None
+            if upload_result is None:
+                batch_id = None
+                if self.is_new_upload_api_available():
+                    try:
+                        # Init resumable upload getting a batch id generated by the server
+                        # This batch id is to be used as a resumable session id
+                        batch_id = self.init_upload()['batchId']
+                    except NewUploadAPINotAvailable:
+                        log.debug('New upload API is not available on server %s', self.server_url)
+                        self.new_upload_api_available = False
+                if batch_id is None:
+                    # New upload API is not available, generate a batch id
+                    batch_id = self._generate_unique_id()
+                upload_result = self.upload(batch_id, file_path, filename=filename,
+                                            mime_type=mime_type, digester=digester)
             upload_duration = int(time.time() - tick)
             action.transfer_duration = upload_duration
             # Use upload duration * 2 as Nuxeo transaction timeout
@@ -427,20 +563,39 @@ class BaseAutomationClient(BaseClient):
             if upload_result.get('batchId') is not None:
                 result = self.execute_batch(command, batch_id, '0', tx_timeout,
                                           **params)
+                if upload_digest is not None:
+                    self.upload_store.remove_upload_chunks(upload_digest)
                 return result
             else:
                 raise ValueError("Bad response from batch upload with id '%s'"
                                  " and file path '%s'" % (batch_id, file_path))
         except InvalidBatchException:
+            if upload_digest is not None:
+                # Start again in a new batch
+                self.upload_store.remove_upload_chunks(upload_digest)
             self.cookie_jar.clear_session_cookies()
         finally:
+            if locked_digest is not None:
+                upload_locks.release(locked_digest)
             self.end_action()
 
     def get_upload_buffer(self, input_file):
+        """Return the size of the upload reads, a multiple of the file system block size"""
         if sys.platform != 'win32':
-            return os.fstatvfs(input_file.fileno()).f_bsize
-        else:
-            return FILE_BUFFER_SIZE
+            block_size = os.fstatvfs(input_file.fileno()).f_bsize
+            if block_size > 0:
+                return max(1, FILE_BUFFER_SIZE // block_size) * block_size
+        return FILE_BUFFER_SIZE
+
+    def get_upload_chunk_size(self):
+        return int(self.upload_store.get_config('upload_chunk_size', UPLOAD_CHUNK_SIZE))
+
+    def get_upload_chunk_threads(self):
+        return int(self.upload_store.get_config('upload_chunk_threads', UPLOAD_CHUNK_THREADS))
+
+    def is_chunked_upload(self, file_size):
+        return (self.upload_store is not None and self.is_new_upload_api_available()
+                and file_size > self.get_upload_chunk_size())
 
     def init_upload(self):
         url = self.rest_api_url + self.batch_upload_path
@@ -465,11 +620,12 @@ class BaseAutomationClient(BaseClient):
         return self._read_response(resp, url)
 
     def upload(self, batch_id, file_path, filename=None, file_index=0,
-               mime_type=None):
+               mime_type=None, digester=None):
         """Upload a file through an Automation batch
 
         Uses poster.httpstreaming to stream the upload
         and not load the whole file in memory.
+        The optional StreamDigester is updated with the uploaded bytes.
         """
         FileAction("Upload", file_path, filename)
         # Request URL
@@ -480,22 +636,9 @@ class BaseAutomationClient(BaseClient):
             url = self.automation_url.encode('ascii') + self.batch_upload_url
 
         # HTTP headers
-        if filename is None:
-            filename = os.path.basename(file_path)
         file_size = os.path.getsize(file_path)
-        if mime_type is None:
-            mime_type = guess_mime_type(filename)
-        # Quote UTF-8 filenames even though JAX-RS does not seem to be able
-        # to retrieve them as per: https://tools.ietf.org/html/rfc5987
-        filename = safe_filename(filename)
-        quoted_filename = urllib2.quote(filename.encode('utf-8'))
-        headers = {
-            "X-File-Name": quoted_filename,
-            "X-File-Size": file_size,
-            "X-File-Type": mime_type,
-            "Content-Type": "application/octet-stream",
-            "Content-Length": file_size,
-        }
+        headers = self._get_upload_headers(file_path, file_size, filename=filename, mime_type=mime_type)
+        headers["Content-Length"] = file_size
         if not self.is_new_upload_api_available():
             headers.update({"X-Batch-Id": batch_id, "X-File-Idx": file_index})
         headers.update(self._get_common_headers())
@@ -504,7 +647,7 @@ class BaseAutomationClient(BaseClient):
         input_file = open(file_path, 'rb')
         # Use file system block size if available for streaming buffer
         fs_block_size = self.get_upload_buffer(input_file)
-        data = self._read_data(input_file, fs_block_size)
+        data = self._read_data(input_file, fs_block_size, digester=digester)
 
         # Execute request
         cookies = self._get_cookies()
@@ -525,6 +668,124 @@ class BaseAutomationClient(BaseClient):
         self.end_action()
         return self._read_response(resp, url)
 
+    def upload_chunks(self, digest, file_path, filename=None, mime_type=None):
+        """Upload a file by chunks through a batch of the new upload API, several chunks at a time
+
+        The uploaded chunks are saved in the upload store by content digest, so an
+        interrupted upload of the same content only sends the missing chunks.
+        Return the batch id and the upload result.
+        """
+        file_size = os.path.getsize(file_path)
+        chunk_size = self.get_upload_chunk_size()
+        chunk_count = max(1, (file_size + chunk_size - 1) // chunk_size)
+        batch_id, uploaded = self.upload_store.get_upload_chunks(digest, chunk_size)
+        if batch_id is not None:
+            server_chunks = self._get_uploaded_chunks(batch_id)
+            if server_chunks is None:
+                log.debug('Batch %s of the upload of %s has expired', batch_id, file_path)
+                self.upload_store.remove_upload_chunks(digest)
+                batch_id = None
+            else:
+                # The server knows better which chunks it has
+                uploaded = server_chunks
+        if batch_id is None:
+            batch_id = self.init_upload()['batchId']
+            uploaded = set()
+        missing = [index for index in range(chunk_count) if index not in uploaded]
+        log.debug('Uploading %d/%d chunks of %s in batch %s', len(missing), chunk_count, file_path, batch_id)
+        headers = self._get_upload_headers(file_path, file_size, filename=filename, mime_type=mime_type)
+        headers.update({"X-Upload-Type": "chunked", "X-Upload-Chunk-Count": chunk_count})
+        headers.update(self._get_common_headers())
+        # Shared by the upload threads
+        action = Action.get_current_action()
+        if action is not None:
+            action.progress += sum([min(chunk_size, file_size - index * chunk_size) for index in uploaded
+                                      if index < chunk_count])
+        lock = Lock()
+
+        def upload_chunk(index, stop):
+            self._upload_chunk(batch_id, file_path, headers, index, chunk_size, file_size, action, lock, stop)
+            self.upload_store.add_upload_chunk(digest, chunk_size, batch_id, index)
+
+        self._run_transfer_threads(missing, upload_chunk, self.get_upload_chunk_threads(), 'ChunkUpload',
+                                   'File upload: %s' % file_path)
+        return batch_id, {'batchId': batch_id, 'fileIdx': '0', 'uploaded': 'true', 'uploadType': 'chunked',
+                          'chunkCount': chunk_count}
+
+    def _upload_chunk(self, batch_id, file_path, headers, index, chunk_size, file_size, action, lock, stop):
+        url = self.rest_api_url + self.batch_upload_path + '/' + batch_id + '/0'
+        length = min(chunk_size, file_size - index * chunk_size)
+        headers = dict(headers)
+        headers.update({"X-Upload-Chunk-Index": index, "Content-Length": length})
+        input_file = open(file_path, 'rb')
+        try:
+            input_file.seek(index * chunk_size)
+            data = self._read_chunk(input_file, length, self.get_upload_buffer(input_file), action, lock, stop)
+            log.trace("Uploading chunk %d of %s to %s", index, file_path, url)
+            req = urllib2.Request(url, data, headers)
+            try:
+                resp = self.streaming_opener.open(req, timeout=self.blob_timeout)
+            except urllib2.HTTPError as e:
+                if e.code == 308:
+                    # Resume Incomplete: other chunks are still missing
+                    e.read()
+                    return
+                log_details = self._log_details(e)
+                if isinstance(log_details, tuple):
+                    _, _, _, error = log_details
+                    if error and error.startswith("Unable to find batch"):
+                        raise InvalidBatchException()
+                raise e
+            resp.read()
+        finally:
+            input_file.close()
+
+    def _read_chunk(self, input_file, length, buffer_size, action, lock, stop):
+        for chunk in read_chunks(input_file, length=length, read_size=buffer_size):
+            if stop.is_set():
+                # Abort the request, the chunk will be sent again
+                raise UploadInterrupted()
+            if action is not None:
+                with lock:
+                    action.progress += len(chunk)
+            yield chunk
+
+    def _get_uploaded_chunks(self, batch_id):
+        """Return the indexes of the chunks uploaded in the batch, or None if the server does not know it"""
+        url = self.rest_api_url + self.batch_upload_path + '/' + batch_id + '/0'
+        req = urllib2.Request(url, headers=self._get_common_headers())
+        try:
+            resp = self.opener.open(req, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                e.read()
+                return None
+            raise e
+        info = self._read_response(resp, url)
+        if not isinstance(info, dict):
+            return None
+        return set([int(index) for index in info.get('uploadedChunkIds', [])])
+
+    def _digest_file(self, file_path, digester, use_mmap=False):
+        hash_file(file_path, digester, check_suspended=self.check_suspended, description='File digest: %s',
+                  use_mmap=use_mmap)
+
+    def _get_upload_headers(self, file_path, file_size, filename=None, mime_type=None):
+        if filename is None:
+            filename = os.path.basename(file_path)
+        if mime_type is None:
+            mime_type = guess_mime_type(filename)
+        # Quote UTF-8 filenames even though JAX-RS does not seem to be able
+        # to retrieve them as per: https://tools.ietf.org/html/rfc5987
+        filename = safe_filename(filename)
+        quoted_filename = urllib2.quote(filename.encode('utf-8'))
+        return {
+            "X-File-Name": quoted_filename,
+            "X-File-Size": file_size,
+            "X-File-Type": mime_type,
+            "Content-Type": "application/octet-stream",
+        }
+
     def end_action(self):
         Action.finish_action()
 
@@ -707,11 +968,16 @@ class BaseAutomationClient(BaseClient):
 
         # TODO: add typechecking
 
-    def _read_response(self, response, url):
+    def _read_response(self, response, url, items_key=None, item_converter=None):
         info = response.info()
-        s = response.read()
         content_type = info.get('content-type', '')
         cookies = self._get_cookies()
+        if items_key is not None and content_type.startswith("application/json"):
+            result = json_stream.load(response, items_key=items_key, item_converter=item_converter)
+            log.trace("Response for '%s' with cookies %r: %r",
+                url, cookies, result)
+            return result
+        s = response.read()
         if content_type.startswith("application/json"):
             log.trace("Response for '%s' with cookies %r: %r",
                 url, cookies, s)
@@ -753,85 +1019,62 @@ class BaseAutomationClient(BaseClient):
 
         return str(time.time()) + '_' + str(random.randint(0, 1000000000))
 
-    def _read_data(self, file_object, buffer_size):
-        while True:
+    def _read_data(self, file_object, buffer_size, digester=None):
+        for chunk in read_chunks(file_object, read_size=buffer_size):
             current_action = Action.get_current_action()
             if current_action is not None and current_action.suspend:
                 break
             # Check if synchronization thread was suspended
             if self.check_suspended is not None:
                 self.check_suspended('File upload: %s' % file_object.name)
-            r = file_object.read(buffer_size)
-            if not r:
-                break
             if current_action is not None:
-                current_action.progress += buffer_size
-            yield r
-
-    def do_get(self, url, file_out=None, digest=None, digest_algorithm=None):
+                current_action.progress += len(chunk)
+            if digester is not None:
+                digester.update(chunk)
+            yield chunk
+
+    def do_get(self, url, file_out=None, digest=None, digest_algorithm=None, digester=None):
+        """Download the content at url, checking its digest if any
+
+        The given StreamDigester is updated in the same pass so the caller
+        can get the digests of other algorithms without reading the content again.
+        When the content of file_out is identified by its digest, the partial file
+        is kept on failure so the next download of the same content resumes it.
+        """
         log.trace('Downloading file from %r to %r with digest=%s, digest_algorithm=%s', url, file_out, digest,
                   digest_algorithm)
-        h = None
         if digest is not None:
             if digest_algorithm is None:
                 digest_algorithm = guess_digest_algorithm(digest)
                 log.trace('Guessed digest algorithm from digest: %s', digest_algorithm)
-            digester = getattr(hashlib, digest_algorithm, None)
             if digester is None:
-                raise ValueError('Unknow digest method: ' + digest_algorithm)
-            h = digester()
-        headers = self._get_common_headers()
+                digester = StreamDigester()
+            digester.add(digest_algorithm)
         base_error_message = (
             "Failed to connect to Nuxeo server %r with user %r"
         ) % (self.server_url, self.user_id)
         try:
-            log.trace("Calling '%s' with headers: %r", url, headers)
-            req = urllib2.Request(url, headers=headers)
-            response = self.opener.open(req, timeout=self.blob_timeout)
-            current_action = Action.get_current_action()
-            # Get the size file
-            if (current_action and response is not None
-                and response.info() is not None):
-                current_action.size = int(response.info().getheader(
-                                                    'Content-Length', 0))
             if file_out is not None:
                 locker = self.unlock_path(file_out)
                 try:
-                    with open(file_out, "wb") as f:
-                        while True:
-                            # Check if synchronization thread was suspended
-                            if self.check_suspended is not None:
-                                self.check_suspended('File download: %s'
-                                                     % file_out)
-                            buffer_ = response.read(self.get_download_buffer())
-                            if buffer_ == '':
-                                break
-                            if current_action:
-                                current_action.progress += (
-                                                    self.get_download_buffer())
-                            f.write(buffer_)
-                            if h is not None:
-                                h.update(buffer_)
-                    if digest is not None:
-                        actual_digest = h.hexdigest()
-                        if digest != actual_digest:
-                            if os.path.exists(file_out):
-                                os.remove(file_out)
-                            raise CorruptedFile("Corrupted file %r: expected digest = %s, actual digest = %s"
-                                                % (file_out, digest, actual_digest))
+                    self._download_file(url, file_out, digest, digest_algorithm, digester)
                     return None, file_out
                 finally:
                     self.lock_path(file_out, locker)
-            else:
-                result = response.read()
-                if h is not None:
-                    h.update(result)
-                    if digest is not None:
-                        actual_digest = h.hexdigest()
-                        if digest != actual_digest:
-                            raise CorruptedFile("Corrupted file: expected digest = %s, actual digest = %s"
-                                                % (digest, actual_digest))
-                return result, None
+            response, _, size = self._open_download(url)
+            current_action = Action.get_current_action()
+            # Get the size file
+            if current_action and size is not None:
+                current_action.size = size
+            result = response.read()
+            if digester is not None:
+                digester.update(result)
+                if digest is not None:
+                    actual_digest = digester.hexdigest(digest_algorithm)
+                    if digest != actual_digest:
+                        raise CorruptedFile("Corrupted file: expected digest = %s, actual digest = %s"
+                                            % (digest, actual_digest))
+            return result, None
         except urllib2.HTTPError as e:
             if e.code == 401 or e.code == 403:
                 raise Unauthorized(self.server_url, self.user_id, e.code)
@@ -843,5 +1086,263 @@ class BaseAutomationClient(BaseClient):
                 e.msg = base_error_message + ": " + e.msg
             raise
 
+    def _download_file(self, url, file_out, digest, digest_algorithm, digester):
+        """Download the content at url to file_out
+
+        A partial file_out holding the same content, as told by the digest and the
+        size of its validation key, is completed by requesting the missing ranges only.
+        The digests are always computed on the whole content.
+        """
+        action = Action.get_current_action()
+        key = self._load_download_key(file_out, digest)
+        if key is not None and key.get('segments') is not None:
+            log.debug('Resuming the segmented download of %r: %d segments done', file_out, len(key['segments']))
+            if action is not None:
+                action.size = key['size']
+                action.progress += sum([self._get_segment_length(key, index) for index in key['segments']])
+            self._download_segments(url, file_out, key, action)
+            if digester is not None:
+                self._digest_file(file_out, digester, use_mmap=True)
+        else:
+            offset = os.path.getsize(file_out) if key is not None else 0
+            segment_size = None
+            if (digest is not None and self.upload_store is not None and offset == 0
+                    and self.get_download_segment_threads() > 1):
+                segment_size = self.get_download_segment_size()
+            # The first segment tells whether the server handles ranges
+            end = segment_size - 1 if segment_size is not None else None
+            response, start, size = self._open_download(url, offset, end)
+            if response is None and key is not None and offset == key['size']:
+                # Range not satisfiable: the partial file is complete
+                start = size = offset
+            elif response is None or (start != 0 and (start != offset or size != key['size'])):
+                log.debug('Partial download %r does not match the content at %r, restarting it', file_out, url)
+                if response is not None:
+                    response.close()
+                response, start, size = self._open_download(url)
+                segment_size = None
+            if start > 0:
+                log.debug('Resuming the download of %r from byte %d', file_out, start)
+            if action is not None:
+                action.size = size or 0
+                action.progress += start
+            segmented = (segment_size is not None and response is not None and response.getcode() == 206
+                         and size > segment_size)
+            if digest is not None and size is not None:
+                key = {'digest': digest, 'size': size}
+                if segmented:
+                    key.update({'segment_size': segment_size, 'segments': []})
+                self._save_download_key(file_out, key)
+            else:
+                self._remove_download_key(file_out)
+            if segmented:
+                with open(file_out, 'wb') as f:
+                    f.truncate(size)
+                    written = self._write_response(response, f, file_out, action)
+                if written != segment_size:
+                    raise DownloadInterrupted('Incomplete first segment of %r: %d/%d bytes'
+                                              % (file_out, written, segment_size))
+                key['segments'].append(0)
+                self._save_download_key(file_out, key)
+                self._download_segments(url, file_out, key, action)
+                if digester is not None:
+                    self._digest_file(file_out, digester, use_mmap=True)
+            elif response is not None:
+                if start > 0 and digester is not None:
+                    self._digest_file(file_out, digester, use_mmap=True)
+                with open(file_out, 'ab' if start > 0 else 'wb') as f:
+                    written = self._write_response(response, f, file_out, action, digester=digester)
+                if size is not None and start + written != size:
+                    raise DownloadInterrupted('Incomplete download of %r: %d/%d bytes'
+                                              % (file_out, start + written, size))
+            elif digester is not None:
+                self._digest_file(file_out, digester, use_mmap=True)
+        if digest is not None:
+            actual_digest = digester.hexdigest(digest_algorithm)
+            if digest != actual_digest:
+                self.remove_partial_download(file_out)
+                raise CorruptedFile("Corrupted file %r: expected digest = %s, actual digest = %s"
+                                    % (file_out, digest, actual_digest))
+        self._remove_download_key(file_out)
+
+    def _open_download(self, url, start=0, end=None):
+        """Request the content at url from the start offset to the end one included
+
+        Return the response, the offset of its first byte and the size of the whole
+        content if known. The response is None if the range is not satisfiable.
+        """
+        headers = self._get_common_headers()
+        if start > 0 or end is not None:
+            headers['Range'] = 'bytes=%d-%s' % (start, '' if end is None else end)
+        log.trace("Calling '%s' with headers: %r", url, headers)
+        req = urllib2.Request(url, headers=headers)
+        try:
+            response = self.opener.open(req, timeout=self.blob_timeout)
+        except urllib2.HTTPError as e:
+            if e.code != 416:
+                raise e
+            e.read()
+            return None, start, None
+        info = response.info()
+        if response.getcode() == 206:
+            match = CONTENT_RANGE_PATTERN.match(info.getheader('Content-Range', ''))
+            if match is None:
+                response.close()
+                raise DownloadInterrupted('Invalid Content-Range for %r: %r'
+                                          % (url, info.getheader('Content-Range')))
+            first, size = match.groups()
+            return response, int(first), int(size) if size != '*' else None
+        length = info.getheader('Content-Length')
+        return response, 0, int(length) if length is not None else None
+
+    def _write_response(self, response, f, file_out, action, digester=None, length=None, lock=None, stop=None):
+        """Copy the response body to f, return the number of bytes written"""
+        written = 0
+        buffer_size = self.get_download_buffer()
+        while length is None or written < length:
+            if stop is not None:
+                if stop.is_set():
+                    raise DownloadInterrupted()
+            # Check if synchronization thread was suspended
+            elif self.check_suspended is not None:
+                self.check_suspended('File download: %s' % file_out)
+            buffer_ = response.read(buffer_size if length is None else min(buffer_size, length - written))
+            if buffer_ == '':
+                break
+            f.write(buffer_)
+            written += len(buffer_)
+            if digester is not None:
+                digester.update(buffer_)
+            if action is not None:
+                if lock is not None:
+                    with lock:
+                        action.progress += len(buffer_)
+                else:
+                    action.progress += len(buffer_)
+        return written
+
+    def _download_segments(self, url, file_out, key, action):
+        """Download the segments of file_out missing from its validation key, several at a time"""
+        segment_count = (key['size'] + key['segment_size'] - 1) // key['segment_size']
+        missing = [index for index in range(segment_count) if index not in key['segments']]
+        log.debug('Downloading %d/%d segments of %r', len(missing), segment_count, file_out)
+        lock = Lock()
+
+        def download_segment(index, stop):
+            self._download_segment(url, file_out, key, index, action, lock, stop)
+            with lock:
+                key['segments'].append(index)
+                self._save_download_key(file_out, key)
+
+        self._run_transfer_threads(missing, download_segment, self.get_download_segment_threads(),
+                                   'SegmentDownload', 'File download: %s' % file_out)
+
+    def _download_segment(self, url, file_out, key, index, action, lock, stop):
+        start = index * key['segment_size']
+        length = self._get_segment_length(key, index)
+        response, first, _ = self._open_download(url, start, start + length - 1)
+        if response is None or response.getcode() != 206 or first != start:
+            if response is not None:
+                response.close()
+            raise DownloadInterrupted('Range %d-%d of %r not served' % (start, start + length - 1, url))
+        try:
+            with open(file_out, 'r+b') as f:
+                f.seek(start)
+                written = self._write_response(response, f, file_out, action, length=length, lock=lock,
+                                               stop=stop)
+        finally:
+            response.close()
+        if written != length:
+            raise DownloadInterrupted('Incomplete segment %d of %r: %d/%d bytes' % (index, file_out, written,
+                                                                                    length))
+
+    def _get_segment_length(self, key, index):
+        return min(key['segment_size'], key['size'] - index * key['segment_size'])
+
+    def _run_transfer_threads(self, items, process, thread_count, name, description):
+        """Call process(item, stop) on each item from several threads
+
+        The first error stops the other threads and is raised once they are done.
+        """
+        pending = Queue()
+        for item in items:
+            pending.put(item)
+        stop = Event()
+        errors = []
+
+        def process_pending_items():
+            while not stop.is_set():
+                try:
+                    item = pending.get_nowait()
+                except Empty:
+                    return
+                try:
+                    process(item, stop)
+                except Exception as e:
+                    if not stop.is_set():
+                        errors.append(e)
+                        stop.set()
+                    return
+
+        threads = []
+        for _ in range(min(thread_count, len(items))):
+            thread = Thread(target=process_pending_items, name=name)
+            # Not waited for on interruption, it stops after the current buffer
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+                    # Check if synchronization thread was suspended
+                    if self.check_suspended is not None:
+                        self.check_suspended(description)
+        finally:
+            stop.set()
+        if errors:
+            raise errors[0]
+
+    def _load_download_key(self, file_out, digest):
+        """Return the validation key of the partial file_out if it holds the content with the given digest"""
+        key_file = file_out + DOWNLOAD_KEY_FILE_SUFFIX
+        if digest is None or not os.path.exists(file_out) or not os.path.exists(key_file):
+            return None
+        try:
+            with open(key_file, 'rb') as f:
+                key = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug('Cannot read the validation key of %r: %r', file_out, e)
+            return None
+        if key.get('digest') != digest:
+            return None
+        if key.get('segments') is None and os.path.getsize(file_out) > key['size']:
+            return None
+        return key
+
+    def _save_download_key(self, file_out, key):
+        with open(file_out + DOWNLOAD_KEY_FILE_SUFFIX, 'wb') as f:
+            json.dump(key, f)
+
+    def _remove_download_key(self, file_out):
+        key_file = file_out + DOWNLOAD_KEY_FILE_SUFFIX
+        if os.path.exists(key_file):
+            os.remove(key_file)
+
+    def is_partial_download(self, file_out):
+        """Return True if file_out is kept to resume its download"""
+        return os.path.exists(file_out) and os.path.exists(file_out + DOWNLOAD_KEY_FILE_SUFFIX)
+
+    def remove_partial_download(self, file_out):
+        if os.path.exists(file_out):
+            os.remove(file_out)
+        self._remove_download_key(file_out)
+
+    def get_download_segment_size(self):
+        return int(self.upload_store.get_config('download_segment_size', DOWNLOAD_SEGMENT_SIZE))
+
+    def get_download_segment_threads(self):
+        return int(self.upload_store.get_config('download_segment_threads', DOWNLOAD_SEGMENT_THREADS))
+
     def get_download_buffer(self):
         return FILE_BUFFER_SIZE
@@ -0,0 +1,96 @@
+"""Reusable buffers to hash and upload the files without allocating a string per read."""
+
+import mmap
+import os
+from contextlib import contextmanager
+from threading import Lock
+from nxdrive.client.common import FILE_BUFFER_SIZE
+
+# Files at least this large are hashed through a memory map when allowed
+MMAP_THRESHOLD = 16 * 1024 * 1024
+# The suspension is checked between two slices of the memory map
+MMAP_SLICE_SIZE = 16 * 1024 * 1024
+
+
+class BufferPool(object):
+    """Buffers of the same size shared by the hashing and transfer threads
+
+    At most max_idle released buffers are kept for reuse, the others are freed.
+    """
+
+    def __init__(self, buffer_size=FILE_BUFFER_SIZE, max_idle=8):
+        self.buffer_size = buffer_size
+        self._max_idle = max_idle
+        self._idle = []
+        self._lock = Lock()
+        self.created = 0
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.created += 1
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer_):
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append(buffer_)
+
+    @contextmanager
+    def buffer(self):
+        buffer_ = self.acquire()
+        try:
+            yield buffer_
+        finally:
+            self.release(buffer_)
+
+
+BUFFER_POOL = BufferPool()
+
+
+def read_chunks(input_file, length=None, read_size=None, buffer_pool=BUFFER_POOL):
+    """Yield the content of input_file, up to length bytes, as views of a pooled buffer
+
+    A view is overwritten by the next one: it must be consumed before asking for it.
+    """
+    with buffer_pool.buffer() as buffer_:
+        view = memoryview(buffer_)
+        read_size = min(read_size or len(buffer_), len(buffer_))
+        while length is None or length > 0:
+            size = read_size if length is None else min(read_size, length)
+            read = input_file.readinto(view[:size])
+            if not read:
+                break
+            if length is not None:
+                length -= read
+            yield view[:read]
+
+
+def hash_file(file_path, digester, check_suspended=None, description='Digest computation: %s', use_mmap=False,
+              mmap_threshold=MMAP_THRESHOLD, buffer_pool=BUFFER_POOL):
+    """Update the digester with the content of file_path
+
+    A memory map saves copying the content of a large file, but the process
+    gets a SIGBUS if the file is truncated meanwhile: use_mmap is only for the
+    files that no other process modifies, like the partial downloads.
+    """
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if use_mmap and size >= max(1, mmap_threshold):
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, MMAP_SLICE_SIZE):
+                    # Check if synchronization thread was suspended
+                    if check_suspended is not None:
+                        check_suspended(description % file_path)
+                    digester.update(buffer(mapped, offset, MMAP_SLICE_SIZE))
+            finally:
+                mapped.close()
+            return
+        for chunk in read_chunks(f, buffer_pool=buffer_pool):
+            # Check if synchronization thread was suspended
+            if check_suspended is not None:
+                check_suspended(description % file_path)
+            digester.update(chunk)
+
@@ -3,6 +3,7 @@
 import re
 import os
 import stat
+import hashlib
 
 
 class BaseClient(object):
@@ -61,6 +62,33 @@ class BaseClient(object):
             self.set_path_readonly(parent)
 
 
+class StreamDigester(object):
+    """Compute the digests of several algorithms in a single pass over the bytes"""
+
+    def __init__(self, *algorithms):
+        self._digesters = dict()
+        for algorithm in algorithms:
+            self.add(algorithm)
+
+    def add(self, algorithm):
+        if algorithm is None or algorithm in self._digesters:
+            return
+        digester = getattr(hashlib, algorithm, None)
+        if digester is None:
+            raise ValueError('Unknow digest method: ' + algorithm)
+        self._digesters[algorithm] = digester()
+
+    def update(self, buffer_):
+        for digester in self._digesters.itervalues():
+            digester.update(buffer_)
+
+    def hexdigest(self, algorithm):
+        return self._digesters[algorithm].hexdigest()
+
+    def hexdigests(self):
+        return dict((algorithm, digester.hexdigest()) for algorithm, digester in self._digesters.iteritems())
+
+
 class NotFound(Exception):
     pass
 
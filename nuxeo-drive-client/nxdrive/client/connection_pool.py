@@ -0,0 +1,290 @@
+"""Keep-alive HTTP connections shared by the Nuxeo clients of an engine."""
+
+import httplib
+import select
+import socket
+import urllib2
+from threading import Condition
+from time import time
+from poster.streaminghttp import StreamingHTTPConnection
+from poster.streaminghttp import StreamingHTTPHandler
+from poster.streaminghttp import StreamingHTTPRedirectHandler
+from nxdrive.logging_config import get_logger
+
+log = get_logger(__name__)
+
+
+# Methods which can be sent again when the response of a reused connection is lost
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+
+
+def is_connection_dropped(connection):
+    """Return True if the server closed the idle connection, its socket is then readable"""
+    sock = connection.sock
+    if sock is None:
+        # Connected again on the next request
+        return False
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+class ConnectionPool(object):
+    """Idle HTTP connections by host, with a limit of connections per host
+
+    A connection is acquired for one request and given back once its
+    response has been fully read, so it can be reused by the next request
+    to the same host instead of doing a new TCP / TLS handshake.
+    The limit per host is a soft one: after waiting wait_timeout seconds for
+    a connection to be released, a new one is opened anyway.
+    """
+
+    def __init__(self, max_per_host=4, idle_timeout=15, wait_timeout=10):
+        self._max_per_host = max_per_host
+        self._idle_timeout = idle_timeout
+        self._wait_timeout = wait_timeout
+        self._condition = Condition()
+        # key -> list of (connection, release time), most recent last
+        self._idle = dict()
+        # key -> number of connections in use
+        self._active = dict()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, key, factory, reuse=True):
+        """Return a (connection, reused) tuple for the given host key"""
+        to_close = []
+        with self._condition:
+            deadline = time() + self._wait_timeout
+            while True:
+                to_close.extend(self._evict_idle())
+                idle = self._idle.get(key)
+                if reuse and idle:
+                    connection = idle.pop()[0]
+                    self._active[key] = self._active.get(key, 0) + 1
+                    self.reused += 1
+                    break
+                if idle and (self._count(key) >= self._max_per_host):
+                    # Make room for a new connection
+                    to_close.append(idle.pop(0)[0])
+                remaining = deadline - time()
+                if self._count(key) < self._max_per_host or remaining <= 0:
+                    connection = None
+                    self._active[key] = self._active.get(key, 0) + 1
+                    self.created += 1
+                    break
+                self._condition.wait(remaining)
+        self._close(to_close)
+        if connection is not None:
+            return connection, True
+        try:
+            return factory(), False
+        except:
+            self.discard(key, None)
+            raise
+
+    def release(self, key, connection):
+        """Give back a connection that can be reused"""
+        with self._condition:
+            self._active[key] -= 1
+            self._idle.setdefault(key, []).append((connection, time()))
+            self._condition.notify()
+
+    def discard(self, key, connection):
+        """Give back a connection that cannot be reused"""
+        with self._condition:
+            self._active[key] -= 1
+            self._condition.notify()
+        if connection is not None:
+            self._close([connection])
+
+    def clear(self):
+        """Close all the idle connections"""
+        with self._condition:
+            to_close = [connection for idle in self._idle.values() for connection, _ in idle]
+            self._idle.clear()
+            self._condition.notify_all()
+        self._close(to_close)
+
+    def get_metrics(self):
+        with self._condition:
+            idle = sum([len(connections) for connections in self._idle.values()])
+            active = sum(self._active.values())
+            return {"http_connections_created": self.created, "http_connections_reused": self.reused,
+                    "http_connections_idle": idle, "http_connections_active": active}
+
+    def _count(self, key):
+        return self._active.get(key, 0) + len(self._idle.get(key, []))
+
+    def _evict_idle(self):
+        # Must be called with the condition held
+        evicted = []
+        limit = time() - self._idle_timeout
+        for key, idle in self._idle.items():
+            while idle and idle[0][1] < limit:
+                evicted.append(idle.pop(0)[0])
+            if not idle:
+                del self._idle[key]
+        return evicted
+
+    def _close(self, connections):
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception as e:
+                log.trace("Error while closing HTTP connection: %r", e)
+
+
+class PooledResponse(object):
+    """File-like HTTP response body giving back its connection to the pool once read"""
+
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._released = False
+        self._check_complete()
+
+    def read(self, amt=None):
+        data = self._response.read() if amt is None else self._response.read(amt)
+        self._check_complete()
+        return data
+
+    def readline(self, limit=-1):
+        line = ''
+        while not line.endswith('\n') and (limit < 0 or len(line) < limit):
+            char = self.read(1)
+            if not char:
+                break
+            line += char
+        return line
+
+    def readlines(self, sizehint=0):
+        return list(iter(self.readline, ''))
+
+    def close(self):
+        if not self._released:
+            # The body was not fully read: the connection cannot be reused
+            self._released = True
+            self._pool.discard(self._key, self._connection)
+        self._response.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def _check_complete(self):
+        if self._released or not self._response.isclosed():
+            return
+        self._released = True
+        if self._response.will_close:
+            self._pool.discard(self._key, self._connection)
+        else:
+            self._pool.release(self._key, self._connection)
+
+
+class PooledHandlerMixin(object):
+    """Open the urllib2 requests on the connections of a ConnectionPool"""
+
+    def __init__(self, pool, *args, **kwargs):
+        super(PooledHandlerMixin, self).__init__(*args, **kwargs)
+        self._pool = pool
+
+    def do_open_pooled(self, connection_class, req, **kwargs):
+        """Same as urllib2.AbstractHTTPHandler.do_open without the Connection: close header"""
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        tunnel_headers = {}
+        if req._tunnel_host:
+            proxy_auth_hdr = "Proxy-Authorization"
+            if proxy_auth_hdr in headers:
+                tunnel_headers[proxy_auth_hdr] = headers.pop(proxy_auth_hdr)
+
+        # Streamed bodies cannot be sent again on a stale connection
+        data = req.get_data()
+        replayable = data is None or isinstance(data, basestring)
+        key = (connection_class.__name__, host, req._tunnel_host)
+        method = req.get_method()
+        while True:
+            connection, reused = self._pool.acquire(
+                key, lambda: connection_class(host, timeout=req.timeout, **kwargs), reuse=replayable)
+            if reused and is_connection_dropped(connection):
+                # Closed by the server while idle, nothing was sent on it
+                self._pool.discard(key, connection)
+                continue
+            try:
+                if not reused and req._tunnel_host:
+                    connection.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+                elif reused:
+                    connection.timeout = req.timeout
+                    if connection.sock is not None:
+                        timeout = req.timeout
+                        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                            timeout = socket.getdefaulttimeout()
+                        connection.sock.settimeout(timeout)
+                connection.request(method, req.get_selector(), data, headers)
+            except (socket.error, httplib.HTTPException) as e:
+                self._pool.discard(key, connection)
+                if reused and not isinstance(e, socket.timeout):
+                    # The request was not fully sent on the stale connection, send it on another one
+                    log.trace("Retry request on a new connection after %r", e)
+                    continue
+                if isinstance(e, socket.error):
+                    raise urllib2.URLError(e)
+                raise
+            try:
+                response = connection.getresponse(buffering=True)
+            except (socket.error, httplib.HTTPException) as e:
+                self._pool.discard(key, connection)
+                if reused and method in IDEMPOTENT_METHODS and not isinstance(e, socket.timeout):
+                    # The server may have handled the request, only send it again if it has no side effect
+                    log.trace("Retry %s request on a new connection after %r", method, e)
+                    continue
+                if isinstance(e, socket.error):
+                    raise urllib2.URLError(e)
+                raise
+            break
+
+        fp = PooledResponse(self._pool, key, connection, response)
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+
+class PooledHTTPHandler(PooledHandlerMixin, StreamingHTTPHandler):
+
+    def http_open(self, req):
+        return self.do_open_pooled(StreamingHTTPConnection, req)
+
+
+if hasattr(httplib, 'HTTPS'):
+    from poster.streaminghttp import StreamingHTTPSConnection
+    from poster.streaminghttp import StreamingHTTPSHandler
+
+    class PooledHTTPSHandler(PooledHandlerMixin, StreamingHTTPSHandler):
+
+        def https_open(self, req):
+            return self.do_open_pooled(StreamingHTTPSConnection, req)
+else:
+    PooledHTTPSHandler = None
+
+
+def get_pooled_handlers(pool, streaming=False):
+    """Return the urllib2 handlers opening their connections from the pool"""
+    handlers = [PooledHTTPHandler(pool)]
+    if PooledHTTPSHandler is not None:
+        handlers.append(PooledHTTPSHandler(pool))
+    if streaming:
+        handlers.append(StreamingHTTPRedirectHandler)
+    return handlers
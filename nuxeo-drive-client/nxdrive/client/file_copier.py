@@ -0,0 +1,117 @@
+"""Local file copies sharing the blocks of the source when the volume supports it."""
+
+import errno
+import io
+import os
+import shutil
+import sys
+from threading import Lock, local
+from nxdrive.client.common import FILE_BUFFER_SIZE
+from nxdrive.logging_config import get_logger
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+log = get_logger(__name__)
+
+# ioctl sharing the blocks of a file with another one on Btrfs, XFS and the
+# other copy-on-write file systems of Linux, same as cp --reflink
+FICLONE = 0x40049409
+# The volume cannot clone any file
+CLONE_UNSUPPORTED_ERRORS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOSYS)
+# These two files cannot be cloned, other files of the volume may be
+CLONE_FILE_ERRORS = (errno.EXDEV, errno.EINVAL)
+
+COPY_CLONE = 'clone'
+COPY_CHUNKED = 'chunked'
+
+
+def clone_file(src, dst):
+    """Make dst share the blocks of src, raise an IOError if the file system cannot"""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise IOError(errno.EOPNOTSUPP, 'File cloning is not supported on %s' % sys.platform)
+    with open(src, 'rb') as input_file:
+        with open(dst, 'wb') as output_file:
+            fcntl.ioctl(output_file.fileno(), FICLONE, input_file.fileno())
+
+
+class FileCopier(object):
+    """Copy the local files with the fastest strategy of their volume
+
+    On a copy-on-write file system the blocks of the source are cloned, so many
+    copies of the same content cost neither I/O nor disk space. Otherwise the
+    content is copied by chunks through a buffer reused by each thread.
+    The strategy is found by the first copy to a volume and kept for the next ones.
+    """
+
+    def __init__(self, buffer_size=FILE_BUFFER_SIZE):
+        self._buffer_size = buffer_size
+        self._buffers = local()
+        self._lock = Lock()
+        # Device id of the volume -> strategy
+        self._strategies = dict()
+        self._files = {COPY_CLONE: 0, COPY_CHUNKED: 0}
+        self._bytes = {COPY_CLONE: 0, COPY_CHUNKED: 0}
+
+    def get_strategy(self, device):
+        """Return the strategy of the volume, None if not known yet"""
+        with self._lock:
+            return self._strategies.get(device)
+
+    def copy(self, src, dst):
+        """Copy the content and the permission bits of src to dst, return the strategy used"""
+        device = os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+        strategy = COPY_CHUNKED
+        if os.stat(src).st_dev == device and self.get_strategy(device) != COPY_CHUNKED:
+            try:
+                clone_file(src, dst)
+                strategy = COPY_CLONE
+                self._set_strategy(device, COPY_CLONE)
+            except (IOError, OSError) as e:
+                if e.errno in CLONE_UNSUPPORTED_ERRORS:
+                    log.debug('Volume of %r cannot clone files, copying them by chunks: %r', dst, e)
+                    self._set_strategy(device, COPY_CHUNKED)
+                elif e.errno in CLONE_FILE_ERRORS:
+                    log.debug('Cannot clone %r to %r, copying it by chunks: %r', src, dst, e)
+                else:
+                    raise
+        if strategy == COPY_CHUNKED:
+            self._copy_chunks(src, dst)
+        shutil.copymode(src, dst)
+        size = os.path.getsize(dst)
+        with self._lock:
+            self._files[strategy] += 1
+            self._bytes[strategy] += size
+        return strategy
+
+    def get_metrics(self):
+        with self._lock:
+            return {"copy_strategies": dict(self._strategies),
+                    "copy_cloned_files": self._files[COPY_CLONE],
+                    "copy_cloned_bytes": self._bytes[COPY_CLONE],
+                    "copy_chunked_files": self._files[COPY_CHUNKED],
+                    "copy_chunked_bytes": self._bytes[COPY_CHUNKED]}
+
+    def _set_strategy(self, device, strategy):
+        with self._lock:
+            if self._strategies.get(device) != strategy:
+                log.debug('Using the %s copy strategy for device %r', strategy, device)
+                self._strategies[device] = strategy
+
+    def _copy_chunks(self, src, dst):
+        buffer_ = getattr(self._buffers, 'buffer', None)
+        if buffer_ is None:
+            buffer_ = self._buffers.buffer = bytearray(self._buffer_size)
+        view = memoryview(buffer_)
+        with io.open(src, 'rb', buffering=0) as input_file:
+            with io.open(dst, 'wb', buffering=0) as output_file:
+                while True:
+                    length = input_file.readinto(buffer_)
+                    if not length:
+                        break
+                    written = 0
+                    while written < length:
+                        written += output_file.write(view[written:length])
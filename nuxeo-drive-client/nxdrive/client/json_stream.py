@@ -0,0 +1,125 @@
+"""Incremental decoding of the JSON responses of the Automation operations."""
+
+import json
+from json.decoder import WHITESPACE
+
+READ_SIZE = 64 * 1024
+
+# Relies on the C scanner of the _json module when the interpreter has it
+_decoder = json.JSONDecoder()
+
+
+def load(fp, items_key=None, item_converter=None, read_size=READ_SIZE):
+    """Decode the JSON document read from the fp file-like object
+
+    The items of the items_key array of the top-level object are decoded one
+    at a time and replaced by item_converter(item), so neither the whole body
+    nor the whole list of decoded items is ever held in memory.
+    Return None for an empty body, as json.loads would fail on it.
+    """
+    return JSONStreamReader(fp, read_size=read_size).load(items_key=items_key, item_converter=item_converter)
+
+
+class JSONStreamReader(object):
+    """Decode a JSON document from a file-like object, reading it by chunks"""
+
+    def __init__(self, fp, read_size=READ_SIZE):
+        self._fp = fp
+        self._read_size = read_size
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def load(self, items_key=None, item_converter=None):
+        self._skip_whitespace()
+        if self._pos >= len(self._buffer):
+            return None
+        if items_key is not None and self._buffer[self._pos] == '{':
+            result = self._load_object(items_key, item_converter)
+        else:
+            result = self._decode_value()
+        # Read up to the end so the connection can be reused
+        self._skip_whitespace()
+        if self._pos < len(self._buffer):
+            raise ValueError("Extra data after the JSON document")
+        return result
+
+    def _load_object(self, items_key, item_converter):
+        self._pos += 1
+        result = dict()
+        if self._peek() == '}':
+            self._pos += 1
+            return result
+        while True:
+            if self._peek() != '"':
+                raise ValueError("Expecting property name")
+            key = self._decode_value()
+            self._expect(':')
+            if key == items_key and self._peek() == '[':
+                result[key] = self._load_items(item_converter)
+            else:
+                result[key] = self._decode_value()
+            if self._expect(',}') == '}':
+                return result
+
+    def _load_items(self, item_converter):
+        self._pos += 1
+        items = []
+        if self._peek() == ']':
+            self._pos += 1
+            return items
+        while True:
+            item = self._decode_value()
+            items.append(item_converter(item) if item_converter is not None else item)
+            if self._expect(',]') == ']':
+                return items
+
+    def _decode_value(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # Most likely a value truncated by the end of the buffer
+                if not self._fill():
+                    raise
+                continue
+            if end == len(self._buffer) and self._fill():
+                # A number or a literal may go on in the next chunk
+                continue
+            self._pos = end
+            return value
+
+    def _peek(self):
+        self._skip_whitespace()
+        if self._pos >= len(self._buffer):
+            raise ValueError("Unexpected end of the JSON document")
+        return self._buffer[self._pos]
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError("Expecting one of %r at %r" % (chars, self._buffer[self._pos:self._pos + 20]))
+        self._pos += 1
+        return char
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill():
+                return
+
+    def _fill(self):
+        """Read the next chunk, dropping the decoded data, return False at the end of the stream"""
+        if self._eof:
+            return False
+        if self._pos > 0:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        # Read at least as much as buffered so a large value is not decoded again for each chunk
+        data = self._fp.read(max(self._read_size, len(self._buffer)))
+        if not data:
+            self._eof = True
+            return False
+        self._buffer += data
+        return True
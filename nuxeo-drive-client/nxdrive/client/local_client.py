@@ -7,6 +7,9 @@ import os
 import shutil
 import re
 import tempfile
+import stat
+from collections import OrderedDict
+from threading import Lock
 from nxdrive.client.common import BaseClient, UNACCESSIBLE_HASH
 from nxdrive.osi import AbstractOSIntegration
 
@@ -20,8 +23,13 @@ from nxdrive.client.common import DEFAULT_IGNORED_SUFFIXES
 from nxdrive.utils import normalized_path
 from nxdrive.utils import safe_long_path
 from nxdrive.utils import guess_digest_algorithm
-from nxdrive.client.common import FILE_BUFFER_SIZE
+from nxdrive.client.buffer_pool import hash_file
 from send2trash import send2trash
+try:
+    # Use the backport of os.scandir when available
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 
 log = get_logger(__name__)
@@ -30,13 +38,79 @@ log = get_logger(__name__)
 DEDUPED_BASENAME_PATTERN = ur'^(.*)__(\d{1,3})$'
 
 
+class DigestCache(object):
+    """Digests of the local files by device, inode, size, modification time and algorithm
+
+    The most recently used digests are kept in memory, the others are persisted
+    through the DAO if any. Both are bounded with a LRU eviction.
+    """
+
+    # Number of writes between two evictions in the DAO
+    EVICTION_PERIOD = 1000
+
+    def __init__(self, dao=None, memory_size=1000, size=100000):
+        self._dao = dao
+        self._memory = OrderedDict()
+        self._memory_size = memory_size
+        self._size = size
+        self._writes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(stat_info, digest_func):
+        if not stat_info.st_ino:
+            # No inode on Windows with Python 2, the key would not be unique
+            return None
+        mtime_ns = getattr(stat_info, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(stat_info.st_mtime * 1000000000)
+        return (stat_info.st_dev, stat_info.st_ino, stat_info.st_size, mtime_ns, digest_func)
+
+    def get(self, key):
+        with self._lock:
+            digest = self._memory.pop(key, None)
+            if digest is not None:
+                self._memory[key] = digest
+                self.hits += 1
+                return digest
+        if self._dao is not None:
+            digest = self._dao.get_digest_cache(key)
+        with self._lock:
+            if digest is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._remember(key, digest)
+        return digest
+
+    def set(self, key, digest):
+        with self._lock:
+            self._remember(key, digest)
+            self._writes += 1
+            evict = self._writes % self.EVICTION_PERIOD == 0
+        if self._dao is not None:
+            self._dao.set_digest_cache(key, digest)
+            if evict:
+                self._dao.evict_digest_cache(self._size)
+
+    def get_metrics(self):
+        return {'digest_cache_hits': self.hits, 'digest_cache_misses': self.misses}
+
+    def _remember(self, key, digest):
+        self._memory[key] = digest
+        while len(self._memory) > self._memory_size:
+            self._memory.popitem(last=False)
+
+
 # Data transfer objects
 
 class FileInfo(object):
     """Data Transfer Object for file info on the Local FS"""
 
     def __init__(self, root, path, folderish, last_modification_time, size=0,
-                 digest_func='md5', check_suspended=None, remote_ref=None):
+                 digest_func='md5', check_suspended=None, remote_ref=None, digest_cache=None):
 
         # Function to check during long-running processing like digest
         # computation if the synchronization thread needs to be suspended
@@ -50,7 +124,7 @@ class FileInfo(object):
 
         # Normalize name on the file system if not normalized
         # See https://jira.nuxeo.com/browse/NXDRIVE-188
-        if os.path.exists(filepath) and normalized_filepath != filepath and not AbstractOSIntegration.is_mac():
+        if normalized_filepath != filepath and not AbstractOSIntegration.is_mac() and os.path.exists(filepath):
             log.debug('Forcing normalization of %r to %r', filepath, normalized_filepath)
             os.rename(filepath, normalized_filepath)
 
@@ -64,6 +138,7 @@ class FileInfo(object):
 
         # Function to use
         self._digest_func = digest_func.lower()
+        self._digest_cache = digest_cache
 
         # Precompute base name once and for all are it's often useful in
         # practice
@@ -84,21 +159,31 @@ class FileInfo(object):
         if digester is None:
             raise ValueError('Unknow digest method: ' + digest_func)
 
+        key = None
+        if self._digest_cache is not None:
+            try:
+                key = DigestCache.get_key(os.stat(safe_long_path(self.filepath)), digest_func)
+            except OSError:
+                return UNACCESSIBLE_HASH
+            if key is not None:
+                digest = self._digest_cache.get(key)
+                if digest is not None:
+                    return digest
+
         h = digester()
         try:
-            with open(safe_long_path(self.filepath), 'rb') as f:
-                while True:
-                    # Check if synchronization thread was suspended
-                    if self.check_suspended is not None:
-                        self.check_suspended('Digest computation: %s'
-                                             % self.filepath)
-                    buffer_ = f.read(FILE_BUFFER_SIZE)
-                    if buffer_ == '':
-                        break
-                    h.update(buffer_)
+            hash_file(safe_long_path(self.filepath), h, check_suspended=self.check_suspended)
         except IOError:
             return UNACCESSIBLE_HASH
-        return h.hexdigest()
+        digest = h.hexdigest()
+        if key is not None:
+            try:
+                # Only keep it if the file has not changed while reading it
+                if key == DigestCache.get_key(os.stat(safe_long_path(self.filepath)), digest_func):
+                    self._digest_cache.set(key, digest)
+            except OSError:
+                pass
+        return digest
 
 
 class LocalClient(BaseClient):
@@ -108,8 +193,10 @@ class LocalClient(BaseClient):
     # Automation operations fetched at manager init time.
 
     def __init__(self, base_folder, digest_func='md5', ignored_prefixes=None,
-                    ignored_suffixes=None, check_suspended=None, case_sensitive=None, disable_duplication=False):
+                    ignored_suffixes=None, check_suspended=None, case_sensitive=None, disable_duplication=False,
+                    digest_cache=None):
         self._case_sensitive = case_sensitive
+        self._digest_cache = digest_cache
         self._disable_duplication = disable_duplication
         # Function to check during long-running processing like digest
         # computation if the synchronization thread needs to be suspended
@@ -408,14 +495,18 @@ class LocalClient(BaseClient):
         if isinstance(ref, str):
             ref = unicode(ref)
         os_path = self._abspath(ref)
-        if not os.path.exists(os_path):
+        try:
+            stat_info = os.stat(os_path)
+        except OSError:
             if raise_if_missing:
                 raise NotFound("Could not found file '%s' under '%s'" % (
                 ref, self.base_folder))
             else:
                 return None
-        folderish = os.path.isdir(os_path)
-        stat_info = os.stat(os_path)
+        return self._get_info_from_stat(ref, stat_info)
+
+    def _get_info_from_stat(self, ref, stat_info):
+        folderish = stat.S_ISDIR(stat_info.st_mode)
         if folderish:
             size = 0
         else:
@@ -430,14 +521,28 @@ class LocalClient(BaseClient):
         return FileInfo(self.base_folder, ref, folderish, mtime,
                         digest_func=self._digest_func,
                         check_suspended=self.check_suspended,
-                        remote_ref=remote_ref, size=size)
+                        remote_ref=remote_ref, size=size, digest_cache=self._digest_cache)
+
+    def get_digest_func(self):
+        return self._digest_func
+
+    def set_digests(self, ref, digests):
+        """Keep the digests by algorithm computed while transferring a file to not read it again"""
+        if self._digest_cache is None:
+            return
+        stat_info = os.stat(self._abspath(ref))
+        for digest_func, digest in digests.iteritems():
+            key = DigestCache.get_key(stat_info, digest_func)
+            if key is not None:
+                self._digest_cache.set(key, digest)
 
     def is_equal_digests(self, local_digest, remote_digest, local_path, remote_digest_algorithm=None):
         if local_digest == remote_digest:
             return True
         if remote_digest_algorithm is None:
             remote_digest_algorithm = guess_digest_algorithm(remote_digest)
-        if remote_digest_algorithm == self._digest_func:
+        # The local digest is None while it is pending in the local watcher digester
+        if remote_digest_algorithm == self._digest_func and local_digest is not None:
             return False
         else:
             return self.get_info(local_path).get_digest(digest_func=remote_digest_algorithm) == remote_digest
@@ -506,14 +611,11 @@ class LocalClient(BaseClient):
     def get_children_info(self, ref):
         os_path = self._abspath(ref)
         result = []
-        children = os.listdir(os_path)
-        children.sort()
-        for child_name in children:
-
+        for child_name, stat_info in sorted(self._get_children_stat(os_path)):
             if not (self.is_ignored(ref, child_name) or self.is_temp_file(child_name)):
                 child_ref = self.get_children_ref(ref, child_name)
                 try:
-                    result.append(self.get_info(child_ref))
+                    result.append(self._get_info_from_stat(child_ref, stat_info))
                 except (OSError, NotFound):
                     # the child file has been deleted in the mean time or while
                     # reading some of its attributes
@@ -521,6 +623,24 @@ class LocalClient(BaseClient):
 
         return result
 
+    def _get_children_stat(self, os_path):
+        """List the (name, stat) of a folder children, with a single stat per child"""
+        result = []
+        if scandir is not None:
+            for entry in scandir(os_path):
+                try:
+                    # Cached from the directory listing on Windows
+                    result.append((entry.name, entry.stat()))
+                except OSError:
+                    pass
+            return result
+        for child_name in os.listdir(os_path):
+            try:
+                result.append((child_name, os.stat(os.path.join(os_path, child_name))))
+            except OSError:
+                pass
+        return result
+
     def get_parent_ref(self, ref):
         if ref == '/':
             return None
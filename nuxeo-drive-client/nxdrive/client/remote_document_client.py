@@ -69,7 +69,8 @@ class RemoteDocumentClient(BaseAutomationClient):
                  password=None, token=None, repository=DEFAULT_REPOSITORY_NAME,
                  ignored_prefixes=None, ignored_suffixes=None,
                  base_folder=None, timeout=20, blob_timeout=None,
-                 cookie_jar=None, upload_tmp_dir=None, check_suspended=None):
+                 cookie_jar=None, upload_tmp_dir=None, check_suspended=None,
+                 connection_pool=None):
         super(RemoteDocumentClient, self).__init__(
             server_url, user_id, device_id, client_version,
             proxies=proxies, proxy_exceptions=proxy_exceptions,
@@ -78,7 +79,7 @@ class RemoteDocumentClient(BaseAutomationClient):
             ignored_suffixes=ignored_suffixes,
             timeout=timeout, blob_timeout=blob_timeout,
             cookie_jar=cookie_jar, upload_tmp_dir=upload_tmp_dir,
-            check_suspended=check_suspended)
+            check_suspended=check_suspended, connection_pool=connection_pool)
 
         # fetch the root folder ref
         self.set_base_folder(base_folder)
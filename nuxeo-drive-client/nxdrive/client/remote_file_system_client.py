@@ -1,5 +1,6 @@
 """API to access a remote file system for synchronization."""
 
+import json
 import unicodedata
 from collections import namedtuple
 from datetime import datetime
@@ -10,11 +11,16 @@ from nxdrive.client.base_automation_client import BaseAutomationClient
 from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_PREFIX
 from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_SUFFIX
 from nxdrive.engine.activity import FileAction
-from threading import current_thread
 
 
 log = get_logger(__name__)
 
+# Server operation creating a folder hierarchy in one call, contributed by
+# resources/server/nuxeo-drive-create-folders-config.xml on the servers enabling it
+CREATE_FOLDERS_OPERATION = 'NuxeoDrive.CreateFolders'
+# Folders created by each call of the operation
+FOLDER_BATCH_SIZE = 500
+
 # Data transfer objects
 
 BaseRemoteFileInfo = namedtuple('RemoteFileInfo', [
@@ -34,13 +40,17 @@ BaseRemoteFileInfo = namedtuple('RemoteFileInfo', [
     'can_create_child',  # True is can create child
     'lock_owner',  # lock owner
     'lock_created',  # lock creation time
-    'can_scroll_descendants'  # True if the API to scroll through the descendants can be used
+    'can_scroll_descendants',  # True if the API to scroll through the descendants can be used
+    'size',  # size of the file content in bytes, None if unknown
 ])
 
 
 class RemoteFileInfo(BaseRemoteFileInfo):
     """Data Transfer Object for remote file info"""
 
+    # No instance dictionary, there can be one for each item of a large change summary
+    __slots__ = ()
+
     # Consistency with the local client API
     def get_digest(self):
         return self.digest
@@ -88,9 +98,11 @@ class RemoteFileSystemClient(BaseAutomationClient):
         return content
 
     def stream_content(self, fs_item_id, file_path, parent_fs_item_id=None,
-                                    fs_item_info=None, file_out=None):
+                                    fs_item_info=None, file_out=None, digester=None):
         """Stream the binary content of a file system item to a tmp file
 
+        The optional StreamDigester is updated with the downloaded bytes.
+        An interrupted download is resumed by the next call for the same file.
         Raises NotFound if file system item with id fs_item_id
         cannot be found
         """
@@ -101,13 +113,15 @@ class RemoteFileSystemClient(BaseAutomationClient):
         file_name = os.path.basename(file_path)
         if file_out is None:
             file_dir = os.path.dirname(file_path)
-            file_out = os.path.join(file_dir, DOWNLOAD_TMP_FILE_PREFIX + file_name
-                                                    + str(current_thread().ident) + DOWNLOAD_TMP_FILE_SUFFIX)
+            # Same name on each attempt so an interrupted download can be resumed
+            file_out = os.path.join(file_dir, DOWNLOAD_TMP_FILE_PREFIX + file_name + DOWNLOAD_TMP_FILE_SUFFIX)
         FileAction("Download", file_out, file_name, 0)
         try:
-            _, tmp_file = self.do_get(download_url, file_out=file_out, digest=fs_item_info.digest, digest_algorithm=fs_item_info.digest_algorithm)
+            _, tmp_file = self.do_get(download_url, file_out=file_out, digest=fs_item_info.digest,
+                                      digest_algorithm=fs_item_info.digest_algorithm, digester=digester)
         except Exception as e:
-            if os.path.exists(file_out):
+            # Keep the partial download of a known content to resume it
+            if os.path.exists(file_out) and not self.is_partial_download(file_out):
                 os.remove(file_out)
             raise e
         finally:
@@ -119,10 +133,11 @@ class RemoteFileSystemClient(BaseAutomationClient):
         return [self.file_to_info(fs_item) for fs_item in children]
 
     def scroll_descendants(self, fs_item_id, scroll_id, batch_size=100):
-        res = self.execute("NuxeoDrive.ScrollDescendants", id=fs_item_id, scrollId=scroll_id, batchSize=batch_size)
+        res = self.execute("NuxeoDrive.ScrollDescendants", id=fs_item_id, scrollId=scroll_id, batchSize=batch_size,
+                           items_key='fileSystemItems', item_converter=self.file_to_info)
         return {
             'scroll_id': res['scrollId'],
-            'descendants': [self.file_to_info(fs_item) for fs_item in res['fileSystemItems']]
+            'descendants': res['fileSystemItems']
         }
 
     def is_filtered(self, path):
@@ -133,6 +148,48 @@ class RemoteFileSystemClient(BaseAutomationClient):
             parentId=parent_id, name=name)
         return self.file_to_info(fs_item)
 
+    def can_make_folders(self):
+        return CREATE_FOLDERS_OPERATION in self.operations
+
+    def get_folder_batch_size(self):
+        return int(self.upload_store.get_config('folder_batch_size', FOLDER_BATCH_SIZE))
+
+    def make_folders(self, parent_id, folders):
+        """Create a folder hierarchy, yield the RemoteFileInfo list of the folders created by each call
+
+        folders is a list of (name, parent index) in parent first order, the parent
+        index being the position of the parent in the list or None for parent_id.
+        Without the optional CreateFolders contribution on the server, the folders
+        are created one by one. The operation takes the folders as a JSON array of
+        {"name", "parentId"} or {"name", "parentIndex"} objects, the index being in
+        the same array, and returns the created file system items in the same order.
+        """
+        infos = []
+        if not self.can_make_folders():
+            for name, parent_index in folders:
+                parent = parent_id if parent_index is None else infos[parent_index].uid
+                infos.append(self.make_folder(parent, name))
+                yield infos[-1:]
+            return
+        batch_size = max(1, self.get_folder_batch_size())
+        for start in xrange(0, len(folders), batch_size):
+            batch = []
+            for name, parent_index in folders[start:start + batch_size]:
+                if parent_index is None:
+                    batch.append({'name': name, 'parentId': parent_id})
+                elif parent_index < start:
+                    # Created by a previous call
+                    batch.append({'name': name, 'parentId': infos[parent_index].uid})
+                else:
+                    batch.append({'name': name, 'parentIndex': parent_index - start})
+            log.debug("Creating %d remote folders in one call", len(batch))
+            fs_items = self.execute(CREATE_FOLDERS_OPERATION, parentId=parent_id, folders=json.dumps(batch))
+            if len(fs_items) != len(batch):
+                raise ValueError("%d folders created instead of %d" % (len(fs_items), len(batch)))
+            created = [self.file_to_info(fs_item) for fs_item in fs_items]
+            infos.extend(created)
+            yield created
+
     def make_file(self, parent_id, name, content):
         """Create a document with the given name and content
 
@@ -146,10 +203,10 @@ class RemoteFileSystemClient(BaseAutomationClient):
         finally:
             os.remove(file_path)
 
-    def stream_file(self, parent_id, file_path, filename=None, mime_type=None):
+    def stream_file(self, parent_id, file_path, filename=None, mime_type=None, digester=None):
         """Create a document by streaming the file with the given path"""
         fs_item = self.execute_with_blob_streaming("NuxeoDrive.CreateFile",
-            file_path, filename=filename, mime_type=mime_type,
+            file_path, filename=filename, mime_type=mime_type, digester=digester,
             parentId=parent_id)
         return self.file_to_info(fs_item)
 
@@ -171,10 +228,10 @@ class RemoteFileSystemClient(BaseAutomationClient):
             os.remove(file_path)
 
     def stream_update(self, fs_item_id, file_path, parent_fs_item_id=None,
-                      filename=None):
+                      filename=None, digester=None):
         """Update a document by streaming the file with the given path"""
         fs_item = self.execute_with_blob_streaming('NuxeoDrive.UpdateFile',
-            file_path, filename=filename, id=fs_item_id,
+            file_path, filename=filename, digester=digester, id=fs_item_id,
             parentId=parent_fs_item_id)
         return self.file_to_info(fs_item)
 
@@ -218,6 +275,7 @@ class RemoteFileSystemClient(BaseAutomationClient):
             digest_algorithm = None
             download_url = None
             can_update = False
+            size = None
             can_create_child = fs_item['canCreateChild']
             # Scroll API availability
             can_scroll = fs_item.get('canScrollDescendants')
@@ -234,6 +292,7 @@ class RemoteFileSystemClient(BaseAutomationClient):
                 digest_algorithm = None
             download_url = fs_item['downloadURL']
             can_update = fs_item['canUpdate']
+            size = fs_item.get('size')
             can_create_child = False
             can_scroll_descendants = False
 
@@ -256,7 +315,14 @@ class RemoteFileSystemClient(BaseAutomationClient):
             name, fs_item['id'], fs_item['parentId'],
             fs_item['path'], folderish, last_update, last_contributor, digest, digest_algorithm,
             download_url, fs_item['canRename'], fs_item['canDelete'],
-            can_update, can_create_child, lock_owner, lock_created, can_scroll_descendants)
+            can_update, can_create_child, lock_owner, lock_created, can_scroll_descendants, size)
+
+    def _change_to_info(self, change):
+        # Convert the file system item of a change as soon as it is decoded
+        fs_item = change.get('fileSystemItem')
+        if fs_item is not None:
+            change['fileSystemItem'] = self.file_to_info(fs_item)
+        return change
 
     #
     # API specific to the remote file system client
@@ -271,11 +337,14 @@ class RemoteFileSystemClient(BaseAutomationClient):
 
     def get_changes(self, last_root_definitions,
                         log_id=None, last_sync_date=None):
+        """Return the change summary, the fileSystemItem of each change being a RemoteFileInfo"""
         if log_id:
             # If available, use last event log id as 'lowerBound' parameter
             # according to the new implementation of the audit change finder,
             # see https://jira.nuxeo.com/browse/NXP-14826.
             return self.execute('NuxeoDrive.GetChangeSummary',
+                                items_key='fileSystemChanges',
+                                item_converter=self._change_to_info,
                                 lowerBound=log_id,
                                 lastSyncActiveRootDefinitions=(
                                         last_root_definitions))
@@ -283,6 +352,8 @@ class RemoteFileSystemClient(BaseAutomationClient):
             # Use last sync date as 'lastSyncDate' parameter according to the
             # old implementation of the audit change finder.
             return self.execute('NuxeoDrive.GetChangeSummary',
+                                items_key='fileSystemChanges',
+                                item_converter=self._change_to_info,
                                 lastSyncDate=last_sync_date,
                                 lastSyncActiveRootDefinitions=(
                                                 last_root_definitions))
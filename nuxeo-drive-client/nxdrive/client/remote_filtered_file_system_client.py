@@ -20,7 +20,8 @@ class RemoteFilteredFileSystemClient(RemoteFileSystemClient):
                  password=None, token=None, repository=DEFAULT_REPOSITORY_NAME,
                  ignored_prefixes=None, ignored_suffixes=None,
                  timeout=20, blob_timeout=None, cookie_jar=None,
-                 upload_tmp_dir=None, check_suspended=None):
+                 upload_tmp_dir=None, check_suspended=None,
+                 connection_pool=None, upload_store=None):
         '''
         Constructor
         '''
@@ -29,7 +30,7 @@ class RemoteFilteredFileSystemClient(RemoteFileSystemClient):
             client_version, proxies, proxy_exceptions,
             password, token, repository, ignored_prefixes,
             ignored_suffixes, timeout, blob_timeout, cookie_jar,
-            upload_tmp_dir, check_suspended)
+            upload_tmp_dir, check_suspended, connection_pool, upload_store)
         self._dao = dao
 
     def is_filtered(self, path):
@@ -6,7 +6,7 @@ from nxdrive.engine.workers import Worker, ThreadInterrupt
 from nxdrive.engine.blacklist_queue import BlacklistQueue
 from nxdrive.engine.watcher.local_watcher import DriveFSEventHandler, normalize_event_filename
 from nxdrive.engine.activity import Action
-from nxdrive.client.local_client import LocalClient
+from nxdrive.client.local_client import LocalClient, DigestCache
 from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_PREFIX
 from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_SUFFIX
 from nxdrive.client.common import safe_filename, NotFound
@@ -15,7 +15,6 @@ from nxdrive.osi import parse_protocol_url
 import os
 import sys
 import urllib2
-from time import sleep
 import shutil
 from PyQt4.QtCore import pyqtSignal, pyqtSlot
 from Queue import Queue, Empty
@@ -53,7 +52,8 @@ class DirectEdit(Worker):
         if type(folder) == str:
             folder = unicode(folder)
         self._folder = folder
-        self._local_client = LocalClient(self._folder)
+        # Not bound to an engine database, only keep the digests in memory
+        self._local_client = LocalClient(self._folder, digest_cache=DigestCache())
         self._upload_queue = Queue()
         self._lock_queue = Queue()
         self._error_queue = BlacklistQueue()
@@ -73,10 +73,12 @@ class DirectEdit(Worker):
     def autolock_lock(self, src_path):
         ref = self._local_client.get_path(src_path)
         self._lock_queue.put((ref, 'lock'))
+        self.wake_up()
 
     def autolock_unlock(self, src_path):
         ref = self._local_client.get_path(src_path)
         self._lock_queue.put((ref, 'unlock'))
+        self.wake_up()
 
     def start(self):
         self._stop = False
@@ -189,7 +191,7 @@ class DirectEdit(Worker):
             local_client = engine.get_local_client()
             existing_file_path = local_client._abspath(pair.local_path)
             log.debug('Local file matches remote digest %r, copying it from %r', info.digest, existing_file_path)
-            shutil.copy(existing_file_path, file_out)
+            engine.get_file_copier().copy(existing_file_path, file_out)
             if pair.is_readonly():
                 log.debug('Unsetting readonly flag on copied file %r', file_out)
                 from nxdrive.client.common import BaseClient
@@ -314,6 +316,7 @@ class DirectEdit(Worker):
         dir_path = os.path.dirname(ref)
         self._local_client.set_remote_id(dir_path, unicode(digest), "nxdirecteditdigest")
         self._upload_queue.put(ref)
+        self.wake_up()
 
     def _handle_queues(self):
         uploaded = False
@@ -411,14 +414,17 @@ class DirectEdit(Worker):
             self.handle_url()
             while (1):
                 self._interact()
+                while (not self._watchdog_queue.empty()):
+                    evt = self._watchdog_queue.get()
+                    self.handle_watchdog_event(evt)
                 try:
                     self._handle_queues()
                 except NotFound:
                     pass
-                while (not self._watchdog_queue.empty()):
-                    evt = self._watchdog_queue.get()
-                    self.handle_watchdog_event(evt)
-                sleep(0.01)
+                if (self._watchdog_queue.empty() and self._lock_queue.empty()
+                        and self._upload_queue.empty()):
+                    # Errors are retried later, check them every second
+                    self._wait(None if self._error_queue.empty() else 1)
         except ThreadInterrupt:
             raise
         finally:
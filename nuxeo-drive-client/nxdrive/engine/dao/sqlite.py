@@ -1,13 +1,38 @@
 import sqlite3
 import os
+import re
 import inspect
+import keyword
+from collections import OrderedDict
 from threading import Lock, local, current_thread
 from datetime import datetime
+from time import sleep, time
 from nxdrive.logging_config import get_logger
+from nxdrive.utils import get_remote_ref_suffixes
 from PyQt4.QtCore import pyqtSignal, QObject
 log = get_logger(__name__)
 
 SCHEMA_VERSION = "schema_version"
+# Column names which can be used as row attributes
+ROW_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+# Number of pages kept in memory by each connection
+CACHE_SIZE = 10000
+
+# Columns of States used in WHERE clauses of the hot queries
+STATE_INDEXES = ['local_path', 'local_parent_path', 'remote_ref', 'remote_parent_ref', 'remote_parent_path',
+                 'pair_state', 'remote_digest', 'processor']
+
+# Error count separating the syncing pairs from the ones in error in the StateCounters
+COUNTERS_ERROR_THRESHOLD = 3
+
+# Number of values bound in a single IN clause, SQLite allows 999 parameters by query
+BATCH_QUERY_SIZE = 500
+
+# Seconds between two updates of the last access of a cached digest, only used to choose the evicted ones
+DIGEST_CACHE_ACCESS_PRECISION = 24 * 3600
+
+# Seconds after which the uploaded chunks of an abandoned upload are forgotten
+UPLOAD_CHUNKS_MAX_AGE = 24 * 3600
 
 # Summary status from last known pair of states
 
@@ -60,40 +85,123 @@ class AutoRetryCursor(sqlite3.Cursor):
                 log.trace('Retry locked database #%d', count)
                 if count > 5:
                     raise e
+                # Exponential backoff: 10ms, 20ms, 40ms...
+                sleep(0.01 * (2 ** (count - 1)))
         return obj
 
 
-class AutoRetryConnection(sqlite3.Connection):
-    def cursor(self):
-        return super(AutoRetryConnection, self).cursor(AutoRetryCursor)
-
+class QueryPlanCursor(AutoRetryCursor):
+    """Cursor keeping the query plan of the statements it executes, for the query plan self-check"""
+    def execute(self, sql, *args, **kwargs):
+        if sql.lstrip()[:6].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+            plan = super(QueryPlanCursor, self).execute("EXPLAIN QUERY PLAN " + sql, *args, **kwargs).fetchall()
+            self.connection.query_plans.append((sql, [row[-1] for row in plan]))
+        return super(QueryPlanCursor, self).execute(sql, *args, **kwargs)
 
-class CustomRow(sqlite3.Row):
 
-    def __init__(self, arg1, arg2):
-        super(CustomRow, self).__init__(arg1, arg2)
-        self._custom = dict()
+class AutoRetryConnection(sqlite3.Connection):
+    # Receive the query plans of the executed statements when not None
+    query_plans = None
 
-    def __getattr__(self, name):
-        if name in self._custom:
-            return self._custom[name]
-        return self[name]
+    def cursor(self):
+        if self.query_plans is not None:
+            return super(AutoRetryConnection, self).cursor(QueryPlanCursor)
+        return super(AutoRetryConnection, self).cursor(AutoRetryCursor)
 
-    def __setattr__(self, name, value):
-        if name.startswith('_'):
-            super(CustomRow, self).__setattr__(name,value)
-        else:
-            self._custom[name] = value
 
-    def __delattr__(self, name):
-        if name.startswith('_'):
-            super(CustomRow, self).__detattr__(name)
-        else:
-            del self._custom[name]
+class CustomRow(object):
+    """Row with its values stored in slots
+
+    The row factory generates a subclass by list of columns, with a slot for
+    each column, so accessing a column is a plain attribute lookup instead of a
+    search by name in the sqlite3.Row. Attributes which are not columns can
+    still be set on the row.
+    """
+    __slots__ = ('__dict__',)
+    _columns = ()
+    _slots = ()
+    _indexes = dict()
+    # (row class, cursor description) -> generated row class
+    _row_classes = dict()
+    # Generated row class of the last cursor, to avoid hashing its description for every row
+    _last_row_class = (None, None, None)
+
+    def __new__(cls, cursor, values):
+        description = cursor.description
+        last_class, last_description, row_class = cls._last_row_class
+        if last_class is not cls or description is not last_description:
+            row_class = cls._row_classes.get((cls, description))
+            if row_class is None:
+                row_class = cls._create_row_class(description)
+            cls._last_row_class = (cls, description, row_class)
+        row = object.__new__(row_class)
+        row_class._fill(row, values)
+        return row
+
+    @classmethod
+    def _create_row_class(cls, description):
+        columns = tuple([column[0] for column in description])
+        slots = []
+        indexes = dict()
+        for i, name in enumerate(columns):
+            if (not ROW_IDENTIFIER.match(name) or keyword.iskeyword(name) or name.startswith('__')
+                    or name in indexes or hasattr(cls, name)):
+                # Expressions or duplicates are only available by index
+                slot = '_column_%d' % i
+            else:
+                slot = name
+            slots.append(slot)
+            indexes.setdefault(name, slot)
+        row_class = type(cls.__name__, (cls,), {'__slots__': tuple(slots), '_columns': columns,
+                                                '_slots': tuple(slots), '_indexes': indexes})
+        # Unpack the values to the slots in one statement
+        scope = dict()
+        exec "def fill(row, values):\n    %s, = values\n" % ", ".join(["row." + slot for slot in slots]) in scope
+        row_class._fill = staticmethod(scope['fill'])
+        cls._row_classes[(cls, description)] = row_class
+        return row_class
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            if key not in self._indexes:
+                raise IndexError("No item with that key")
+            return getattr(self, self._indexes[key])
+        if isinstance(key, slice):
+            return tuple([getattr(self, slot) for slot in self._slots[key]])
+        return getattr(self, self._slots[key])
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __iter__(self):
+        return (getattr(self, slot) for slot in self._slots)
+
+    def __eq__(self, other):
+        return (isinstance(other, CustomRow) and self._columns == other._columns
+                and tuple(self) == tuple(other))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self._columns, tuple(self)))
+
+    def keys(self):
+        return list(self._columns)
+
+    def __copy__(self):
+        row = object.__new__(self.__class__)
+        self._fill(row, tuple(self))
+        row.__dict__.update(self.__dict__)
+        return row
+
+    def __deepcopy__(self, memo):
+        # The column values are immutable
+        return self.__copy__()
 
 
 class StateRow(CustomRow):
-    _custom = None
+    __slots__ = ()
 
     def is_readonly(self):
         if self.folderish:
@@ -131,6 +239,26 @@ class LogLock(object):
         self._lock.release()
 
 
+class TransactionLock(object):
+    """Lock of the writes, the threads outside of the current transaction wait for its end
+
+    They would otherwise write in the shared connection without committing, so their
+    next reads from their own connection would not see their writes"""
+    def __init__(self, dao):
+        self._dao = dao
+        self._lock = Lock()
+
+    def acquire(self):
+        if self._dao.in_tx != current_thread().ident:
+            self._dao._tx_lock.acquire()
+        self._lock.acquire()
+
+    def release(self):
+        self._lock.release()
+        if self._dao.in_tx != current_thread().ident:
+            self._dao._tx_lock.release()
+
+
 class FakeLock(object):
     def acquire(self):
         pass
@@ -154,13 +282,14 @@ class ConfigurationDAO(QObject):
         migrate = os.path.exists(self._db)
         # For testing purpose only should always be True
         self.share_connection = True
-        self.auto_commit = True
         self.schema_version = self.get_schema_version()
         self.in_tx = None
         self._tx_lock = Lock()
+        self._wal = False
+        self._query_plans = None
         # If we dont share connection no need to lock
         if self.share_connection:
-            self._lock = Lock()
+            self._lock = TransactionLock(self)
         else:
             self._lock = FakeLock()
         # Use to clean
@@ -183,6 +312,11 @@ class ConfigurationDAO(QObject):
         #if log.getEffectiveLevel() < 6:
         #    self._conn.set_trace_callback(self._log_trace)
 
+    @property
+    def auto_commit(self):
+        # Only the thread in transaction does not commit its writes
+        return self.in_tx != current_thread().ident
+
     def get_schema_version(self):
         return 1
 
@@ -217,8 +351,14 @@ class ConfigurationDAO(QObject):
             self.update_config(SCHEMA_VERSION, 1)
 
     def _init_db(self, cursor):
-        # http://www.stevemcarthur.co.uk/blog/post/some-kind-of-disk-io-error-occurred-sqlite
-        cursor.execute("PRAGMA journal_mode = MEMORY")
+        # WAL let the readers work while a write is in progress, fsync is only done on checkpoint
+        # Requires SQLite 3.7.0, the previous mode is returned if not available
+        mode = cursor.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        self._wal = mode is not None and mode.lower() == 'wal'
+        if not self._wal:
+            log.debug("WAL journal mode not available, fallback to MEMORY")
+            # http://www.stevemcarthur.co.uk/blog/post/some-kind-of-disk-io-error-occurred-sqlite
+            cursor.execute("PRAGMA journal_mode = MEMORY")
         self._create_configuration_table(cursor)
 
     def _create_configuration_table(self, cursor):
@@ -227,9 +367,30 @@ class ConfigurationDAO(QObject):
     def _create_main_conn(self):
         log.debug("Create main connexion on %s (dir exists: %d / file exists: %d)",
                     self._db, os.path.exists(os.path.dirname(self._db)), os.path.exists(self._db))
-        self._conn = AutoRetryConnection(self._db, check_same_thread=False)
+        self._conn = self._create_connection()
         self._connections.append(self._conn)
 
+    def _create_connection(self):
+        # Dont check same thread for closing purpose
+        con = AutoRetryConnection(self._db, check_same_thread=False)
+        # Durable enough with WAL as a commit is only lost on power failure
+        con.execute("PRAGMA synchronous = NORMAL")
+        con.execute("PRAGMA cache_size = " + str(CACHE_SIZE))
+        con.query_plans = self._query_plans
+        return con
+
+    def set_query_plan_check(self, enabled):
+        """Keep the query plans of the statements executed from now on, returned by get_query_plans"""
+        self._query_plans = [] if enabled else None
+        for con in self._connections:
+            con.query_plans = self._query_plans
+
+    def get_query_plans(self):
+        """Return the (statement, plan details) executed since the query plan check is enabled"""
+        if self._query_plans is None:
+            return []
+        return list(self._query_plans)
+
     def _log_trace(self, query):
         log.trace(query)
 
@@ -258,17 +419,18 @@ class ConfigurationDAO(QObject):
     def _get_read_connection(self, factory=CustomRow):
         # If in transaction
         if self.in_tx is not None:
-            if current_thread().ident != self.in_tx:
+            if current_thread().ident == self.in_tx:
+                # Return the write connection
+                self._conn.row_factory = factory
+                return self._conn
+            elif not self._wal:
+                # With WAL the readers see the last commit so no need to wait
                 log.trace("In transaction wait for read connection")
                 # Wait for the thread in transaction to finished
                 self._tx_lock.acquire()
                 self._tx_lock.release()
-            else:
-                # Return the write connection
-                return self._conn
         if not hasattr(self._conns, '_conn') or self._conns._conn is None:
-            # Dont check same thread for closing purpose
-            self._conns._conn = AutoRetryConnection(self._db, check_same_thread=False)
+            self._conns._conn = self._create_connection()
             self._connections.append(self._conns._conn)
         self._conns._conn.row_factory = factory
             # Python3.3 feature
@@ -277,17 +439,28 @@ class ConfigurationDAO(QObject):
         return self._conns._conn
 
     def begin_transaction(self):
-        self.auto_commit = False
         self._tx_lock.acquire()
         self.in_tx = current_thread().ident
 
     def end_transaction(self):
-        self.auto_commit = True
+        try:
+            self._commit_transaction()
+        finally:
+            self.in_tx = None
+            self._tx_lock.release()
+
+    def _commit_transaction(self):
         self._lock.acquire()
-        self._get_write_connection().commit()
-        self._lock.release()
-        self._tx_lock.release()
-        self.in_tx = None
+        try:
+            con = self._get_write_connection()
+            try:
+                con.commit()
+            except:
+                # Dont leave the writes of the failed transaction to the next one
+                con.rollback()
+                raise
+        finally:
+            self._lock.release()
 
     def commit(self):
         if self.auto_commit:
@@ -493,6 +666,9 @@ class EngineDAO(ConfigurationDAO):
         '''
         self._filters = None
         self._queue_manager = None
+        # Pairs to queue and folders to release once the current transaction is committed
+        self._tx_queue = OrderedDict()
+        self._tx_released = []
         super(EngineDAO, self).__init__(db)
         self._filters = self.get_filters()
         self._items_count = None
@@ -500,11 +676,14 @@ class EngineDAO(ConfigurationDAO):
         self.reinit_processors()
 
     def get_schema_version(self):
-        return 3
+        return 8
 
     def _migrate_state(self, cursor):
         try:
             self._migrate_table(cursor, 'States')
+            # Indexes and triggers are dropped with the migration table
+            self._create_state_indexes(cursor)
+            self._create_state_counters(cursor, rebuild=True)
         except sqlite3.IntegrityError:
             # If we cannot smoothly migrate harder migration
             cursor.execute("DROP TABLE if exists StatesMigration")
@@ -522,6 +701,22 @@ class EngineDAO(ConfigurationDAO):
         if (version < 3):
             self._migrate_state(cursor)
             self.update_config(SCHEMA_VERSION, 3)
+        if (version < 4):
+            self._create_state_indexes(cursor)
+            self.update_config(SCHEMA_VERSION, 4)
+        if (version < 5):
+            self._create_digest_cache_table(cursor)
+            self.update_config(SCHEMA_VERSION, 5)
+        if (version < 6):
+            self._create_state_counters(cursor)
+            self.update_config(SCHEMA_VERSION, 6)
+        if (version < 7):
+            self._create_upload_chunks_table(cursor)
+            self.update_config(SCHEMA_VERSION, 7)
+        if (version < 8):
+            # Index of the remote subtree queries
+            self._create_state_indexes(cursor)
+            self.update_config(SCHEMA_VERSION, 8)
 
     def _reinit_database(self):
         self.reinit_states()
@@ -547,12 +742,97 @@ class EngineDAO(ConfigurationDAO):
           + "last_sync_date TIMESTAMP, error_count INTEGER DEFAULT (0), last_sync_error_date TIMESTAMP, last_error VARCHAR, last_error_details TEXT, version INTEGER DEFAULT (0), processor INTEGER DEFAULT (0), last_transfer VARCHAR, PRIMARY KEY (id),"
           +  "UNIQUE(remote_ref, remote_parent_ref), UNIQUE(remote_ref, local_path));")
 
+    def _create_state_indexes(self, cursor):
+        # Not created with the table as _migrate_table keep the indexes on the renamed table
+        for column in STATE_INDEXES:
+            cursor.execute("CREATE INDEX if not exists ix_states_" + column + " ON States(" + column + ")")
+
+    def _create_digest_cache_table(self, cursor):
+        # Device and inode are stored as strings as they can overflow SQLite integers
+        cursor.execute("CREATE TABLE if not exists DigestCache(device VARCHAR NOT NULL, inode VARCHAR NOT NULL,"
+                       + " size INTEGER NOT NULL, mtime INTEGER NOT NULL, algorithm VARCHAR NOT NULL,"
+                       + " digest VARCHAR NOT NULL, last_access INTEGER,"
+                       + " PRIMARY KEY (device, inode, size, mtime, algorithm))")
+        cursor.execute("CREATE INDEX if not exists ix_digestcache_last_access ON DigestCache(last_access)")
+
+    def _create_upload_chunks_table(self, cursor):
+        # Chunks already uploaded in a server batch, by content digest, to resume the interrupted uploads
+        cursor.execute("CREATE TABLE if not exists UploadChunks(digest VARCHAR NOT NULL, chunk_size INTEGER NOT NULL,"
+                       + " batch_id VARCHAR NOT NULL, chunk_index INTEGER NOT NULL, upload_date INTEGER,"
+                       + " PRIMARY KEY (digest, chunk_size, chunk_index))")
+
+    def _get_state_counter_key(self, prefix=''):
+        error_bucket = ("CASE WHEN {0}error_count IS NULL THEN -1 WHEN {0}error_count < {1} THEN 0"
+                        + " WHEN {0}error_count = {1} THEN 1 ELSE 2 END").format(prefix, COUNTERS_ERROR_THRESHOLD)
+        return ("COALESCE(%spair_state, '')" % prefix, "COALESCE(%sfolderish, -1)" % prefix, error_bucket)
+
+    def _create_state_counters(self, cursor, rebuild=False):
+        # Counts and sizes of the States by pair_state, folderish and error bucket, kept up to date
+        # in the same transaction by the triggers so the metrics don't have to scan the States
+        exists = cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='StateCounters'").fetchone()
+        cursor.execute("CREATE TABLE if not exists StateCounters(pair_state VARCHAR NOT NULL,"
+                       + " folderish INTEGER NOT NULL, error_bucket INTEGER NOT NULL,"
+                       + " count INTEGER NOT NULL DEFAULT (0), size INTEGER NOT NULL DEFAULT (0),"
+                       + " PRIMARY KEY (pair_state, folderish, error_bucket))")
+        new_key = "(%s, %s, %s)" % self._get_state_counter_key("NEW.")
+        new_condition = "pair_state=%s AND folderish=%s AND error_bucket=%s" % self._get_state_counter_key("NEW.")
+        old_condition = "pair_state=%s AND folderish=%s AND error_bucket=%s" % self._get_state_counter_key("OLD.")
+        increment = ("INSERT OR IGNORE INTO StateCounters(pair_state, folderish, error_bucket) VALUES " + new_key + ";"
+                     + " UPDATE StateCounters SET count=count+1, size=size+COALESCE(NEW.size, 0) WHERE "
+                     + new_condition + ";")
+        decrement = ("UPDATE StateCounters SET count=count-1, size=size-COALESCE(OLD.size, 0) WHERE "
+                     + old_condition + ";")
+        cursor.execute("CREATE TRIGGER if not exists StateCountersInsert AFTER INSERT ON States"
+                       + " BEGIN " + increment + " END")
+        cursor.execute("CREATE TRIGGER if not exists StateCountersDelete AFTER DELETE ON States"
+                       + " BEGIN " + decrement + " END")
+        cursor.execute("CREATE TRIGGER if not exists StateCountersUpdate"
+                       + " AFTER UPDATE OF pair_state, folderish, error_count, size ON States"
+                       + " WHEN OLD.pair_state IS NOT NEW.pair_state OR OLD.folderish IS NOT NEW.folderish"
+                       + " OR OLD.error_count IS NOT NEW.error_count OR OLD.size IS NOT NEW.size"
+                       + " BEGIN " + decrement + " " + increment + " END")
+        if rebuild or exists is None:
+            self._rebuild_state_counters(cursor)
+
+    def _rebuild_state_counters(self, cursor):
+        cursor.execute("DELETE FROM StateCounters")
+        cursor.execute("INSERT INTO StateCounters(pair_state, folderish, error_bucket, count, size)"
+                       + " SELECT %s, %s, %s, COUNT(*), COALESCE(SUM(size), 0) FROM States" % self._get_state_counter_key()
+                       + " GROUP BY 1, 2, 3")
+
+    def _get_state_counters(self, cursor, query):
+        return dict([((row[0], row[1], row[2]), (row[3], row[4])) for row in cursor.execute(query).fetchall()])
+
+    def check_state_counters(self):
+        """Reconcile the StateCounters with the States, return False if they were not consistent"""
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            expected = self._get_state_counters(c, "SELECT %s, %s, %s, COUNT(*), COALESCE(SUM(size), 0) FROM States"
+                                                % self._get_state_counter_key() + " GROUP BY 1, 2, 3")
+            actual = self._get_state_counters(c, "SELECT pair_state, folderish, error_bucket, count, size"
+                                              + " FROM StateCounters WHERE count != 0 OR size != 0")
+            consistent = expected == actual
+            if not consistent:
+                log.warn("State counters are not consistent, rebuild them: %r instead of %r", actual, expected)
+                self._rebuild_state_counters(c)
+                if self.auto_commit:
+                    con.commit()
+        finally:
+            self._lock.release()
+        return consistent
+
     def _init_db(self, cursor):
         super(EngineDAO, self)._init_db(cursor)
         cursor.execute("CREATE TABLE if not exists Filters(path STRING NOT NULL, PRIMARY KEY(path))")
         cursor.execute("CREATE TABLE if not exists RemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
         cursor.execute("CREATE TABLE if not exists ToRemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
         self._create_state_table(cursor)
+        self._create_state_indexes(cursor)
+        self._create_digest_cache_table(cursor)
+        self._create_state_counters(cursor)
+        self._create_upload_chunks_table(cursor)
 
     def _get_read_connection(self, factory=StateRow):
         return super(EngineDAO, self)._get_read_connection(factory)
@@ -609,6 +889,8 @@ class EngineDAO(ConfigurationDAO):
     def _reinit_states(self, cursor):
         cursor.execute("DROP TABLE States")
         self._create_state_table(cursor, force=True)
+        self._create_state_indexes(cursor)
+        self._create_state_counters(cursor, rebuild=True)
         self._delete_config(cursor, "remote_last_sync_date")
         self._delete_config(cursor, "remote_last_event_log_id")
         self._delete_config(cursor, "remote_last_event_last_root_definitions")
@@ -653,7 +935,7 @@ class EngineDAO(ConfigurationDAO):
             if doc_pair.folderish:
                 c.execute(update + self._get_recursive_condition(doc_pair), ('parent_remotely_deleted',))
             # Only queue parent
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted')
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted', pair=doc_pair)
             if self.auto_commit:
                 con.commit()
         finally:
@@ -682,11 +964,12 @@ class EngineDAO(ConfigurationDAO):
             self._queue_manager.interrupt_processors_on(doc_pair.local_path, exact_match=False)
             # Only queue parent
             if current_state is not None and current_state == "locally_deleted":
-                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state)
+                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state, pair=doc_pair)
 
-    def insert_local_state(self, info, parent_path):
+    def insert_local_state(self, info, parent_path, compute_digest=True):
         pair_state = PAIR_STATES.get(('created', 'unknown'))
-        digest = info.get_digest()
+        # Without compute_digest the caller is responsible for setting it later with update_local_digest
+        digest = info.get_digest() if compute_digest else None
         self._lock.acquire()
         try:
             con = self._get_write_connection()
@@ -698,9 +981,9 @@ class EngineDAO(ConfigurationDAO):
                                                     parent_path, name, info.folderish, info.size, pair_state))
             row_id = c.lastrowid
             parent = c.execute("SELECT * FROM States WHERE local_path=?", (parent_path,)).fetchone()
-            # Dont queue if parent is not yet created
-            if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
+            # Wait for the parent if it is not yet created
+            self._queue_pair_state(row_id, info.folderish, pair_state, size=info.size, local_parent_path=parent_path,
+                                   depends_on=self._get_parent_dependency(parent, parent_path, "locally_created"))
             if self.auto_commit:
                 con.commit()
             self._items_count = self._items_count + 1
@@ -708,6 +991,116 @@ class EngineDAO(ConfigurationDAO):
             self._lock.release()
         return row_id
 
+    def update_local_digest(self, row_id, digest):
+        # Only set a pending digest, the pair may have been updated in the meantime
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("UPDATE States SET local_digest=? WHERE id=? AND local_digest IS NULL", (digest, row_id))
+            if self.auto_commit:
+                con.commit()
+            return c.rowcount == 1
+        finally:
+            self._lock.release()
+
+    def _get_digest_cache_params(self, key):
+        device, inode, size, mtime, algorithm = key
+        return (str(device), str(inode), size, mtime, algorithm)
+
+    def get_digest_cache(self, key):
+        params = self._get_digest_cache_params(key)
+        c = self._get_read_connection().cursor()
+        row = c.execute("SELECT digest, last_access FROM DigestCache WHERE device=? AND inode=? AND size=? AND mtime=?"
+                        + " AND algorithm=?", params).fetchone()
+        if row is None:
+            return None
+        now = int(time())
+        if row.last_access is not None and now - row.last_access < DIGEST_CACHE_ACCESS_PRECISION:
+            # Recent enough to not be evicted, dont write on each hit
+            return row.digest
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("UPDATE DigestCache SET last_access=? WHERE device=? AND inode=? AND size=? AND mtime=?"
+                      + " AND algorithm=?", (now,) + params)
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+        return row.digest
+
+    def set_digest_cache(self, key, digest):
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("INSERT OR REPLACE INTO DigestCache(device, inode, size, mtime, algorithm, digest, last_access)"
+                      + " VALUES(?,?,?,?,?,?,?)", self._get_digest_cache_params(key) + (digest, int(time())))
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
+    def evict_digest_cache(self, size):
+        # Keep only the most recently used digests
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("DELETE FROM DigestCache WHERE rowid IN (SELECT rowid FROM DigestCache"
+                      + " ORDER BY last_access DESC LIMIT -1 OFFSET ?)", (size,))
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
+    def get_upload_chunks(self, digest, chunk_size):
+        """Return the batch id and the indexes of the uploaded chunks of the content, or None and an empty set"""
+        c = self._get_read_connection().cursor()
+        rows = c.execute("SELECT batch_id, chunk_index FROM UploadChunks WHERE digest=? AND chunk_size=?",
+                         (digest, chunk_size)).fetchall()
+        if not rows:
+            return None, set()
+        return rows[0].batch_id, set([row.chunk_index for row in rows])
+
+    def add_upload_chunk(self, digest, chunk_size, batch_id, chunk_index):
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("INSERT OR REPLACE INTO UploadChunks(digest, chunk_size, batch_id, chunk_index, upload_date)"
+                      + " VALUES(?,?,?,?,?)", (digest, chunk_size, batch_id, chunk_index, int(time())))
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
+    def remove_upload_chunks(self, digest):
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("DELETE FROM UploadChunks WHERE digest=?", (digest,))
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
+    def clean_upload_chunks(self, max_age=UPLOAD_CHUNKS_MAX_AGE):
+        # The server drops the batches of the abandoned uploads anyway
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            c.execute("DELETE FROM UploadChunks WHERE digest IN (SELECT digest FROM UploadChunks"
+                      + " GROUP BY digest HAVING MAX(upload_date) < ?)", (int(time()) - max_age,))
+            if self.auto_commit:
+                con.commit()
+        finally:
+            self._lock.release()
+
     def get_last_files(self, number, direction=""):
         c = self._get_read_connection(factory=StateRow).cursor()
         condition = ""
@@ -730,19 +1123,95 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             # Order by path to be sure to process parents before childs
             pairs = c.execute("SELECT * FROM States WHERE " + self._get_to_sync_condition() + " ORDER BY local_path ASC").fetchall()
+            # Folders to synchronize by path, their children wait for them
             folders = dict()
             for pair in pairs:
                 # Add all the folders
                 if pair.folderish:
-                    folders[pair.local_path] = True
-                if not pair.local_parent_path in folders:
-                    self._queue_manager.push_ref(pair.id, pair.folderish, pair.pair_state)
+                    folders[pair.local_path] = pair.id
+                self._queue_manager.push_ref(pair.id, pair.folderish, pair.pair_state, size=pair.size,
+                                             local_parent_path=pair.local_parent_path,
+                                             depends_on=folders.get(pair.local_parent_path))
         # Dont block everything if queue manager fail
         # TODO As the error should be fatal not sure we need this
         finally:
             self._lock.release()
 
-    def _queue_pair_state(self, row_id, folderish, pair_state, pair=None):
+    def _commit_transaction(self):
+        # Still in the transaction, so no other transaction can queue its pairs meanwhile
+        queue = self._tx_queue
+        released = self._tx_released
+        try:
+            super(EngineDAO, self)._commit_transaction()
+            if not queue and not released:
+                return
+            # Now that the rows are visible to the processors, queue them
+            self._lock.acquire()
+            try:
+                c = self._get_write_connection().cursor()
+                for row_id, (folderish, pair_state, pair, size, local_parent_path, depends_on) in queue.iteritems():
+                    # The parent can have been synchronized since
+                    if depends_on is not None and not self._is_pending_parent(c, depends_on):
+                        depends_on = None
+                    self._push_pair_state(row_id, folderish, pair_state, pair=pair, size=size,
+                                          local_parent_path=local_parent_path, depends_on=depends_on)
+                for row in released:
+                    self._queue_manager.release_children(row)
+            finally:
+                self._lock.release()
+        finally:
+            self._tx_queue = OrderedDict()
+            self._tx_released = []
+
+    def _get_parent_dependency(self, parent, parent_path, creation_state):
+        """Return what the pair waits for before being processed: the id of its parent in creation,
+        or the parent path if the parent has no row yet, None if the pair can be processed"""
+        if parent is None:
+            # At the root or below a filtered folder without parent_path
+            return parent_path if parent_path else None
+        if parent.pair_state == creation_state:
+            return parent.id
+        return None
+
+    def _is_pending_parent(self, c, depends_on):
+        if isinstance(depends_on, basestring):
+            parent = c.execute("SELECT pair_state FROM States WHERE local_path=?", (depends_on,)).fetchone()
+            if parent is None:
+                return True
+        else:
+            parent = c.execute("SELECT pair_state FROM States WHERE id=?", (depends_on,)).fetchone()
+            if parent is None:
+                return False
+        return parent.pair_state != 'synchronized' and parent.pair_state != 'unsynchronized'
+
+    def _queue_descendants(self, c, doc_pair):
+        """Queue the descendants of doc_pair, each one waiting for its parent"""
+        folders = {doc_pair.local_path: doc_pair.id}
+        descendants = c.execute("SELECT * FROM States" + self._get_recursive_condition(doc_pair)
+                                + " ORDER BY local_path ASC").fetchall()
+        for row in descendants:
+            if row.folderish:
+                folders[row.local_path] = row.id
+            self._queue_pair_state(row.id, row.folderish, row.pair_state, pair=row,
+                                   depends_on=folders.get(row.local_parent_path, row.local_parent_path))
+
+    def _queue_pair_state(self, row_id, folderish, pair_state, pair=None, size=None, local_parent_path=None,
+                          depends_on=None):
+        # The size and the parent of the pair are used by the scheduling policies
+        if pair is not None:
+            if size is None:
+                size = pair.size
+            if local_parent_path is None:
+                local_parent_path = pair.local_parent_path
+        if self.in_tx is not None and self.in_tx == current_thread().ident:
+            # Keep the first position but the last state of the row
+            self._tx_queue[row_id] = (folderish, pair_state, pair, size, local_parent_path, depends_on)
+            return
+        self._push_pair_state(row_id, folderish, pair_state, pair=pair, size=size,
+                              local_parent_path=local_parent_path, depends_on=depends_on)
+
+    def _push_pair_state(self, row_id, folderish, pair_state, pair=None, size=None, local_parent_path=None,
+                         depends_on=None):
         if (self._queue_manager is not None
              and pair_state != 'synchronized' and pair_state != 'unsynchronized'):
             if pair_state == 'conflicted':
@@ -750,7 +1219,8 @@ class EngineDAO(ConfigurationDAO):
                 self.newConflict.emit(row_id)
             else:
                 log.trace("Push to queue: %s, pair=%r", pair_state, pair)
-                self._queue_manager.push_ref(row_id, folderish, pair_state)
+                self._queue_manager.push_ref(row_id, folderish, pair_state, size=size,
+                                             local_parent_path=local_parent_path, depends_on=depends_on)
         else:
             log.trace("Will not push pair: %s, pair=%r", pair_state, pair)
         return
@@ -789,9 +1259,10 @@ class EngineDAO(ConfigurationDAO):
                                         pair_state, row.id))
             if queue:
                 parent = c.execute("SELECT * FROM States WHERE local_path=?", (parent_path,)).fetchone()
-                # Dont queue if parent is not yet created
-                if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
-                    self._queue_pair_state(row.id, info.folderish, pair_state, pair=row)
+                # Wait for the parent if it is not yet created
+                self._queue_pair_state(row.id, info.folderish, pair_state, pair=row, size=info.size,
+                                       local_parent_path=parent_path,
+                                       depends_on=self._get_parent_dependency(parent, parent_path, "locally_created"))
             if self.auto_commit:
                 con.commit()
         finally:
@@ -806,11 +1277,20 @@ class EngineDAO(ConfigurationDAO):
 
     def get_remote_descendants(self, path):
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_path LIKE ?", (path + '%',)).fetchall()
+        return c.execute("SELECT * FROM States WHERE " + self._get_prefix_condition("remote_parent_path", path)).fetchall()
 
     def get_remote_descendants_from_ref(self, ref):
+        # The folder itself can already have its new path, so use the paths stored on its children
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_path LIKE ?", ('%' + ref + '%',)).fetchall()
+        paths = c.execute("SELECT DISTINCT remote_parent_path FROM States WHERE remote_parent_ref=?", (ref,)).fetchall()
+        descendants = []
+        for path in paths:
+            if path[0] is None:
+                continue
+            descendants.extend(c.execute("SELECT * FROM States WHERE remote_parent_path=? OR " +
+                                         self._get_prefix_condition("remote_parent_path", path[0] + '/'),
+                                         (path[0],)).fetchall())
+        return descendants
 
     def get_remote_children(self, ref):
         c = self._get_read_connection(factory=StateRow).cursor()
@@ -821,17 +1301,23 @@ class EngineDAO(ConfigurationDAO):
         return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_state='created' AND local_state='unknown'", (ref,)).fetchall()
 
     def get_unsynchronized_count(self):
-        return self.get_count("pair_state='unsynchronized'")
+        return self.get_counter("pair_state='unsynchronized'")
 
     def get_conflict_count(self):
-        return self.get_count("pair_state='conflicted'")
+        return self.get_counter("pair_state='conflicted'")
 
-    def get_error_count(self, threshold=3):
-        return self.get_count("error_count > " + str(threshold))
+    def get_error_count(self, threshold=COUNTERS_ERROR_THRESHOLD):
+        if threshold != COUNTERS_ERROR_THRESHOLD:
+            return self.get_count("error_count > " + str(threshold))
+        return self.get_counter("error_bucket=2")
 
-    def get_syncing_count(self, threshold=3):
-        query = "pair_state!='synchronized' AND pair_state!='conflicted' AND pair_state!='unsynchronized' AND error_count < " + str(threshold)
-        count = self.get_count(query)
+    def get_syncing_count(self, threshold=COUNTERS_ERROR_THRESHOLD):
+        query = "pair_state!='synchronized' AND pair_state!='conflicted' AND pair_state!='unsynchronized'"
+        if threshold != COUNTERS_ERROR_THRESHOLD:
+            count = self.get_count(query + " AND error_count < " + str(threshold))
+        else:
+            # The pairs without state are counted as '', they are not syncing
+            count = self.get_counter(query + " AND pair_state!='' AND error_bucket=0")
         if self._items_count is not None and count != self._items_count:
             log.trace("Cache Syncing count incorrect should be %d was %d", count, self._items_count)
             self._items_count = count
@@ -843,7 +1329,7 @@ class EngineDAO(ConfigurationDAO):
             query = query + " AND folderish=0"
         elif filetype == "folder":
             query = query + " AND folderish=1"
-        return self.get_count(query)
+        return self.get_counter(query)
 
     def get_count(self, condition=None):
         query = "SELECT COUNT(*) as count FROM States"
@@ -852,9 +1338,17 @@ class EngineDAO(ConfigurationDAO):
         c = self._get_read_connection(factory=StateRow).cursor()
         return c.execute(query).fetchone().count
 
+    def get_counter(self, condition=None):
+        """Same as get_count from the StateCounters, condition can only use pair_state, folderish and error_bucket"""
+        query = "SELECT SUM(count) as count FROM StateCounters"
+        if condition is not None:
+            query = query + " WHERE " + condition
+        c = self._get_read_connection(factory=StateRow).cursor()
+        return c.execute(query).fetchone().count or 0
+
     def get_global_size(self):
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT SUM(size) as sum FROM States WHERE pair_state='synchronized'").fetchone().sum
+        return c.execute("SELECT SUM(size) as sum FROM StateCounters WHERE pair_state='synchronized' AND count > 0").fetchone().sum
 
     def get_unsynchronizeds(self):
         c = self._get_read_connection(factory=StateRow).cursor()
@@ -872,9 +1366,16 @@ class EngineDAO(ConfigurationDAO):
         c = self._get_read_connection(factory=StateRow).cursor()
         return c.execute("SELECT * FROM States WHERE local_parent_path=?", (path,)).fetchall()
 
+    def get_locally_created_folders(self, doc_pair):
+        """Return the locally created descendant folders of doc_pair, parents first"""
+        c = self._get_read_connection(factory=StateRow).cursor()
+        return c.execute("SELECT * FROM States WHERE folderish=1 AND pair_state='locally_created' AND remote_ref IS NULL"
+                         + " AND (local_parent_path=? OR " + self._get_prefix_condition("local_parent_path", doc_pair.local_path + "/")
+                         + ") ORDER BY local_path ASC", (doc_pair.local_path,)).fetchall()
+
     def get_states_from_partial_local(self, path):
         c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE local_path LIKE ?", (path + '%',)).fetchall()
+        return c.execute("SELECT * FROM States WHERE " + self._get_prefix_condition("local_path", path)).fetchall()
 
     def get_first_state_from_partial_remote(self, ref):
         c = self._get_read_connection(factory=StateRow).cursor()
@@ -899,6 +1400,43 @@ class EngineDAO(ConfigurationDAO):
         c = self._get_read_connection(factory=StateRow).cursor()
         return c.execute("SELECT * FROM States WHERE remote_ref=?", (ref,)).fetchall()
 
+    def get_states_from_remotes(self, refs):
+        """Return the result of get_states_from_remote for each ref in a dict"""
+        result = dict([(ref, []) for ref in refs])
+        refs = result.keys()
+        c = self._get_read_connection(factory=StateRow).cursor()
+        for i in range(0, len(refs), BATCH_QUERY_SIZE):
+            batch = refs[i:i + BATCH_QUERY_SIZE]
+            for state in c.execute("SELECT * FROM States WHERE remote_ref IN (%s)" % ','.join('?' * len(batch)),
+                                   batch):
+                result[state.remote_ref].append(state)
+        return result
+
+    def get_first_states_from_partial_remotes(self, refs):
+        """Return the result of get_first_state_from_partial_remote for each ref in a dict, with one table scan
+
+        Only the remote refs ending with '#' plus the ref or equal to it are matched"""
+        result = dict([(ref, None) for ref in refs])
+        if not result:
+            return result
+        c = self._get_read_connection(factory=StateRow).cursor()
+        # Only read the full rows of the matched states
+        matches = dict()
+        for row_id, remote_ref in c.execute("SELECT id, remote_ref FROM States WHERE remote_ref IS NOT NULL"
+                                            + " ORDER BY last_remote_updated ASC"):
+            for suffix in get_remote_ref_suffixes(remote_ref):
+                if suffix in result and suffix not in matches:
+                    matches[suffix] = row_id
+        ids = list(set(matches.values()))
+        states = dict()
+        for i in range(0, len(ids), BATCH_QUERY_SIZE):
+            batch = ids[i:i + BATCH_QUERY_SIZE]
+            for state in c.execute("SELECT * FROM States WHERE id IN (%s)" % ','.join('?' * len(batch)), batch):
+                states[state.id] = state
+        for suffix, row_id in matches.iteritems():
+            result[suffix] = states.get(row_id)
+        return result
+
     def get_state_from_id(self, row_id, from_write=False):
         # Dont need to read from write as auto_commit is True
         if from_write and self.auto_commit:
@@ -915,8 +1453,19 @@ class EngineDAO(ConfigurationDAO):
                 self._lock.release()
         return state
 
+    def _get_prefix_condition(self, column, prefix):
+        # Same as LIKE 'prefix%' but as a range so SQLite can use the column index
+        if not prefix:
+            return column + " IS NOT NULL"
+        if isinstance(prefix, unicode):
+            upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+        else:
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return ("(" + column + " >= '" + self._escape(prefix) + "' AND " + column + " < '"
+                + self._escape(upper) + "')")
+
     def _get_recursive_condition(self, doc_pair):
-        return (" WHERE local_parent_path LIKE '" + self._escape(doc_pair.local_path) + "/%'"
+        return (" WHERE " + self._get_prefix_condition("local_parent_path", doc_pair.local_path + "/")
                     + " OR local_parent_path = '" + self._escape(doc_pair.local_path) + "'")
 
     def update_remote_parent_path(self, doc_pair, new_path):
@@ -926,11 +1475,10 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             if doc_pair.folderish:
                 remote_path = doc_pair.remote_parent_path + "/" + doc_pair.remote_ref
-                query = "UPDATE States SET remote_parent_path='%s/%s' || substr(remote_parent_path,%d)" % (
-                    self._escape(new_path), self._escape(doc_pair.remote_ref), len(remote_path) + 1)
-                query = query + self._get_recursive_condition(doc_pair)
+                query = ("UPDATE States SET remote_parent_path=? || substr(remote_parent_path,?) WHERE remote_parent_path=?"
+                         + " OR " + self._get_prefix_condition("remote_parent_path", remote_path + "/"))
                 log.trace("Update remote_parent_path: " + query)
-                c.execute(query)
+                c.execute(query, (new_path + "/" + doc_pair.remote_ref, len(remote_path) + 1, remote_path))
             c.execute("UPDATE States SET remote_parent_path=? WHERE id=?", (new_path, doc_pair.id))
             if self.auto_commit:
                 con.commit()
@@ -956,13 +1504,10 @@ class EngineDAO(ConfigurationDAO):
             if doc_pair.folderish:
                 if new_path == '/':
                     new_path = ''
-                escaped_new_path = self._escape(new_path)
-                escaped_new_name = self._escape(new_name)
-                query = ("UPDATE States SET local_parent_path='%s/%s' || substr(local_parent_path,%d), local_path='%s/%s' || substr(local_path,%d)" %
-                         (escaped_new_path, escaped_new_name, len(doc_pair.local_path) + 1,
-                          escaped_new_path, escaped_new_name, len(doc_pair.local_path)+1))
-                query = query + self._get_recursive_condition(doc_pair)
-                c.execute(query)
+                new_local_path = new_path + "/" + new_name
+                query = ("UPDATE States SET local_parent_path=? || substr(local_parent_path,?), local_path=? || substr(local_path,?)"
+                         + self._get_recursive_condition(doc_pair))
+                c.execute(query, (new_local_path, len(doc_pair.local_path) + 1, new_local_path, len(doc_pair.local_path) + 1))
             # Dont need to update the path as it is refresh later
             c.execute("UPDATE States SET local_parent_path=? WHERE id=?", (new_path, doc_pair.id))
             if self.auto_commit:
@@ -981,7 +1526,7 @@ class EngineDAO(ConfigurationDAO):
                 c.execute(update + self._get_recursive_condition(doc_pair))
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, pair=doc_pair)
         finally:
             self._lock.release()
 
@@ -996,7 +1541,10 @@ class EngineDAO(ConfigurationDAO):
                 c.execute(update + self._get_recursive_condition(doc_pair))
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, pair=doc_pair)
+            if doc_pair.folderish:
+                # Created again after their parent
+                self._queue_descendants(c, doc_pair)
         finally:
             self._lock.release()
 
@@ -1011,7 +1559,10 @@ class EngineDAO(ConfigurationDAO):
                 c.execute(update + self._get_recursive_condition(doc_pair))
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
+            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, pair=doc_pair)
+            if doc_pair.folderish:
+                # Created again after their parent
+                self._queue_descendants(c, doc_pair)
         finally:
             self._lock.release()
 
@@ -1027,6 +1578,8 @@ class EngineDAO(ConfigurationDAO):
                 con.commit()
         finally:
             self._lock.release()
+        if doc_pair.folderish and self._queue_manager is not None:
+            self._queue_manager.forget_children(doc_pair)
 
     def get_state_from_local(self, path):
         c = self._get_read_connection(factory=StateRow).cursor()
@@ -1042,37 +1595,25 @@ class EngineDAO(ConfigurationDAO):
                       "remote_parent_path, remote_name, last_remote_updated, remote_can_rename," +
                       "remote_can_delete, remote_can_update, " +
                       "remote_can_create_child, last_remote_modifier, remote_digest," +
-                      "folderish, last_remote_modifier, local_path, local_parent_path, remote_state, local_state, pair_state, local_name)" +
-                      " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,'created','unknown',?, ?)",
+                      "folderish, last_remote_modifier, local_path, local_parent_path, remote_state, local_state, pair_state, local_name, size)" +
+                      " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,'created','unknown',?,?,?)",
                       (info.uid, info.parent_uid, remote_parent_path, info.name,
                        info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
                        info.can_create_child, info.last_contributor, info.digest, info.folderish, info.last_contributor,
-                       local_path, local_parent_path, pair_state, info.name))
+                       local_path, local_parent_path, pair_state, info.name, info.size))
             row_id = c.lastrowid
             if self.auto_commit:
                 con.commit()
-            # Check if parent is not in creation
+            # Wait for the parent if it is in creation
             parent = c.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
-            if (parent is None and local_parent_path == '') or (parent is not None and parent.pair_state != "remotely_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
+            self._queue_pair_state(row_id, info.folderish, pair_state, size=info.size,
+                                   local_parent_path=local_parent_path,
+                                   depends_on=self._get_parent_dependency(parent, local_parent_path, "remotely_created"))
             self._items_count = self._items_count + 1
         finally:
             self._lock.release()
         return row_id
 
-    def queue_children(self, row):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            children = c.execute("SELECT * FROM States WHERE remote_parent_ref=? or local_parent_path=? AND " +
-                                    self._get_to_sync_condition(), (row.remote_ref, row.local_path)).fetchall()
-            log.debug("Queuing %d children of '%r'", len(children), row)
-            for child in children:
-                self._queue_pair_state(child.id, child.folderish, child.pair_state)
-        finally:
-            self._lock.release()
-
     def increase_error(self, row, error, details=None, incr=1):
         error_date = datetime.utcnow()
         self._lock.acquire()
@@ -1098,7 +1639,7 @@ class EngineDAO(ConfigurationDAO):
                       " WHERE id=?", (row.id,))
             if self.auto_commit:
                 con.commit()
-            self._queue_pair_state(row.id, row.folderish, row.pair_state)
+            self._queue_pair_state(row.id, row.folderish, row.pair_state, pair=row)
             self._items_count = self._items_count + 1
         finally:
             self._lock.release()
@@ -1113,7 +1654,7 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET local_state='synchronized', remote_state='modified', pair_state='remotely_modified', last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
                       " WHERE id=? AND version=?", (row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, "remotely_modified")
+            self._queue_pair_state(row.id, row.folderish, "remotely_modified", pair=row)
             if self.auto_commit:
                 con.commit()
         finally:
@@ -1130,7 +1671,7 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             c.execute("UPDATE States SET local_state='created', remote_state='unknown', pair_state='locally_created', last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
                       " WHERE id=? AND version=?", (row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, "locally_created")
+            self._queue_pair_state(row.id, row.folderish, "locally_created", pair=row)
             if self.auto_commit:
                 con.commit()
         finally:
@@ -1213,8 +1754,13 @@ class EngineDAO(ConfigurationDAO):
             else:
                 log.trace("The current row was: %r (version=%r)", row2, row2.version)
             log.trace("The previous row was: %r (version=%r)", row, row.version)
-        elif row.folderish:
-            self.queue_children(row)
+        elif row.folderish and self._queue_manager is not None:
+            # Only the children waiting for the folder, the other ones are already queued
+            if self.in_tx is not None and self.in_tx == current_thread().ident:
+                # Not before the folder is committed as synchronized
+                self._tx_released.append(row)
+            else:
+                self._queue_manager.release_children(row)
         return result
 
     def update_remote_state(self, row, info, remote_parent_path=None, versionned=True, queue=True, force_update=False):
@@ -1241,19 +1787,18 @@ class EngineDAO(ConfigurationDAO):
                       "remote_parent_path=?, remote_name=?, last_remote_updated=?, remote_can_rename=?," +
                       "remote_can_delete=?, remote_can_update=?, " +
                       "remote_can_create_child=?, last_remote_modifier=?, remote_digest=?, local_state=?," +
-                      "remote_state=?, pair_state=?" + version + " WHERE id=?",
+                      "remote_state=?, pair_state=?, size=COALESCE(?, size)" + version + " WHERE id=?",
                       (info.uid, info.parent_uid, remote_parent_path, info.name,
                        info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
                        info.can_create_child, info.last_contributor, info.digest, row.local_state,
-                       row.remote_state, pair_state, row.id))
+                       row.remote_state, pair_state, info.size, row.id))
             if self.auto_commit:
                 con.commit()
             if queue:
-                # Check if parent is not in creation
+                # Wait for the parent if it is in creation, it can be None if the parent is filtered
                 parent = c.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
-                # Parent can be None if the parent is filtered
-                if (parent is not None and parent.pair_state != "remotely_created") or parent is None:
-                    self._queue_pair_state(row.id, info.folderish, pair_state)
+                self._queue_pair_state(row.id, info.folderish, pair_state, pair=row, size=info.size,
+                                       depends_on=self._get_parent_dependency(parent, None, "remotely_created"))
         finally:
             self._lock.release()
 
@@ -1269,7 +1814,7 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             # Remove any subchilds as it is gonna be scanned anyway
-            c.execute("DELETE FROM ToRemoteScan WHERE path LIKE ?", (path+'%',))
+            c.execute("DELETE FROM ToRemoteScan WHERE " + self._get_prefix_condition("path", path))
             # ADD IT
             c.execute("INSERT INTO ToRemoteScan(path) VALUES(?)", (path,))
             if self.auto_commit:
@@ -1383,18 +1928,19 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             # DELETE ANY SUBFILTERS
-            c.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
+            c.execute("DELETE FROM Filters WHERE " + self._get_prefix_condition("path", path))
             # PREVENT ANY RESCAN
-            c.execute("DELETE FROM ToRemoteScan WHERE path LIKE ?", (path+'%',))
+            c.execute("DELETE FROM ToRemoteScan WHERE " + self._get_prefix_condition("path", path))
             # ADD IT
             c.execute("INSERT INTO Filters(path) VALUES(?)", (path,))
             # TODO ADD THIS path AS remotely_deleted
             if self.auto_commit:
                 con.commit()
-            self._filters = self.get_filters()
-            self._items_count = self.get_syncing_count()
         finally:
             self._lock.release()
+        # Read outside of the lock as it can wait for a transaction to end
+        self._filters = self.get_filters()
+        self._items_count = self.get_syncing_count()
 
     def remove_filter(self, path):
         path = self._clean_filter_path(path)
@@ -1402,13 +1948,14 @@ class EngineDAO(ConfigurationDAO):
         try:
             con = self._get_write_connection()
             c = con.cursor()
-            c.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
+            c.execute("DELETE FROM Filters WHERE " + self._get_prefix_condition("path", path))
             if self.auto_commit:
                 con.commit()
-            self._filters = self.get_filters()
-            self._items_count = self.get_syncing_count()
         finally:
             self._lock.release()
+        # Read outside of the lock as it can wait for a transaction to end
+        self._filters = self.get_filters()
+        self._items_count = self.get_syncing_count()
 
     def _escape(self, _str):
         return _str.replace("'", "''")
@@ -6,16 +6,19 @@ from nxdrive.commandline import DEFAULT_UPDATE_SITE_URL
 from nxdrive.client.common import DEFAULT_REPOSITORY_NAME
 from nxdrive.client.common import NotFound
 from nxdrive.client import LocalClient
+from nxdrive.client import DigestCache
 from nxdrive.client import RemoteFileSystemClient
 from nxdrive.client import RemoteFilteredFileSystemClient
 from nxdrive.client import RemoteDocumentClient
+from nxdrive.client import ConnectionPool
+from nxdrive.client import FileCopier
+from nxdrive.client.base_automation_client import clean_partial_downloads
 from nxdrive.utils import normalized_path
 from nxdrive.engine.processor import Processor
 from threading import current_thread
 from nxdrive.osi import AbstractOSIntegration
 from nxdrive.engine.workers import Worker, ThreadInterrupt, PairInterrupt
 from nxdrive.engine.activity import Action, FileAction
-from time import sleep
 WindowsError = None
 try:
     from exceptions import WindowsError
@@ -172,6 +175,13 @@ class Engine(QObject):
         self._threads = list()
         self._client_cache_timestamps = dict()
         self._dao = self._create_dao()
+        # Shared by the local clients to avoid hashing several times the same file
+        self._digest_cache = DigestCache(self._dao)
+        # Shared by the remote clients to keep the HTTP connections alive
+        self._connection_pool = ConnectionPool(
+            max_per_host=int(self._dao.get_config("http_connections_per_host", 16)))
+        # Shared by the processors to copy the local files having the content to download
+        self._file_copier = FileCopier()
         if binder is not None:
             self.bind(binder)
         self._load_configuration()
@@ -202,6 +212,8 @@ class Engine(QObject):
             self._conflict_resolver(conflict.id, emit=False)
         # Scan in remote_watcher thread
         self._scanPair.connect(self._remote_watcher.scan_pair)
+        # Poll the server sooner after an upload
+        self.newSync.connect(self._remote_watcher.pair_synchronized)
         # Set the root icon
         self._set_root_icon()
         # Set user full name
@@ -240,9 +252,7 @@ class Engine(QObject):
         self._folder_lock = path
         # Check for each processor
         log.debug("Local Folder locking on '%s'", path)
-        while self.get_queue_manager().has_file_processors_on(path):
-            log.trace("Local folder locking wait for file processor to finish")
-            sleep(1)
+        self.get_queue_manager().wait_file_processors_on(path)
         log.debug("Local Folder lock setup completed on '%s'", path)
 
     def release_folder_lock(self):
@@ -600,6 +610,12 @@ class Engine(QObject):
             raise FsMarkerException()
         # Checking root in case of failed migration
         self._check_root()
+        # Forget the chunks of the abandoned uploads
+        self._dao.clean_upload_chunks()
+        # And remove the abandoned downloads
+        removed = clean_partial_downloads(self._local_folder)
+        if removed:
+            log.debug("Removed %d files of abandoned downloads", removed)
         self._stopped = False
         Processor.soft_locks = dict()
         log.debug("Engine %s starting", self.get_uid())
@@ -628,6 +644,8 @@ class Engine(QObject):
         metrics["unsynchronized_files"] = self._dao.get_unsynchronized_count()
         metrics["files_size"] = self._dao.get_global_size()
         metrics["invalid_credentials"] = self._invalid_credentials
+        metrics.update(self._connection_pool.get_metrics())
+        metrics.update(self._file_copier.get_metrics())
         return metrics
 
     def get_conflicts(self):
@@ -712,7 +730,8 @@ class Engine(QObject):
             self._server_url, self._remote_user, self._manager.device_id,
             self._manager.get_version(), proxies=self._manager.proxies,
             proxy_exceptions=self._manager.proxy_exceptions,
-            password=str(password), timeout=self._handshake_timeout)
+            password=str(password), timeout=self._handshake_timeout,
+            connection_pool=self._connection_pool)
         self._remote_token = nxclient.request_token()
         if self._remote_token is None:
             raise Exception
@@ -765,7 +784,8 @@ class Engine(QObject):
                 self._manager.get_version(), proxies=self._manager.proxies,
                 proxy_exceptions=self._manager.proxy_exceptions,
                 password=self._remote_password, token=self._remote_token,
-                timeout=self._handshake_timeout)
+                timeout=self._handshake_timeout,
+                connection_pool=self._connection_pool)
             if self._remote_token is None:
                 self._remote_token = nxclient.request_token()
         if self._remote_token is not None:
@@ -823,11 +843,18 @@ class Engine(QObject):
                     thread.worker.quit()
 
     def get_local_client(self):
-        client = LocalClient(self._local_folder, case_sensitive=self._case_sensitive)
+        client = LocalClient(self._local_folder, case_sensitive=self._case_sensitive,
+                             digest_cache=self._digest_cache)
         if self._case_sensitive is None and os.path.exists(self._local_folder):
             self._case_sensitive = client.is_case_sensitive()
         return client
 
+    def get_digest_cache(self):
+        return self._digest_cache
+
+    def get_file_copier(self):
+        return self._file_copier
+
     def get_server_version(self):
         return self._dao.get_config("server_version")
 
@@ -841,6 +868,7 @@ class Engine(QObject):
     def invalidate_client_cache(self):
         log.debug("Invalidate client cache")
         self._remote_clients.clear()
+        self._connection_pool.clear()
         self.invalidClientsCache.emit()
 
     def _set_root_icon(self):
@@ -919,27 +947,34 @@ class Engine(QObject):
         cache_key = (self._manager.device_id, filtered)
         remote_client = cache.get(cache_key)
         if remote_client is None:
-            if filtered:
-                remote_client = self.remote_filtered_fs_client_factory(
-                        self._server_url, self._remote_user,
-                        self._manager.device_id, self.version, self._dao,
-                        proxies=self._manager.proxies,
-                        proxy_exceptions=self._manager.proxy_exceptions,
-                        password=self._remote_password,
-                        timeout=self.timeout, cookie_jar=self.cookie_jar,
-                        token=self._remote_token, check_suspended=self.suspend_client)
-            else:
-                remote_client = self.remote_fs_client_factory(
-                        self._server_url, self._remote_user,
-                        self._manager.device_id, self.version,
-                        proxies=self._manager.proxies,
-                        proxy_exceptions=self._manager.proxy_exceptions,
-                        password=self._remote_password,
-                        timeout=self.timeout, cookie_jar=self.cookie_jar,
-                        token=self._remote_token, check_suspended=self.suspend_client)
+            remote_client = self.create_remote_client(filtered)
             cache[cache_key] = remote_client
         return remote_client
 
+    def create_remote_client(self, filtered=True):
+        """Return a new client for the FileSystem abstraction, not shared with the other threads."""
+        if self._invalid_credentials:
+            return None
+        if filtered:
+            return self.remote_filtered_fs_client_factory(
+                    self._server_url, self._remote_user,
+                    self._manager.device_id, self.version, self._dao,
+                    proxies=self._manager.proxies,
+                    proxy_exceptions=self._manager.proxy_exceptions,
+                    password=self._remote_password,
+                    timeout=self.timeout, cookie_jar=self.cookie_jar,
+                    token=self._remote_token, check_suspended=self.suspend_client,
+                    connection_pool=self._connection_pool, upload_store=self._dao)
+        return self.remote_fs_client_factory(
+                self._server_url, self._remote_user,
+                self._manager.device_id, self.version,
+                proxies=self._manager.proxies,
+                proxy_exceptions=self._manager.proxy_exceptions,
+                password=self._remote_password,
+                timeout=self.timeout, cookie_jar=self.cookie_jar,
+                token=self._remote_token, check_suspended=self.suspend_client,
+                connection_pool=self._connection_pool, upload_store=self._dao)
+
     def get_remote_doc_client(self, repository=DEFAULT_REPOSITORY_NAME, base_folder=None):
         if self._invalid_credentials:
             return None
@@ -954,7 +989,8 @@ class Engine(QObject):
                 proxy_exceptions=self._manager.proxy_exceptions,
                 password=self._remote_password, token=self._remote_token,
                 repository=repository, base_folder=base_folder,
-                timeout=self._handshake_timeout, cookie_jar=self.cookie_jar, check_suspended=self.suspend_client)
+                timeout=self._handshake_timeout, cookie_jar=self.cookie_jar, check_suspended=self.suspend_client,
+                connection_pool=self._connection_pool)
             cache[cache_key] = remote_client
         return remote_client
 
@@ -970,7 +1006,10 @@ class Engine(QObject):
         from nxdrive.client.rest_api_client import RestAPIClient
         rest_client = RestAPIClient(self.get_server_url(), self.get_remote_user(),
                                         self._manager.get_device_id(), self._manager.get_version(), None,
-                                        self.get_remote_token(), timeout=self.timeout, cookie_jar=self.cookie_jar)
+                                        self.get_remote_token(), timeout=self.timeout, cookie_jar=self.cookie_jar,
+                                        proxies=self._manager.proxies,
+                                        proxy_exceptions=self._manager.proxy_exceptions,
+                                        connection_pool=self._connection_pool)
         return rest_client
 
     def get_user_full_name(self, userid):
@@ -1,6 +1,6 @@
 __author__ = 'loopingz'
 from nxdrive.engine.watcher.local_watcher import LocalWatcher, DriveFSRootEventHandler, normalize_event_filename
-from time import sleep, time, mktime
+from time import time, mktime
 from nxdrive.utils import current_milli_time
 import os
 import sqlite3
@@ -134,23 +134,25 @@ class SimpleWatcher(LocalWatcher):
             self._action = Action("Full local scan")
             self._scan()
             self._end_action()
-            # Check windows dequeue and folder scan only every 100 loops ( every 1s )
             current_time_millis = int(round(time() * 1000))
             self._win_delete_interval = current_time_millis
             self._win_folder_scan_interval = current_time_millis
-            i = 0
+            # Check the folders to scan every second
+            next_check = time() + 1
             while (1):
                 self._interact()
-                sleep(0.01)
                 while (not self._watchdog_queue.empty()):
                     # Dont retest if already local scan
                     evt = self._watchdog_queue.get()
                     self.handle_watchdog_event(evt)
-                # Check to scan
-                i += 1
-                if i % 100 != 0:
+                if self._watchdog_queue.empty():
+                    if self._to_scan or self._delete_files:
+                        self._wait(next_check - time())
+                    else:
+                        self._wait()
+                if time() < next_check:
                     continue
-                i = 0
+                next_check = time() + 1
                 threshold_time = current_milli_time() - 1000 * self._scan_delay
                 # Need to create a list of to scan as the dictionary cannot grow while iterating
                 local_scan = []
@@ -8,6 +8,7 @@ from nxdrive.logging_config import get_logger
 from nxdrive.client.common import LOCALLY_EDITED_FOLDER_NAME, UNACCESSIBLE_HASH
 from nxdrive.client.common import NotFound
 from nxdrive.client.common import safe_filename
+from nxdrive.client.common import StreamDigester
 from nxdrive.engine.activity import Action
 from nxdrive.utils import current_milli_time, is_office_temp_file
 from PyQt4.QtCore import pyqtSignal
@@ -150,6 +151,7 @@ class Processor(EngineWorker):
             local_client = self._engine.get_local_client()
             remote_client = self._engine.get_remote_client()
             doc_pair = None
+            folder_pair = None
             try:
                 doc_pair = self._dao.acquire_state(self._thread_id, self._current_item.id)
             except:
@@ -160,6 +162,7 @@ class Processor(EngineWorker):
             try:
                 if doc_pair is None:
                     log.trace("Didn't acquire state, dropping %r", self._current_item)
+                    self._engine.get_queue_manager().increase_redundant_acquires()
                     self._current_item = self._get_item()
                     continue
                 log.debug('Executing processor on %r(%d)', doc_pair, doc_pair.version)
@@ -170,8 +173,16 @@ class Processor(EngineWorker):
                     or doc_pair.pair_state is None
                     or doc_pair.pair_state.startswith('parent_')):
                     log.trace("Skip as pair is in non-processable state: %r", doc_pair)
+                    self._engine.get_queue_manager().increase_redundant_acquires()
                     self._current_item = self._get_item()
                     continue
+                # Folders are processed in parallel, not the ones above or below another one
+                if doc_pair.folderish:
+                    if not self._engine.get_queue_manager().acquire_folder(doc_pair, self._current_item):
+                        self._current_doc_pair = None
+                        self._current_item = self._get_item()
+                        continue
+                    folder_pair = doc_pair
                 # TODO Update as the server dont take hash to avoid conflict yet
                 if (doc_pair.pair_state.startswith("locally")
                         and doc_pair.remote_ref is not None):
@@ -225,12 +236,11 @@ class Processor(EngineWorker):
                     except ThreadInterrupt:
                         raise
                     except PairInterrupt:
-                        from time import sleep
-                        # Wait one second to avoid retrying to quickly
+                        # Retry in one second to avoid retrying too quickly, without holding the processor
                         self._current_doc_pair = None
-                        log.debug("PairInterrupt wait 1s and requeue on %r", doc_pair)
-                        sleep(1)
-                        self._engine.get_queue_manager().push(doc_pair)
+                        log.debug("PairInterrupt requeue in 1s on %r", doc_pair)
+                        self._engine.get_queue_manager().postpone_pair(doc_pair, 1)
+                        self._current_item = self._get_item()
                         continue
                     except Exception as e:
                         log.exception(e)
@@ -248,6 +258,9 @@ class Processor(EngineWorker):
                 if soft_lock is not None:
                     self._unlock_soft_path(soft_lock)
                 self._dao.release_state(self._thread_id)
+                if folder_pair is not None:
+                    self._engine.get_queue_manager().release_folder(folder_pair)
+                self._engine.get_queue_manager().notify_processing_end()
             self._interact()
             self._current_item = self._get_item()
 
@@ -411,6 +424,8 @@ class Processor(EngineWorker):
             fs_item_info = None
             remote_parent_path = parent_pair.remote_parent_path + '/' + parent_pair.remote_ref
             if doc_pair.folderish:
+                if self._synchronize_folder_tree(doc_pair, parent_pair, local_client, remote_client):
+                    return
                 log.debug("Creating remote folder '%s' in folder '%s'",
                           name, parent_pair.remote_name)
                 fs_item_info = remote_client.make_folder(parent_ref, name)
@@ -433,8 +448,13 @@ class Processor(EngineWorker):
                     if doc_pair.local_digest == UNACCESSIBLE_HASH:
                         self._postpone_pair(doc_pair, 'Unaccessible hash')
                         return
+                # Digest still pending in the local watcher, compute it while uploading
+                digester = StreamDigester(local_client.get_digest_func()) if doc_pair.local_digest is None else None
                 fs_item_info = remote_client.stream_file(
-                    parent_ref, local_client._abspath(doc_pair.local_path), filename=name)
+                    parent_ref, local_client._abspath(doc_pair.local_path), filename=name, digester=digester)
+                if digester is not None:
+                    doc_pair.local_digest = digester.hexdigest(local_client.get_digest_func())
+                    self._dao.update_local_digest(doc_pair.id, doc_pair.local_digest)
                 remote_ref = fs_item_info.uid
                 self._dao.update_last_transfer(doc_pair.id, "upload")
                 self._update_speed_metrics()
@@ -467,7 +487,74 @@ class Processor(EngineWorker):
                 self._engine.newReadonly.emit(doc_pair.local_name, parent_pair.remote_name)
                 self._handle_unsynchronized(local_client, doc_pair)
 
+    def _synchronize_folder_tree(self, doc_pair, parent_pair, local_client, remote_client):
+        """Create the locally created folder with its locally created subfolders by batches
+
+        Each batch is mapped to the pairs in one transaction, so the children of its
+        folders can be synchronized right away. Return False if the server cannot
+        create folders by batches or if there is no subfolder to create.
+        """
+        if not remote_client.can_make_folders():
+            return False
+        # The subfolders wait for doc_pair, hold them to be the only one creating them
+        folders = [doc_pair]
+        indexes = {doc_pair.local_path: 0}
+        for folder in self._dao.get_locally_created_folders(doc_pair):
+            if (folder.local_parent_path in indexes and local_client.get_remote_id(folder.local_path) is None
+                    and self._dao.acquire_processor(self._thread_id, folder.id)):
+                indexes[folder.local_path] = len(folders)
+                folders.append(folder)
+        if len(folders) == 1:
+            return False
+        log.debug("Creating %d remote folders from '%s' in folder '%s'", len(folders), doc_pair.local_path,
+                  parent_pair.remote_name)
+        root_path = parent_pair.remote_parent_path + '/' + parent_pair.remote_ref
+        remote_paths = []
+        try:
+            for infos in remote_client.make_folders(parent_pair.remote_ref,
+                                                    [(folder.local_name, indexes.get(folder.local_parent_path))
+                                                     for folder in folders]):
+                batch = folders[len(remote_paths):len(remote_paths) + len(infos)]
+                for folder, info in zip(batch, infos):
+                    try:
+                        local_client.set_remote_id(folder.local_path, info.uid)
+                    except (NotFound, IOError, OSError) as e:
+                        log.debug("Cannot put remote_ref %s in %r: %r", info.uid, folder.local_path, e)
+                # Only the database updates in the transaction
+                dirty = []
+                self._dao.begin_transaction()
+                try:
+                    for folder, info in zip(batch, infos):
+                        parent_index = indexes.get(folder.local_parent_path)
+                        remote_parent_path = root_path if parent_index is None else remote_paths[parent_index]
+                        remote_paths.append(remote_parent_path + '/' + info.uid)
+                        self._dao.update_remote_state(folder, info, remote_parent_path=remote_parent_path,
+                                                      versionned=False, queue=False)
+                        if info.name != folder.local_name or info.digest != folder.local_digest:
+                            dirty.append((folder, info))
+                        else:
+                            self._dao.synchronize_state(folder)
+                finally:
+                    self._dao.end_transaction()
+                # Renamed by the server, synchronize it as remotely modified once committed
+                for folder, info in dirty:
+                    self._synchronize_if_not_remotely_dirty(folder, local_client, remote_client, remote_info=info)
+        finally:
+            # A subfolder released by its synchronized parent was dropped as held, retry it
+            synchronized = set()
+            for folder in folders:
+                pair = self._dao.get_state_from_id(folder.id)
+                if pair is None:
+                    continue
+                if pair.pair_state == 'synchronized':
+                    synchronized.add(pair.local_path)
+                elif pair.id != doc_pair.id and pair.local_parent_path in synchronized:
+                    self._engine.get_queue_manager().postpone_pair(pair, 1)
+        return True
+
     def _synchronize_locally_deleted(self, doc_pair, local_client, remote_client):
+        # The remote content will not be downloaded anymore
+        self._remove_partial_download(doc_pair, local_client, remote_client)
         if doc_pair.remote_ref is not None:
             if doc_pair.remote_can_delete:
                 log.debug("Deleting or unregistering remote document '%s' (%s)", doc_pair.remote_name,
@@ -559,6 +646,7 @@ class Processor(EngineWorker):
                   " synchronizer will fix this case at next iteration",
                   doc_pair)
         self._dao.remove_state(doc_pair)
+        self._remove_partial_download(doc_pair, local_client, remote_client)
 
     def _get_temporary_file(self, file_path):
         from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_PREFIX
@@ -569,21 +657,33 @@ class Processor(EngineWorker):
                                 + DOWNLOAD_TMP_FILE_SUFFIX)
         return file_out
 
+    def _remove_partial_download(self, doc_pair, local_client, remote_client):
+        # The download kept to be resumed is useless once the pair is dropped
+        if doc_pair.folderish or doc_pair.local_path is None:
+            return
+        try:
+            remote_client.remove_partial_download(self._get_temporary_file(
+                local_client._abspath(doc_pair.local_path)))
+        except (IOError, OSError) as e:
+            log.debug("Cannot remove the partial download of %r: %r", doc_pair, e)
+
     def _download_content(self, local_client, remote_client, doc_pair, file_path):
         # Check if the file is already on the HD
         pair = self._dao.get_valid_duplicate_file(doc_pair.remote_digest)
         if pair:
-            import shutil
             file_out = self._get_temporary_file(file_path)
             locker = local_client.unlock_path(file_out)
             try:
-                shutil.copy(local_client._abspath(pair.local_path), file_out)
+                self._engine.get_file_copier().copy(local_client._abspath(pair.local_path), file_out)
             finally:
                 local_client.lock_path(file_out, locker)
             return file_out
+        # Compute the local digest while downloading
+        digester = StreamDigester(local_client.get_digest_func())
         tmp_file = remote_client.stream_content(
                                 doc_pair.remote_ref, file_path,
-                                parent_fs_item_id=doc_pair.remote_parent_ref)
+                                parent_fs_item_id=doc_pair.remote_parent_ref, digester=digester)
+        local_client.set_digests(local_client.get_path(tmp_file), digester.hexdigests())
         self._update_speed_metrics()
         return tmp_file
 
@@ -707,6 +807,7 @@ class Processor(EngineWorker):
         if remote_client.is_filtered(path):
             # It is filtered so skip and remove from the LastKnownState
             self._dao.remove_state(doc_pair)
+            self._remove_partial_download(doc_pair, local_client, remote_client)
             return
         if not local_client.exists(doc_pair.local_path):
             path = self._create_remotely(local_client, remote_client, doc_pair, parent_pair, name)
@@ -780,9 +881,7 @@ class Processor(EngineWorker):
                     self._engine.set_local_folder_lock(doc_pair.local_path)
                 else:
                     # Check for nxpart to clean up
-                    file_out = self._get_temporary_file(local_client._abspath(doc_pair.local_path))
-                    if os.path.exists(file_out):
-                        os.remove(file_out)
+                    self._remove_partial_download(doc_pair, local_client, remote_client)
                 if self._engine.use_trash():
                     local_client.delete(doc_pair.local_path)
                 else:
@@ -815,6 +914,7 @@ class Processor(EngineWorker):
                   " synchronizer will fix this case at next iteration",
                   doc_pair)
         self._dao.remove_state(doc_pair)
+        self._remove_partial_download(doc_pair, local_client, remote_client)
         if doc_pair.local_path is not None:
             log.debug("Since the local path is not None: %s, the synchronizer"
                       " will probably consider this as a local creation at"
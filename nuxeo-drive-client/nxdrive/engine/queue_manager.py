@@ -1,7 +1,10 @@
 from PyQt4.QtCore import QObject, pyqtSignal, pyqtSlot, QTimer
-from Queue import Queue, Empty
 from nxdrive.logging_config import get_logger
-from threading import Lock, local
+from nxdrive.engine.scheduler_queue import SchedulerQueue, DEFAULT_PRIORITY, LOW_PRIORITY
+from nxdrive.engine.scheduling_policy import get_scheduling_policy, get_file_lane, SMALL_FILE_SIZE, SMALL_FILE_LANE
+from nxdrive.engine.retry_scheduler import RetryScheduler, get_backoff
+from threading import Condition, Lock, current_thread, local
+from collections import OrderedDict
 from copy import deepcopy
 import time
 log = get_logger(__name__)
@@ -15,16 +18,27 @@ except ImportError:
     pass  # This will never be raised under Unix
 
 
+def is_path_conflict(path, other_path):
+    """Return True if the local paths are the same or one is a descendant of the other"""
+    path = path.lower()
+    other_path = other_path.lower()
+    return (path == other_path or path.startswith(other_path.rstrip('/') + '/')
+            or other_path.startswith(path.rstrip('/') + '/'))
+
+
 class QueueItem(object):
-    def __init__(self, row_id, folderish, pair_state):
+    def __init__(self, row_id, folderish, pair_state, size=None, local_parent_path=None):
         self.id = row_id
         self.folderish = folderish
         self.pair_state = pair_state
+        # Same attributes as the DocPair, for the scheduling policies
+        self.size = size
+        self.local_parent_path = local_parent_path
 
     def __repr__(self):
-        return "%s[%s](Folderish:%s, State: %s)" % (
+        return "%s[%s](Folderish:%s, State: %s, Size: %s)" % (
                         self.__class__.__name__, self.id,
-                        self.folderish, self.pair_state)
+                        self.folderish, self.pair_state, self.size)
 
 
 class QueueManager(QObject):
@@ -47,10 +61,30 @@ class QueueManager(QObject):
         super(QueueManager, self).__init__()
         self._dao = dao
         self._engine = engine
-        self._local_folder_queue = Queue()
-        self._local_file_queue = Queue()
-        self._remote_file_queue = Queue()
-        self._remote_folder_queue = Queue()
+        # Order of the files and share of the additional processors reserved to the small files
+        self._policy = get_scheduling_policy(dao.get_config('file_scheduling_policy', 'fifo'))
+        self._small_file_size = int(dao.get_config('small_file_size', SMALL_FILE_SIZE))
+        self._small_file_processors = int(dao.get_config('small_file_processors', 1))
+        file_lane = self._get_file_lane if self._small_file_processors > 0 else None
+        # At most one item by row id in all the queues
+        self._local_folder_queue = SchedulerQueue()
+        self._local_file_queue = SchedulerQueue(key=self._policy.get_key, lane=file_lane)
+        self._remote_file_queue = SchedulerQueue(key=self._policy.get_key, lane=file_lane)
+        self._remote_folder_queue = SchedulerQueue()
+        self._queues = [self._local_folder_queue, self._local_file_queue,
+                        self._remote_folder_queue, self._remote_file_queue]
+        # Acquired pairs which had nothing to process
+        self._redundant_acquires = 0
+        # Dependency graph of the pairs waiting for their parent to be synchronized:
+        # parent row id, or local path if the parent has no row yet -> {row id: (item, priority)}
+        self._waiting_children = dict()
+        # row id -> parent it waits for
+        self._waiting_parents = dict()
+        self._released_children = 0
+        # Folder pairs being processed: row id -> local path, and row id -> items waiting for its end
+        self._processing_folders = dict()
+        self._waiting_folders = dict()
+        self._dependency_lock = Lock()
         self._connected = local()
         self._local_folder_enable = True
         self._local_file_enable = True
@@ -65,7 +99,11 @@ class QueueManager(QObject):
         self.set_max_processors(max_file_processors)
         self._threads_pool = list()
         self._processors_pool = list()
+        # Processors of the small file lane, also in the processors pool
+        self._small_file_pool = list()
         self._get_file_lock = Lock()
+        # Notified each time a processor is done with a pair or ends
+        self._processing_condition = Condition()
         # Should not operate on thread while we are inspecting them
         '''
         This error required to add a lock for inspecting threads, as the below Traceback shows the processor thread was ended while the method was running
@@ -84,7 +122,8 @@ class QueueManager(QObject):
 
         # ERROR HANDLING
         self._error_lock = Lock()
-        self._on_error_queue = dict()
+        # Blacklisted and postponed pairs by next try time
+        self._on_error_queue = RetryScheduler()
         self._error_timer = QTimer()
         self._error_timer.timeout.connect(self._on_error_timer)
         self.newError.connect(self._on_new_error)
@@ -111,7 +150,7 @@ class QueueManager(QObject):
             self.push(item)
 
     def _copy_queue(self, queue):
-        result = deepcopy(queue.queue)
+        result = deepcopy(queue.items())
         result.reverse()
         return result
 
@@ -182,50 +221,133 @@ class QueueManager(QObject):
     def get_remote_folder_queue(self):
         return self._copy_queue(self._remote_folder_queue)
 
-    def push_ref(self, row_id, folderish, pair_state):
-        self.push(QueueItem(row_id, folderish, pair_state))
+    def push_ref(self, row_id, folderish, pair_state, priority=DEFAULT_PRIORITY, size=None, local_parent_path=None,
+                 depends_on=None):
+        self.push(QueueItem(row_id, folderish, pair_state, size=size, local_parent_path=local_parent_path),
+                  priority=priority, depends_on=depends_on)
 
-    def push(self, state):
+    def push(self, state, priority=DEFAULT_PRIORITY, depends_on=None):
+        """Queue the pair, or keep it aside until its parent depends_on is synchronized"""
         if state.pair_state is None:
             log.trace("Don't push an empty pair_state: %r", state)
             return
-        log.trace("Pushing %r", state)
         row_id = state.id
+        with self._dependency_lock:
+            self._remove_waiting(row_id)
+            if depends_on is not None:
+                self._waiting_children.setdefault(depends_on, OrderedDict())[row_id] = (state, priority)
+                self._waiting_parents[row_id] = depends_on
+        if depends_on is not None:
+            log.trace("Waiting for parent %r before pushing %r", depends_on, state)
+            for queue in self._queues:
+                queue.remove(row_id)
+            return
+        log.trace("Pushing %r", state)
         if state.pair_state.startswith('locally'):
             if state.folderish:
-                self._local_folder_queue.put(state)
-                log.trace('Pushed to _local_folder_queue, now of size: %d', self._local_folder_queue.qsize())
+                queue = self._local_folder_queue
             else:
-                if "deleted" in state.pair_state:
-                    self._engine.cancel_action_on(state.id)
-                self._local_file_queue.put(state)
-                log.trace('Pushed to _local_file_queue, now of size: %d', self._local_file_queue.qsize())
-            self.newItem.emit(row_id)
+                queue = self._local_file_queue
         elif state.pair_state.startswith('remotely'):
             if state.folderish:
-                self._remote_folder_queue.put(state)
-                log.trace('Pushed to _remote_folder_queue, now of size: %d', self._remote_folder_queue.qsize())
+                queue = self._remote_folder_queue
             else:
-                if "deleted" in state.pair_state:
-                    self._engine.cancel_action_on(state.id)
-                self._remote_file_queue.put(state)
-                log.trace('Pushed to _remote_file_queue, now of size: %d', self._remote_file_queue.qsize())
-            self.newItem.emit(row_id)
+                queue = self._remote_file_queue
         else:
             # deleted and conflicted
             log.debug("Not processable state: %r", state)
+            return
+        if not state.folderish and "deleted" in state.pair_state:
+            self._engine.cancel_action_on(state.id)
+        # The pair state can have changed from local to remote or the opposite
+        for other_queue in self._queues:
+            if other_queue is not queue and row_id in other_queue:
+                other_queue.remove(row_id)
+        if queue.put(state, priority=priority):
+            log.trace('Pushed %r, queue now of size: %d', state, queue.qsize())
+            self.newItem.emit(row_id)
+        else:
+            log.trace('Merged %r with the queued pair', state)
+
+    def _remove_waiting(self, row_id):
+        parent = self._waiting_parents.pop(row_id, None)
+        if parent is None:
+            return
+        children = self._waiting_children[parent]
+        del children[row_id]
+        if not children:
+            del self._waiting_children[parent]
+
+    def release_children(self, parent_pair):
+        """Push the pairs waiting for the synchronization of parent_pair"""
+        released = []
+        with self._dependency_lock:
+            for parent in (parent_pair.id, parent_pair.local_path):
+                children = self._waiting_children.pop(parent, None)
+                if children is None:
+                    continue
+                for row_id, child in children.iteritems():
+                    del self._waiting_parents[row_id]
+                    released.append(child)
+            self._released_children += len(released)
+        if released:
+            log.debug("Releasing %d children of %r", len(released), parent_pair)
+        for state, priority in released:
+            self.push(state, priority=priority)
+
+    def forget_children(self, parent_pair):
+        """Drop the pairs waiting for parent_pair and their own waiting children, once removed"""
+        with self._dependency_lock:
+            parents = [parent_pair.id, parent_pair.local_path]
+            while parents:
+                children = self._waiting_children.pop(parents.pop(), None)
+                if children is None:
+                    continue
+                for row_id in children:
+                    del self._waiting_parents[row_id]
+                    parents.append(row_id)
+
+    def acquire_folder(self, doc_pair, item):
+        """Register the folder pair as being processed, unless a folder above or below it already is
+
+        The item is then kept aside and pushed again once that other folder is done."""
+        if doc_pair.local_path is None:
+            return True
+        with self._dependency_lock:
+            for row_id, path in self._processing_folders.iteritems():
+                if is_path_conflict(doc_pair.local_path, path):
+                    log.trace("Wait for the folder %s to be processed before %r", path, doc_pair)
+                    self._waiting_folders.setdefault(row_id, []).append(item)
+                    return False
+            self._processing_folders[doc_pair.id] = doc_pair.local_path
+        return True
+
+    def release_folder(self, doc_pair):
+        with self._dependency_lock:
+            if self._processing_folders.pop(doc_pair.id, None) is None:
+                return
+            waiting = self._waiting_folders.pop(doc_pair.id, [])
+        for item in waiting:
+            self.push(item)
+
+    def get_waiting_count(self):
+        return len(self._waiting_parents)
+
+    def increase_redundant_acquires(self):
+        self._redundant_acquires += 1
 
     @pyqtSlot()
     def _on_error_timer(self):
-        cur_time = int(time.time())
         self._error_lock.acquire()
         try:
-            for doc_pair in self._on_error_queue.values():
-                if doc_pair.error_next_try < cur_time:
-                    queueItem = QueueItem(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
-                    del self._on_error_queue[doc_pair.id]
-                    log.debug('End of blacklist period, pushing doc_pair: %r', doc_pair)
-                    self.push(queueItem)
+            doc_pair = self._on_error_queue.pop()
+            while doc_pair is not None:
+                queueItem = QueueItem(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, size=doc_pair.size,
+                                      local_parent_path=doc_pair.local_parent_path)
+                log.debug('End of blacklist period, pushing doc_pair: %r', doc_pair)
+                # Let the new changes go first
+                self.push(queueItem, priority=LOW_PRIORITY)
+                doc_pair = self._on_error_queue.pop()
             if len(self._on_error_queue) == 0:
                 self._error_timer.stop()
         finally:
@@ -236,7 +358,9 @@ class QueueManager(QObject):
 
     @pyqtSlot()
     def _on_new_error(self):
-        self._error_timer.start(1000)
+        # Restarting it would delay the next check
+        if not self._error_timer.isActive():
+            self._error_timer.start(1000)
 
     def get_errors_count(self):
         return len(self._on_error_queue)
@@ -256,15 +380,23 @@ class QueueManager(QObject):
             self.newErrorGiveUp.emit(doc_pair.id)
             log.debug("Giving up on pair : %r", doc_pair)
             return
-        interval = self._error_interval * error_count
-        doc_pair.error_next_try = interval + int(time.time())
+        interval = get_backoff(self._error_interval, error_count)
         log.debug("Blacklisting pair for %ds: %r", interval, doc_pair)
+        self._postpone(doc_pair, interval)
+
+    def postpone_pair(self, doc_pair, interval=60):
+        log.debug("Postponing pair for %ds: %r", interval, doc_pair)
+        self._postpone(doc_pair, interval)
+
+    def _postpone(self, doc_pair, interval):
+        next_try = time.time() + interval
+        doc_pair.error_next_try = int(next_try)
         self._error_lock.acquire()
         try:
             emit_sig = False
             if doc_pair.id not in self._on_error_queue:
                 emit_sig = True
-            self._on_error_queue[doc_pair.id] = doc_pair
+            self._on_error_queue.push(doc_pair.id, doc_pair, next_try)
             if emit_sig:
                 self.newError.emit(doc_pair.id)
         finally:
@@ -273,77 +405,86 @@ class QueueManager(QObject):
     def requeue_errors(self):
         self._error_lock.acquire()
         try:
-            for doc_pair in self._on_error_queue.values():
+            for doc_pair in self._on_error_queue.items():
                 doc_pair.error_next_try = 0
+            self._on_error_queue.reschedule_all(0)
         finally:
             self._error_lock.release()
 
-    def _get_local_folder(self):
-        if self._local_folder_queue.empty():
-            return None
-        try:
-            state = self._local_folder_queue.get(True, 3)
-        except Empty:
-            return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_local_folder()
+    def _get_from_queue(self, queue):
+        state = queue.get()
+        while state is not None and self._is_on_error(state.id):
+            state = queue.get()
         return state
 
+    def _get_local_folder(self):
+        return self._get_from_queue(self._local_folder_queue)
+
     def _get_local_file(self):
-        if self._local_file_queue.empty():
-            return None
-        try:
-            state = self._local_file_queue.get(True, 3)
-        except Empty:
-            return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_local_file()
-        return state
+        return self._get_from_queue(self._local_file_queue)
 
     def _get_remote_folder(self):
-        if self._remote_folder_queue.empty():
-            return None
-        try:
-            state = self._remote_folder_queue.get(True, 3)
-        except Empty:
-            return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_remote_folder()
-        return state
+        return self._get_from_queue(self._remote_folder_queue)
 
     def _get_remote_file(self):
-        if self._remote_file_queue.empty():
-            return None
-        try:
-            state = self._remote_file_queue.get(True, 3)
-        except Empty:
-            return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_remote_file()
-        return state
+        return self._get_from_queue(self._remote_file_queue)
 
-    def _get_file(self):
+    def _get_file(self, lanes=None):
         self._get_file_lock.acquire()
-        if self._remote_file_queue.empty() and self._local_file_queue.empty():
+        try:
+            queue = self._policy.select([self._local_file_queue, self._remote_file_queue], lanes)
+            if queue is None:
+                return None
+            state = queue.get(lanes)
+        finally:
             self._get_file_lock.release()
-            return None
-        state = None
-        if (self._remote_file_queue.qsize() > self._local_file_queue.qsize()):
-            state = self._get_remote_file()
-        else:
-            state = self._get_local_file()
-        self._get_file_lock.release()
         if state is not None and self._is_on_error(state.id):
-            return self._get_file()
+            return self._get_file(lanes)
         return state
 
+    def _get_item(self):
+        """Serve the folders first, as they release the pairs waiting for them, then the files"""
+        folder_getters = []
+        if self._local_folder_enable:
+            folder_getters.append((self._local_folder_queue, self._get_local_folder))
+        if self._remote_folder_enable:
+            folder_getters.append((self._remote_folder_queue, self._get_remote_folder))
+        folder_getters.sort(key=lambda getter: getter[0].qsize(), reverse=True)
+        for _, getter in folder_getters:
+            state = getter()
+            if state is not None:
+                return state
+        return self._get_file()
+
+    def _get_small_file(self):
+        return self._get_file(lanes=(SMALL_FILE_LANE,))
+
+    def _get_file_lane(self, item):
+        return get_file_lane(item, self._small_file_size)
+
+    def _get_small_file_processors(self):
+        # The dedicated file processors and the other additional ones serve all the files
+        return min(self._small_file_processors, self._max_processors)
+
+    def _has_small_files(self):
+        return not (self._local_file_queue.empty((SMALL_FILE_LANE,))
+                    and self._remote_file_queue.empty((SMALL_FILE_LANE,)))
+
+    def _get_generic_processors(self):
+        # The processors are reserved to the small files only while there are some to transfer
+        if self._small_file_pool or self._has_small_files():
+            return self._max_processors - self._get_small_file_processors()
+        return self._max_processors
+
     @pyqtSlot()
     def _thread_finished(self):
         self._thread_inspection.acquire()
         try:
-            for thread in self._processors_pool:
+            for thread in list(self._processors_pool):
                 if thread.isFinished():
                     self._processors_pool.remove(thread)
+                    if thread in self._small_file_pool:
+                        self._small_file_pool.remove(thread)
             if (self._local_folder_thread is not None and
                     self._local_folder_thread.isFinished()):
                 self._local_folder_thread = None
@@ -360,6 +501,7 @@ class QueueManager(QObject):
                 self.newItem.emit(None)
         finally:
             self._thread_inspection.release()
+        self.notify_processing_end()
 
     def active(self):
         # Recheck threads
@@ -395,8 +537,28 @@ class QueueManager(QObject):
         metrics["total_queue"] = (metrics["local_folder_queue"] + metrics["local_file_queue"]
                                 + metrics["remote_folder_queue"] + metrics["remote_file_queue"])
         metrics["additional_processors"] = len(self._processors_pool)
+        metrics["merged_queue_items"] = sum([queue.merged for queue in self._queues])
+        metrics["redundant_acquires"] = self._redundant_acquires
+        metrics["file_scheduling_policy"] = self._policy.name
+        metrics["small_file_processors"] = len(self._small_file_pool)
+        metrics["file_lane_waits"] = self.get_file_lane_waits()
+        metrics["waiting_children"] = self.get_waiting_count()
+        metrics["released_children"] = self._released_children
         return metrics
 
+    def get_file_lane_waits(self):
+        """Return the number of files served and their average and max wait in seconds, by lane"""
+        totals = dict()
+        for queue in (self._local_file_queue, self._remote_file_queue):
+            for lane, (served, total, max_wait) in queue.get_waits().iteritems():
+                lane_total = totals.setdefault(lane, [0, 0.0, 0.0])
+                lane_total[0] += served
+                lane_total[1] += total
+                lane_total[2] = max(lane_total[2], max_wait)
+        return dict([(lane, {"files": served, "average_wait": total / served if served else 0.0,
+                             "max_wait": max_wait})
+                     for lane, (served, total, max_wait) in totals.iteritems()])
+
     def get_overall_size(self):
         return (self._local_folder_queue.qsize() + self._local_file_queue.qsize()
                 + self._remote_folder_queue.qsize() + self._remote_file_queue.qsize())
@@ -415,6 +577,9 @@ class QueueManager(QObject):
             log.trace("Worker(%r) is processing: %r", worker.get_metrics(), path)
         return result
 
+    def _is_other_processing_file(self, worker, path, thread_id):
+        return getattr(worker, "_thread_id", None) != thread_id and self.is_processing_file(worker, path)
+
     def interrupt_processors_on(self, path, exact_match=True):
         for proc in self.get_processors_on(path, exact_match):
             proc.stop()
@@ -445,20 +610,33 @@ class QueueManager(QObject):
     def has_file_processors_on(self, path):
         self._thread_inspection.acquire()
         try:
+            # The generic processors handle folders too: the calling one must not wait for itself
+            caller = current_thread().ident
             # First check local and remote file
             if self._local_file_thread is not None:
-                if self.is_processing_file(self._local_file_thread.worker, path):
+                if self._is_other_processing_file(self._local_file_thread.worker, path, caller):
                     return True
             if self._remote_file_thread is not None:
-                if self.is_processing_file(self._remote_file_thread.worker, path):
+                if self._is_other_processing_file(self._remote_file_thread.worker, path, caller):
                     return True
             for thread in self._processors_pool:
-                if self.is_processing_file(thread.worker, path):
+                if self._is_other_processing_file(thread.worker, path, caller):
                     return True
             return False
         finally:
             self._thread_inspection.release()
 
+    def notify_processing_end(self):
+        with self._processing_condition:
+            self._processing_condition.notify_all()
+
+    def wait_file_processors_on(self, path):
+        """Block until no file processor works on path or one of its children"""
+        with self._processing_condition:
+            while self.has_file_processors_on(path):
+                log.trace("Wait for file processor to finish on %s", path)
+                self._processing_condition.wait()
+
     @pyqtSlot()
     def launch_processors(self):
         if (self._disable or self.is_paused() or (self._local_folder_queue.empty() and self._local_file_queue.empty()
@@ -480,8 +658,15 @@ class QueueManager(QObject):
         if self._remote_file_thread is None and not self._remote_file_queue.empty() and self._remote_file_enable:
             log.debug("creating remote file processor")
             self._remote_file_thread = self._create_thread(self._get_remote_file, name="RemoteFileProcessor")
-        if self._remote_file_queue.qsize() + self._local_file_queue.qsize() == 0:
-            return
-        while len(self._processors_pool) < self._max_processors:
-            log.debug("creating additional file processor")
-            self._processors_pool.append(self._create_thread(self._get_file, name="GenericProcessor"))
+        small_file_processors = self._get_small_file_processors()
+        # The small file processors end once their lane is empty
+        if self._has_small_files():
+            while len(self._small_file_pool) < small_file_processors:
+                log.debug("creating small file processor")
+                thread = self._create_thread(self._get_small_file, name="SmallFileProcessor")
+                self._small_file_pool.append(thread)
+                self._processors_pool.append(thread)
+        # The other ones serve the folders too, so the independent subtrees run in parallel
+        while len(self._processors_pool) - len(self._small_file_pool) < self._get_generic_processors():
+            log.debug("creating additional processor")
+            self._processors_pool.append(self._create_thread(self._get_item, name="GenericProcessor"))
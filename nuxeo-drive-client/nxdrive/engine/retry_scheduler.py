@@ -0,0 +1,124 @@
+"""Deadline heap of the pairs to retry later."""
+
+from threading import Lock
+from itertools import count
+import heapq
+import random
+import time
+
+# Marks the heap entries of the replaced or removed items
+_REMOVED = object()
+
+
+def get_backoff(interval, retry, max_interval=None, jitter=0.1):
+    """Return the delay before the given retry: interval, then doubled on each retry,
+    randomized by +/- jitter to spread the retries of the items failing together"""
+    delay = interval * (2 ** max(0, retry - 1))
+    if max_interval is not None:
+        delay = min(delay, max_interval)
+    return delay * random.uniform(1 - jitter, 1 + jitter)
+
+
+class RetryScheduler(object):
+    """Items to retry later, at most one by id, ordered by deadline
+
+    Getting the items whose deadline is passed only looks at the head of the heap,
+    so a timer can check it often whatever the number of scheduled items.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # Heap of [deadline, sequence, item id, item]
+        self._heap = []
+        # item id -> heap entry
+        self._entries = dict()
+        self._sequence = count()
+
+    def push(self, item_id, item, deadline):
+        """Schedule the item at the deadline, in seconds since the epoch,
+        replacing the item already scheduled with the same id"""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(item_id)
+            if entry is not None:
+                entry[3] = _REMOVED
+            entry = [deadline, next(self._sequence), item_id, item]
+            self._entries[item_id] = entry
+            heapq.heappush(self._heap, entry)
+            self._compact()
+        finally:
+            self._lock.release()
+
+    def pop(self, cur_time=None):
+        """Return the next item whose deadline is passed, or None"""
+        if cur_time is None:
+            cur_time = time.time()
+        self._lock.acquire()
+        try:
+            self._drop_removed()
+            if not self._heap or self._heap[0][0] > cur_time:
+                return None
+            entry = heapq.heappop(self._heap)
+            del self._entries[entry[2]]
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def get_next_deadline(self):
+        """Return the deadline of the next item, or None if there is none"""
+        self._lock.acquire()
+        try:
+            self._drop_removed()
+            if not self._heap:
+                return None
+            return self._heap[0][0]
+        finally:
+            self._lock.release()
+
+    def remove(self, item_id):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(item_id, None)
+            if entry is None:
+                return False
+            entry[3] = _REMOVED
+            self._compact()
+            return True
+        finally:
+            self._lock.release()
+
+    def reschedule_all(self, deadline):
+        """Move the deadline of all the scheduled items"""
+        self._lock.acquire()
+        try:
+            self._heap = [entry for entry in self._heap if entry[3] is not _REMOVED]
+            for entry in self._heap:
+                entry[0] = deadline
+            heapq.heapify(self._heap)
+        finally:
+            self._lock.release()
+
+    def items(self):
+        """Return the scheduled items by deadline"""
+        self._lock.acquire()
+        try:
+            return [entry[3] for entry in sorted(self._entries.values())]
+        finally:
+            self._lock.release()
+
+    def __contains__(self, item_id):
+        return item_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop_removed(self):
+        # Must be called with the lock held
+        while self._heap and self._heap[0][3] is _REMOVED:
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        # Must be called with the lock held, drop the removed entries once they are the majority
+        if len(self._heap) > 2 * len(self._entries) + 100:
+            self._heap = [entry for entry in self._heap if entry[3] is not _REMOVED]
+            heapq.heapify(self._heap)
@@ -0,0 +1,157 @@
+"""Priority queue of the QueueManager, with at most one item by key."""
+
+from threading import Lock
+from itertools import count
+from time import time
+import heapq
+
+# Lower priorities are served first
+HIGH_PRIORITY = -10
+DEFAULT_PRIORITY = 0
+LOW_PRIORITY = 10
+
+DEFAULT_LANE = 'default'
+
+
+class SchedulerQueue(object):
+    """Queue of pairs with at most one item by row id, served by priority then in push order
+
+    Pushing a row id already queued replaces the queued item by the latest one,
+    keeping its place unless the new priority is better.
+    The optional key function orders the items of the same priority before the push
+    order, the optional lane function splits the items so get can serve only some lanes.
+    """
+
+    def __init__(self, key=None, lane=None):
+        self._key = key
+        self._lane = lane
+        self._lock = Lock()
+        # Heap of [priority, key, sequence, item, push time] by lane, the item is None once the entry is replaced or removed
+        self._heaps = dict()
+        # row id -> (lane, heap entry)
+        self._entries = dict()
+        # lane -> number of queued items
+        self._sizes = dict()
+        # lane -> [served items, total wait, max wait]
+        self._waits = dict()
+        self._sequence = count()
+        self.merged = 0
+
+    def put(self, item, priority=DEFAULT_PRIORITY):
+        """Queue the item, return False if it was merged with an already queued one"""
+        key = self._key(item) if self._key is not None else 0
+        lane = self._lane(item) if self._lane is not None else DEFAULT_LANE
+        self._lock.acquire()
+        try:
+            previous = self._entries.get(item.id)
+            if previous is None:
+                sequence = next(self._sequence)
+                push_time = time()
+            else:
+                self.merged += 1
+                previous_lane, entry = previous
+                if priority >= entry[0] and key == entry[1] and lane == previous_lane:
+                    entry[3] = item
+                    return False
+                # Reschedule with the better priority, or the new key or lane, keeping the waiting time
+                entry[3] = None
+                self._sizes[previous_lane] -= 1
+                if priority >= entry[0]:
+                    priority, sequence = entry[0], entry[2]
+                else:
+                    sequence = next(self._sequence)
+                push_time = entry[4]
+            entry = [priority, key, sequence, item, push_time]
+            self._entries[item.id] = (lane, entry)
+            self._sizes[lane] = self._sizes.get(lane, 0) + 1
+            heapq.heappush(self._heaps.setdefault(lane, []), entry)
+            return previous is None
+        finally:
+            self._lock.release()
+
+    def _get_head_lane(self, lanes):
+        best = None
+        for lane in (lanes if lanes is not None else self._heaps.keys()):
+            heap = self._heaps.get(lane)
+            while heap and heap[0][3] is None:
+                heapq.heappop(heap)
+            if heap and (best is None or heap[0] < self._heaps[best][0]):
+                best = lane
+        return best
+
+    def peek(self, lanes=None):
+        """Return the (priority, key, sequence) of the next item of the lanes, or None if they are empty"""
+        self._lock.acquire()
+        try:
+            lane = self._get_head_lane(lanes)
+            if lane is None:
+                return None
+            return tuple(self._heaps[lane][0][:3])
+        finally:
+            self._lock.release()
+
+    def get(self, lanes=None):
+        """Return the next item of the lanes, all by default, or None if they are empty"""
+        self._lock.acquire()
+        try:
+            lane = self._get_head_lane(lanes)
+            if lane is None:
+                return None
+            entry = heapq.heappop(self._heaps[lane])
+            item = entry[3]
+            del self._entries[item.id]
+            self._sizes[lane] -= 1
+            wait = time() - entry[4]
+            waits = self._waits.setdefault(lane, [0, 0.0, 0.0])
+            waits[0] += 1
+            waits[1] += wait
+            waits[2] = max(waits[2], wait)
+            return item
+        finally:
+            self._lock.release()
+
+    def remove(self, row_id):
+        self._lock.acquire()
+        try:
+            previous = self._entries.pop(row_id, None)
+            if previous is None:
+                return False
+            lane, entry = previous
+            entry[3] = None
+            self._sizes[lane] -= 1
+            # Drop the removed entries once they are the majority
+            heap = self._heaps[lane]
+            if len(heap) > 2 * self._sizes[lane] + 100:
+                heap = [entry for entry in heap if entry[3] is not None]
+                heapq.heapify(heap)
+                self._heaps[lane] = heap
+            return True
+        finally:
+            self._lock.release()
+
+    def __contains__(self, row_id):
+        return row_id in self._entries
+
+    def qsize(self, lanes=None):
+        if lanes is None:
+            return len(self._entries)
+        return sum([self._sizes.get(lane, 0) for lane in lanes])
+
+    def empty(self, lanes=None):
+        return self.qsize(lanes) == 0
+
+    def items(self):
+        """Return the queued items in the order they will be served"""
+        self._lock.acquire()
+        try:
+            return [entry[3] for _, entry in sorted(self._entries.values(), key=lambda value: value[1][:3])]
+        finally:
+            self._lock.release()
+
+    def get_waits(self):
+        """Return [served items, total wait, max wait] by lane, the waits being in seconds"""
+        self._lock.acquire()
+        try:
+            return dict([(lane, list(waits)) for lane, waits in self._waits.iteritems()])
+        finally:
+            self._lock.release()
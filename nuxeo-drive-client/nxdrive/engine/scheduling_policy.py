@@ -0,0 +1,81 @@
+"""Policies ordering the files to synchronize, and lanes by file size."""
+
+from nxdrive.engine.scheduler_queue import DEFAULT_LANE
+
+# Files up to this size go to the small file lane, the files of unknown size do not
+SMALL_FILE_SIZE = 1024 * 1024
+SMALL_FILE_LANE = 'small'
+
+
+def get_transfer_size(item):
+    """Return the bytes to transfer for the item, None if unknown"""
+    pair_state = getattr(item, 'pair_state', None)
+    if pair_state is not None and 'deleted' in pair_state:
+        # Nothing is transferred
+        return 0
+    return getattr(item, 'size', None)
+
+
+def get_file_lane(item, small_file_size=SMALL_FILE_SIZE):
+    size = get_transfer_size(item)
+    if size is not None and size <= small_file_size:
+        return SMALL_FILE_LANE
+    return DEFAULT_LANE
+
+
+class SchedulingPolicy(object):
+    """Files served in push order, from the longest of the local and remote queues"""
+    name = 'fifo'
+
+    def get_key(self, item):
+        """Order of the items of the same priority, before the push order"""
+        return 0
+
+    def select(self, queues, lanes=None):
+        """Return the queue to take the next file from, None if the lanes of all the queues are empty"""
+        selected = None
+        for queue in queues:
+            if queue.qsize(lanes) > (selected.qsize(lanes) if selected is not None else 0):
+                selected = queue
+        return selected
+
+    def _select_head(self, queues, lanes):
+        selected = None
+        selected_head = None
+        for queue in queues:
+            head = queue.peek(lanes)
+            if head is not None and (selected_head is None or head < selected_head):
+                selected, selected_head = queue, head
+        return selected
+
+
+class ShortestJobFirstPolicy(SchedulingPolicy):
+    """Smallest files first, so most of the files are visible sooner, the files of unknown size last"""
+    name = 'sjf'
+
+    def get_key(self, item):
+        size = get_transfer_size(item)
+        return (size is None, size or 0)
+
+    def select(self, queues, lanes=None):
+        return self._select_head(queues, lanes)
+
+
+class FolderLocalityPolicy(SchedulingPolicy):
+    """Files of the same folder one after the other, so each folder is complete sooner"""
+    name = 'folder'
+
+    def get_key(self, item):
+        return getattr(item, 'local_parent_path', None) or ''
+
+    def select(self, queues, lanes=None):
+        return self._select_head(queues, lanes)
+
+
+SCHEDULING_POLICIES = dict([(policy.name, policy) for policy in
+                            (SchedulingPolicy, ShortestJobFirstPolicy, FolderLocalityPolicy)])
+
+
+def get_scheduling_policy(name):
+    """Return an instance of the named policy, the default one if the name is unknown"""
+    return SCHEDULING_POLICIES.get(name, SchedulingPolicy)()
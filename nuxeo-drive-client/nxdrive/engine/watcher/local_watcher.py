@@ -9,14 +9,14 @@ from nxdrive.utils import current_milli_time
 from nxdrive.utils import is_office_temp_file
 from nxdrive.osi import AbstractOSIntegration
 from nxdrive.engine.activity import Action
-from Queue import Queue
+from Queue import Queue, LifoQueue
 import sys
 import os
 import re
 import sqlite3
-from time import sleep, time, mktime
+from time import time, mktime
 from datetime import datetime
-from threading import Lock
+from threading import Lock, Condition, Thread
 from PyQt4.QtCore import pyqtSignal, pyqtSlot
 log = get_logger(__name__)
 
@@ -35,7 +35,141 @@ def is_text_edit_tmp_file(name):
     return re.match(TEXT_EDIT_TMP_FILE_PATTERN, name)
 
 
+class LocalFolderLister(object):
+    '''
+    List the children of local folders on a pool of threads, ahead of the scan
+
+    The scan pushes the subfolders it is about to walk and gets back their
+    children by path. Requests are handled last in first out to follow the
+    depth-first order of the scan, so the subfolders should be pushed in reverse order.
+    At most max_listings listings are done ahead of the scan, the threads wait for
+    the scan to get them otherwise. A folder not yet taken by the threads is listed
+    by the scan itself.
+    Exceptions raised by the client are given back to the caller.
+    '''
+    def __init__(self, client, threads=4, max_listings=64):
+        self._client = client
+        self._max_listings = max(1, max_listings)
+        self._requests = LifoQueue()
+        self._results = dict()
+        self._listing = set()
+        self._pushed = set()
+        self._condition = Condition()
+        self._stopped = False
+        self._threads = []
+        for i in range(max(1, threads)):
+            thread = Thread(target=self._run, name="LocalFolderLister-%d" % i)
+            thread.daemon = True
+            self._threads.append(thread)
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped = True
+        with self._condition:
+            self._condition.notify_all()
+        for _ in self._threads:
+            self._requests.put(None)
+
+    def push(self, path):
+        with self._condition:
+            self._pushed.add(path)
+        self._requests.put(path)
+
+    def is_pushed(self, path):
+        return path in self._pushed
+
+    def get(self, path, timeout=0.1):
+        """Return the children info of a pushed path, None if still being listed"""
+        with self._condition:
+            if path in self._listing:
+                self._condition.wait(timeout)
+            if path in self._listing:
+                return None
+            self._pushed.discard(path)
+            result = self._results.pop(path, None)
+            # Room for the next listing
+            self._condition.notify_all()
+        if result is None:
+            # Not taken by the threads yet, dont wait for them
+            return self._client.get_children_info(path)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _run(self):
+        while not self._stopped:
+            path = self._requests.get()
+            if path is None:
+                break
+            with self._condition:
+                # Wait for the scan to get the listings done ahead
+                while len(self._results) + len(self._listing) >= self._max_listings and not self._stopped:
+                    self._condition.wait(0.1)
+                if self._stopped or path not in self._pushed:
+                    # Listed by the scan meanwhile
+                    continue
+                self._listing.add(path)
+            try:
+                result = self._client.get_children_info(path)
+            except Exception as e:
+                result = e
+            with self._condition:
+                self._listing.discard(path)
+                if path in self._pushed:
+                    self._results[path] = result
+                self._condition.notify_all()
+
+
+class LocalDigester(object):
+    '''
+    Compute the digest of local files on a pool of threads
+
+    The callback is called from a digester thread with the file info and its digest.
+    '''
+    def __init__(self, threads=2):
+        self._requests = Queue()
+        self._stopped = False
+        self._threads = []
+        for i in range(max(1, threads)):
+            thread = Thread(target=self._run, name="LocalDigester-%d" % i)
+            thread.daemon = True
+            self._threads.append(thread)
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped = True
+        for _ in self._threads:
+            self._requests.put(None)
+
+    def push(self, info, callback):
+        self._requests.put((info, callback))
+
+    def get_queue_size(self):
+        return self._requests.qsize()
+
+    def _run(self):
+        while not self._stopped:
+            request = self._requests.get()
+            if request is None:
+                break
+            info, callback = request
+            try:
+                callback(info, info.get_digest())
+            except Exception as e:
+                log.debug("Cannot update digest of %r: %r", info.path, e)
+
+
 class LocalWatcher(EngineWorker):
+    # Folders listed in parallel by the full scan, overridden by the local_scan_threads config
+    LOCAL_SCAN_THREADS = 4
+    # Threads computing the digests of new and modified files found by the scans
+    DIGEST_THREADS = 2
     localScanFinished = pyqtSignal()
     rootMoved = pyqtSignal(str)
     rootDeleted = pyqtSignal()
@@ -74,6 +208,8 @@ class LocalWatcher(EngineWorker):
         self._win_lock = Lock()
         self._delete_events = dict()
         self._folder_scan_events = dict()
+        self._lister = None
+        self._digester = None
 
     def set_windows_queue_threshold(self, size):
         self._windows_queue_threshold = size
@@ -100,6 +236,8 @@ class LocalWatcher(EngineWorker):
             if not self.client.exists('/'):
                 self.rootDeleted.emit()
                 return
+            self._digester = LocalDigester(self.DIGEST_THREADS)
+            self._digester.start()
             self._action = Action("Setup watchdog")
             self._watchdog_queue = Queue()
             self._setup_watchdog()
@@ -107,13 +245,11 @@ class LocalWatcher(EngineWorker):
             self._action = Action("Full local scan")
             self._scan()
             self._end_action()
-            # Check windows dequeue and folder scan only every 100 loops ( every 1s )
             current_time_millis = int(round(time() * 1000))
             self._win_delete_interval = current_time_millis
             self._win_folder_scan_interval = current_time_millis
             while (1):
                 self._interact()
-                sleep(0.01)
                 if trigger_local_scan:
                     self._action = Action("Full local scan")
                     self._scan()
@@ -134,12 +270,24 @@ class LocalWatcher(EngineWorker):
                     self._win_folder_scan_check()
                 self._win_delete_check()
                 self._win_folder_scan_check()
+                # Wait for the next watchdog event, the handler wakes the thread up
+                if not trigger_local_scan and self._watchdog_queue.empty():
+                    self._wait(self._get_wait_timeout())
 
         except ThreadInterrupt:
             raise
         finally:
+            if self._digester is not None:
+                self._digester.stop()
+                self._digester = None
             self._stop_watchdog()
 
+    def _get_wait_timeout(self):
+        # Windows delete and folder scan events are resolved after a delay, check them every second
+        if self._windows and (self._delete_events or self._folder_scan_events):
+            return 1
+        return None
+
     def win_queue_empty(self):
         return not self._delete_events
 
@@ -243,7 +391,13 @@ class LocalWatcher(EngineWorker):
         self._protected_files = dict()
 
         info = self.client.get_info(u'/')
-        self._scan_recursive(info)
+        self._lister = LocalFolderLister(self.client, self._get_local_scan_threads())
+        self._lister.start()
+        try:
+            self._scan_recursive(info)
+        finally:
+            self._lister.stop()
+            self._lister = None
         self._scan_handle_deleted_files()
         self._metrics['last_local_scan_time'] = current_milli_time() - start_ms
         log.debug("Full scan finished in %dms", self._metrics['last_local_scan_time'])
@@ -262,9 +416,51 @@ class LocalWatcher(EngineWorker):
         metrics = super(LocalWatcher, self).get_metrics()
         if self._event_handler is not None:
             metrics['fs_events'] = self._event_handler.counter
+        if self._digester is not None:
+            metrics['digest_queue'] = self._digester.get_queue_size()
+        metrics.update(self._engine.get_digest_cache().get_metrics())
         return dict(metrics.items() + self._metrics.items())
 
 
+    def _get_local_scan_threads(self):
+        return int(self._dao.get_config('local_scan_threads', self.LOCAL_SCAN_THREADS))
+
+    def _get_children_info(self, path):
+        if self._lister is None or not self._lister.is_pushed(path):
+            return self.client.get_children_info(path)
+        result = self._lister.get(path)
+        while result is None:
+            self._interact()
+            result = self._lister.get(path)
+        return result
+
+    def _insert_local_state(self, info, parent_path):
+        if self._digester is None or info.folderish:
+            return self._dao.insert_local_state(info, parent_path)
+        row_id = self._dao.insert_local_state(info, parent_path, compute_digest=False)
+        self._push_new_digest(row_id, info)
+        return row_id
+
+    def _push_new_digest(self, row_id, info):
+        self._digester.push(info, lambda info, digest: self._dao.update_local_digest(row_id, digest))
+
+    def _push_modified_digest(self, doc_pair, info):
+        pair_id = doc_pair.id
+        last_local_updated = doc_pair.last_local_updated
+
+        def update_modified_digest(info, digest):
+            doc_pair = self._dao.get_state_from_id(pair_id)
+            if (doc_pair is None or doc_pair.local_path != info.path
+                    or doc_pair.last_local_updated != last_local_updated):
+                # Removed, moved or modified again in the meantime, the watchdog handles the new event
+                return
+            # Even if a processor holds the pair: the new version makes its synchronization fail
+            if doc_pair.local_digest != digest:
+                doc_pair.local_digest = digest
+                doc_pair.local_state = 'modified'
+            self._dao.update_local_state(doc_pair, info)
+        self._digester.push(info, update_modified_digest)
+
     def _suspend_queue(self):
         self._engine.get_queue_manager().suspend()
         for processor in self._engine.get_queue_manager().get_processors_on('/', exact_match=False):
@@ -319,7 +515,7 @@ class LocalWatcher(EngineWorker):
         # detect recently deleted children
         log.trace('Starting to get FS children info for %r', info.path)
         try:
-            fs_children_info = self.client.get_children_info(info.path)
+            fs_children_info = self._get_children_info(info.path)
         except OSError:
             # The folder has been deleted in the mean time
             return
@@ -329,7 +525,7 @@ class LocalWatcher(EngineWorker):
         # or if it is just the result of a remote creation performed on the file system but not yet updated in the DB
         # as for its local information
         remote_children = []
-        parent_remote_id = self.client.get_remote_id(info.path)
+        parent_remote_id = info.remote_ref
         if parent_remote_id is not None:
             remote_children_pairs = self._dao.get_new_remote_children(parent_remote_id)
             for remote_child_pair in remote_children_pairs:
@@ -341,7 +537,8 @@ class LocalWatcher(EngineWorker):
             child_type = 'folder' if child_info.folderish else 'file'
             if child_name not in children:
                 try:
-                    remote_id = self.client.get_remote_id(child_info.path)
+                    # Read from the file attributes while listing the folder
+                    remote_id = child_info.remote_ref
                     if remote_id is None:
                         # Avoid IntegrityError: do not insert a new pair state if item is already referenced in the DB
                         if remote_children and child_name in remote_children:
@@ -350,7 +547,7 @@ class LocalWatcher(EngineWorker):
                             continue
                         log.debug("Found new %s %s", child_type, child_info.path)
                         self._metrics['new_files'] = self._metrics['new_files'] + 1
-                        self._dao.insert_local_state(child_info, info.path)
+                        self._insert_local_state(child_info, info.path)
                     else:
                         log.debug("Found potential moved file %s[%s]", child_info.path, remote_id)
                         doc_pair = self._dao.get_normal_state_from_remote(remote_id)
@@ -374,7 +571,7 @@ class LocalWatcher(EngineWorker):
                             log.debug("Can't find reference for %s in database, put it in locally_created state",
                                       child_info.path)
                             self._metrics['new_files'] = self._metrics['new_files'] + 1
-                            self._dao.insert_local_state(child_info, info.path)
+                            self._insert_local_state(child_info, info.path)
                             self._protected_files[remote_id] = True
                         elif doc_pair.processor > 0:
                             log.debug('Skip pair as it is being processed: %r', doc_pair)
@@ -402,7 +599,7 @@ class LocalWatcher(EngineWorker):
                                 # Local copy paste
                                 log.debug("Found a copy-paste of document")
                                 self.client.remove_remote_id(child_info.path)
-                                self._dao.insert_local_state(child_info, info.path)
+                                self._insert_local_state(child_info, info.path)
                             else:
                                 # Moved and renamed
                                 log.debug("Moved and renamed: %r", doc_pair)
@@ -461,7 +658,7 @@ class LocalWatcher(EngineWorker):
                                 continue
                             old_pair = self._dao.get_normal_state_from_remote(remote_ref)
                             if old_pair is None:
-                                self._dao.insert_local_state(child_info, info.path)
+                                self._insert_local_state(child_info, info.path)
                             else:
                                 old_pair.local_state = 'moved'
                                 # Check digest also
@@ -471,13 +668,21 @@ class LocalWatcher(EngineWorker):
                                 self._dao.update_local_state(old_pair, child_info)
                                 self._protected_files[old_pair.remote_ref] = True
                             self._delete_files[child_pair.remote_ref] = child_pair
+                        self._metrics['update_files'] = self._metrics['update_files'] + 1
+                        if not child_info.folderish and self._digester is not None:
+                            # Compare the digests in the background
+                            self._push_modified_digest(child_pair, child_info)
+                            continue
                         if not child_info.folderish:
                             digest = child_info.get_digest()
                             if child_pair.local_digest != digest:
                                 child_pair.local_digest = digest
                                 child_pair.local_state = 'modified'
-                        self._metrics['update_files'] = self._metrics['update_files'] + 1
                         self._dao.update_local_state(child_pair, child_info)
+                    elif (child_pair.local_digest is None and child_pair.pair_state == 'locally_created'
+                            and not child_info.folderish and self._digester is not None):
+                        # Digest not computed before the previous stop of the watcher
+                        self._push_new_digest(child_pair.id, child_info)
                     if child_info.folderish:
                         to_scan.append(child_info)
                 except Exception as e:
@@ -496,6 +701,10 @@ class LocalWatcher(EngineWorker):
             else:
                 self._delete_files[deleted.remote_ref] = deleted
 
+        if self._lister is not None:
+            for child_info in reversed(to_scan_new + to_scan if recursive else to_scan_new):
+                self._lister.push(child_info.path)
+
         for child_info in to_scan_new:
             self._push_to_scan(child_info)
 
@@ -539,16 +748,16 @@ class LocalWatcher(EngineWorker):
 
     def _check_watchdog(self):
         # Be sure to have at least one watchdog event
-        timeout = 30
+        timeout = time() + 30
         lock = self.client.unlock_ref('/', False)
         try:
             fname = self.client._abspath('/.watchdog_setup')
             while (self._watchdog_queue.empty()):
                 with open(fname, 'a'):
                     os.utime(fname, None)
-                sleep(1)
-                timeout -= 1
-                if timeout < 0:
+                # Woken up by the event handler
+                self._wait(1)
+                if self._watchdog_queue.empty() and time() > timeout:
                     log.debug("Can't have watchdog setup. Fallback to full scan mode ?")
                     os.remove(fname)
                     raise Exception
@@ -938,6 +1147,7 @@ class DriveFSEventHandler(FileSystemEventHandler):
         self.counter = self.counter + 1
         log.trace("Queueing watchdog: %r", event)
         self.watcher._watchdog_queue.put(event)
+        self.watcher.wake_up()
 
 
 class DriveFSRootEventHandler(FileSystemEventHandler):
@@ -0,0 +1,89 @@
+"""Interval of the remote polls adapted to the change activity."""
+
+from bisect import bisect_left
+from threading import Lock
+import time
+
+
+class PollScheduler(object):
+    '''
+    Interval between two polls of the remote change summary
+
+    After remote changes or a local upload, which may trigger follow-up events
+    on the server, the polls use min_interval for active_period seconds.
+    Then they use the base interval, until no activity was seen for
+    idle_period seconds: the interval is then doubled on each empty poll, up to
+    max_interval.
+    '''
+    def __init__(self, interval, min_interval=5, max_interval=300, active_period=60, idle_period=600):
+        self.interval = interval
+        self.min_interval = min(min_interval, interval)
+        self.max_interval = max(max_interval, interval)
+        self.active_period = active_period
+        self.idle_period = idle_period
+        self._last_activity = None
+        self._idle_polls = 0
+
+    def notify_activity(self, cur_time=None):
+        """Remote changes were found or a local change was uploaded"""
+        self._last_activity = time.time() if cur_time is None else cur_time
+        self._idle_polls = 0
+
+    def notify_empty_poll(self, cur_time=None):
+        if cur_time is None:
+            cur_time = time.time()
+        if self._last_activity is None:
+            # Count the idle time from the first poll
+            self._last_activity = cur_time
+        elif cur_time - self._last_activity >= self.idle_period:
+            self._idle_polls += 1
+
+    def get_interval(self, cur_time=None):
+        """Return the delay in seconds before the next poll"""
+        if cur_time is None:
+            cur_time = time.time()
+        if self._last_activity is not None and cur_time - self._last_activity < self.active_period:
+            return self.min_interval
+        if self._idle_polls == 0:
+            return self.interval
+        # Avoid computing huge powers after days of idleness
+        return min(self.max_interval, self.interval * 2 ** min(self._idle_polls, 32))
+
+
+class LatencyHistogram(object):
+    '''
+    Count of the measured latencies by bucket, a bucket being named by its upper bound in seconds
+    '''
+    BOUNDS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self, bounds=BOUNDS):
+        self._lock = Lock()
+        self._bounds = tuple(bounds)
+        # One more bucket for the latencies above the last bound
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._total = 0
+        self._sum = 0
+
+    def add(self, latency):
+        # A server clock ahead of the local one gives negative latencies
+        latency = max(0, latency)
+        self._lock.acquire()
+        try:
+            self._counts[bisect_left(self._bounds, latency)] += 1
+            self._total += 1
+            self._sum += latency
+        finally:
+            self._lock.release()
+
+    def get_metrics(self):
+        self._lock.acquire()
+        try:
+            buckets = dict([('<=%d' % bound, count) for bound, count in zip(self._bounds, self._counts)])
+            buckets['>%d' % self._bounds[-1]] = self._counts[-1]
+            return {
+                'buckets': buckets,
+                'count': self._total,
+                'average': float(self._sum) / self._total if self._total else 0,
+            }
+        finally:
+            self._lock.release()
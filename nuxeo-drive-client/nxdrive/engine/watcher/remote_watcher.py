@@ -7,16 +7,19 @@ from nxdrive.logging_config import get_logger
 from nxdrive.engine.workers import EngineWorker
 from nxdrive.utils import current_milli_time
 from nxdrive.client import NotFound
-from time import sleep
 from datetime import datetime
 from nxdrive.client.common import COLLECTION_SYNC_ROOT_FACTORY_NAME
-from nxdrive.client.remote_file_system_client import RemoteFileInfo
 from nxdrive.engine.activity import Action
 from nxdrive.client.common import safe_filename
 from nxdrive.client.base_automation_client import Unauthorized
-from nxdrive.utils import path_join
+from nxdrive.utils import path_join, get_remote_ref_suffixes
+from nxdrive.engine.dao.sqlite import BATCH_QUERY_SIZE
+from nxdrive.engine.watcher.poll_scheduler import PollScheduler, LatencyHistogram
 from httplib import BadStatusLine
 from urllib2 import HTTPError, URLError
+from Queue import Queue, Empty, Full
+from threading import Thread
+from time import time
 import os
 import socket
 log = get_logger(__name__)
@@ -24,7 +27,213 @@ from PyQt4.QtCore import pyqtSignal, pyqtSlot
 from nxdrive.engine.workers import ThreadInterrupt
 
 
+class ScrollFetcher(object):
+    '''
+    Fetch the scroll pages of a remote folder in a background thread
+
+    At most max_pages pages are fetched in advance, the fetch thread waits for
+    the consumer otherwise. The batch size adapts to the server response time.
+    Exceptions raised by the client are given back to the consumer.
+    '''
+    def __init__(self, client, uid, batch_size=100, min_batch_size=50, max_batch_size=1000, target_time=2,
+                 max_pages=2):
+        self._client = client
+        self._uid = uid
+        self.batch_size = batch_size
+        self._min_batch_size = min_batch_size
+        self._max_batch_size = max_batch_size
+        self._target_time = target_time
+        self._queue = Queue(maxsize=max_pages)
+        self._stopped = False
+        self._thread = Thread(target=self._run, name="ScrollFetcher-%s" % uid)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+
+    def get(self, timeout=0.1):
+        """Return the next (descendants, elapsed_seconds) page, None if not yet fetched"""
+        try:
+            page = self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+        if isinstance(page, Exception):
+            raise page
+        return page
+
+    def _adapt_batch_size(self, elapsed, count):
+        # Only grow on a full page: a partial one means the end of the scroll
+        if elapsed < self._target_time / 2.0 and count >= self.batch_size:
+            self.batch_size = min(self.batch_size * 2, self._max_batch_size)
+        elif elapsed > self._target_time:
+            self.batch_size = max(self.batch_size / 2, self._min_batch_size)
+
+    def _put(self, page):
+        # Block while the consumer is behind, unless stopped
+        while not self._stopped:
+            try:
+                self._queue.put(page, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _run(self):
+        scroll_id = None
+        try:
+            while not self._stopped:
+                log.trace('Scrolling through at most [%d] descendants of %s', self.batch_size, self._uid)
+                start = time()
+                scroll_res = self._client.scroll_descendants(self._uid, scroll_id, batch_size=self.batch_size)
+                elapsed = time() - start
+                descendants = scroll_res['descendants']
+                self._put((descendants, elapsed))
+                if not descendants:
+                    break
+                self._adapt_batch_size(elapsed, len(descendants))
+                scroll_id = scroll_res['scroll_id']
+        except Exception as e:
+            self._put(e)
+
+
+class RemoteFolderCrawler(object):
+    '''
+    Fetch the children of remote folders on a pool of threads, each having its own client
+
+    The threads and their clients are kept until stopped, to be reused by the
+    next scans. Results are returned in completion order, the caller is
+    responsible for pushing a folder only once its parent has been handled.
+    Exceptions raised by the client are given back to the caller.
+    '''
+    def __init__(self, client_factory, threads=4):
+        self._client_factory = client_factory
+        self._requests = Queue()
+        self._results = Queue()
+        self._stopped = False
+        # Incremented to forget the requests of an aborted scan
+        self._generation = 0
+        # Incremented to create new clients, like after a credentials update
+        self._client_generation = 0
+        self._threads = []
+        for i in range(max(1, threads)):
+            thread = Thread(target=self._run, args=(i,), name="RemoteFolderCrawler-%d" % i)
+            thread.daemon = True
+            self._threads.append(thread)
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped = True
+        for _ in self._threads:
+            self._requests.put(None)
+
+    def push(self, key, uid):
+        self._requests.put((self._generation, key, uid))
+
+    def get(self, timeout=0.1):
+        """Return the next (key, children_info) result, None if none is available yet"""
+        while True:
+            try:
+                generation, key, result = self._results.get(timeout=timeout)
+            except Empty:
+                return None
+            if generation == self._generation:
+                break
+        if isinstance(result, Exception):
+            raise result
+        return key, result
+
+    def cancel(self):
+        """Forget the pending requests and their results"""
+        self._generation += 1
+
+    def reset_clients(self):
+        self._client_generation += 1
+
+    def _run(self, index):
+        client = None
+        client_generation = None
+        while not self._stopped:
+            request = self._requests.get()
+            if request is None:
+                break
+            generation, key, uid = request
+            if generation != self._generation:
+                continue
+            try:
+                if client is None or client_generation != self._client_generation:
+                    client_generation = self._client_generation
+                    client = self._client_factory(index)
+                result = client.get_children_info(uid)
+            except Exception as e:
+                result = e
+            self._results.put((generation, key, result))
+
+
+class RemoteStatesCache(object):
+    """States of the remote refs of a change summary, fetched by batch
+
+    The states of a ref are fetched again from the DAO once invalidated,
+    and all of them once the descendants of a folder may have been updated.
+    The refs without factory name are matched one by one, then once for the rest
+    of the summary when more than PARTIAL_SCAN_THRESHOLD of them are looked up, as
+    matching all of them scans the whole table. The processors update the states
+    meanwhile: they must be read again by id before being updated.
+    """
+    # A match of all the refs costs about as much as this number of matches of one ref
+    PARTIAL_SCAN_THRESHOLD = 16
+
+    def __init__(self, dao, partial_refs):
+        self._dao = dao
+        self._states = dict()
+        self._partial_refs = partial_refs
+        self._partial_states = None
+        self._partial_lookups = 0
+
+    def prefetch(self, refs):
+        self._states = self._dao.get_states_from_remotes(refs)
+
+    def get_states(self, ref):
+        states = self._states.get(ref)
+        if states is None:
+            states = self._dao.get_states_from_remote(ref)
+        return states
+
+    def get_first_partial_state(self, ref):
+        if self._partial_states is None:
+            self._partial_lookups += 1
+            if self._partial_lookups <= self.PARTIAL_SCAN_THRESHOLD:
+                return self._dao.get_first_state_from_partial_remote(ref)
+            self._partial_states = self._dao.get_first_states_from_partial_remotes(self._partial_refs)
+        if ref not in self._partial_states:
+            return self._dao.get_first_state_from_partial_remote(ref)
+        return self._partial_states[ref]
+
+    def invalidate(self, ref):
+        self._states.pop(ref, None)
+        if self._partial_states is not None:
+            for suffix in get_remote_ref_suffixes(ref):
+                self._partial_states.pop(suffix, None)
+
+    def clear(self):
+        self._states = dict()
+
+
 class RemoteWatcher(EngineWorker):
+    SCROLL_BATCH_SIZE = 100
+    SCROLL_MIN_BATCH_SIZE = 50
+    SCROLL_MAX_BATCH_SIZE = 1000
+    # Expected time in seconds for a scroll request
+    SCROLL_TARGET_TIME = 2
+    # Folders fetched in parallel by the recursive scan, overridden by the remote_scan_threads config
+    REMOTE_SCAN_THREADS = 4
+    # Bounds of the polling interval, overridden by the remote_poll_min_interval and remote_poll_max_interval config
+    POLL_MIN_INTERVAL = 5
+    POLL_MAX_INTERVAL = 300
     initiate = pyqtSignal()
     updated = pyqtSignal()
     remoteScanFinished = pyqtSignal()
@@ -37,7 +246,14 @@ class RemoteWatcher(EngineWorker):
         self.server_interval = delay
         # Review to delete
         self._init()
-        self._current_interval = 0
+        # Time of the next poll, 0 to poll as soon as possible
+        self._next_poll = 0
+        # Adapted on each scroll, kept for the next one
+        self._scroll_batch_size = self.SCROLL_BATCH_SIZE
+        # Time between the server events and their detection
+        self._detection_latency = LatencyHistogram()
+        # Created on the first recursive scan of several folders
+        self._crawler = None
 
     def _init(self):
         self.unhandle_fs_event = False
@@ -53,6 +269,11 @@ class RemoteWatcher(EngineWorker):
         self._metrics['last_remote_scan_time'] = -1
         self._metrics['last_remote_update_time'] = -1
         self._metrics['empty_polls'] = 0
+        self._poll_scheduler = PollScheduler(self.server_interval,
+                                             min_interval=int(self._dao.get_config('remote_poll_min_interval',
+                                                                                   self.POLL_MIN_INTERVAL)),
+                                             max_interval=int(self._dao.get_config('remote_poll_max_interval',
+                                                                                   self.POLL_MAX_INTERVAL)))
 
     def get_engine(self):
         return self._engine
@@ -63,12 +284,17 @@ class RemoteWatcher(EngineWorker):
         metrics['last_event_log_id'] = self._last_event_log_id
         metrics['last_root_definitions'] = self._last_root_definitions
         metrics['last_remote_full_scan'] = self._last_remote_full_scan
-        metrics['next_polling'] = self._current_interval
+        # In hundredths of second
+        metrics['next_polling'] = int(max(0, self._next_poll - time()) * 100)
+        metrics['polling_interval'] = self._poll_scheduler.get_interval()
+        metrics['detection_latency'] = self._detection_latency.get_metrics()
         return dict(metrics.items() + self._metrics.items())
 
     @pyqtSlot()
     def _reset_clients(self):
         self._client = None
+        if self._crawler is not None:
+            self._crawler.reset_clients()
 
     def _execute(self):
         first_pass = True
@@ -76,17 +302,21 @@ class RemoteWatcher(EngineWorker):
             self._init()
             while (1):
                 self._interact()
-                if self._current_interval == 0:
-                    #
-                    self._current_interval = self.server_interval * 100
+                if self._next_poll <= time():
+                    start = time()
+                    # Scheduled once the changes are handled, unless a poll is requested meanwhile
+                    self._next_poll = start + self._poll_scheduler.max_interval
                     if self._handle_changes(first_pass):
                         first_pass = False
-                else:
-                    self._current_interval = self._current_interval - 1
-                sleep(0.01)
+                    self._next_poll = min(self._next_poll, start + self._poll_scheduler.get_interval())
+                self._wait(self._next_poll - time())
         except ThreadInterrupt:
             self.remoteWatcherStopped.emit()
             raise
+        finally:
+            if self._crawler is not None:
+                self._crawler.stop()
+                self._crawler = None
 
     def _scan_remote(self, from_state=None):
         """Recursively scan the bound remote folder looking for updates"""
@@ -119,7 +349,17 @@ class RemoteWatcher(EngineWorker):
     @pyqtSlot(str)
     def scan_pair(self, remote_path):
         self._dao.add_path_to_scan(str(remote_path))
-        self._current_interval = 0
+        self._next_poll = 0
+        self.wake_up()
+
+    @pyqtSlot(object, object)
+    def pair_synchronized(self, doc_pair, metrics):
+        if not metrics.get('handler', '').startswith('locally_'):
+            return
+        # The server can send follow-up events for the uploaded document, like its conversions
+        self._poll_scheduler.notify_activity()
+        self._next_poll = min(self._next_poll, time() + self._poll_scheduler.get_interval())
+        self.wake_up()
 
     def _scan_pair(self, remote_path):
         if remote_path is None:
@@ -202,76 +442,89 @@ class RemoteWatcher(EngineWorker):
             descendants[descendant.remote_ref] = descendant
 
         to_process = []
-        scroll_id = None
-        # TODO: configurable?
-        batch_size = 100
-        t1 = None
-        while True:
-            t0 = datetime.now()
-            if t1 is not None:
+        fetcher = ScrollFetcher(self._client, remote_info.uid, batch_size=self._scroll_batch_size,
+                                min_batch_size=self.SCROLL_MIN_BATCH_SIZE, max_batch_size=self.SCROLL_MAX_BATCH_SIZE,
+                                target_time=self.SCROLL_TARGET_TIME)
+        fetcher.start()
+        try:
+            while True:
+                # Wait for the next page while handling the thread suspension
+                page = fetcher.get()
+                while page is None:
+                    self._interact()
+                    page = fetcher.get()
+                descendants_info, elapsed = page
+                if not descendants_info:
+                    log.trace('Remote scroll request retrieved no descendants of %s (%s), took %d ms',
+                              remote_info.name, remote_info.uid, elapsed * 1000)
+                    break
+                log.trace('Remote scroll request retrieved %d descendants of %s (%s), took %d ms',
+                          len(descendants_info), remote_info.name, remote_info.uid, elapsed * 1000)
+                t0 = datetime.now()
+                # Results are not necessarily sorted
+                descendants_info = sorted(descendants_info, key=lambda x: x.path, reverse=False)
+                # Handle descendants, one transaction per batch
+                self._dao.begin_transaction()
+                try:
+                    for descendant_info in descendants_info:
+                        log.trace('Handling remote descendant: %r', descendant_info)
+                        descendant_pair = None
+                        if descendant_info.uid in descendants:
+                            descendant_pair = descendants.pop(descendant_info.uid)
+                            if self._check_modified(descendant_pair, descendant_info):
+                                descendant_pair.remote_state = 'modified'
+                            self._dao.update_remote_state(descendant_pair, descendant_info)
+                        else:
+                            parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
+                            if parent_pair is None:
+                                log.trace('Cannot find parent pair of remote descendant, postponing processing of %s',
+                                          descendant_info)
+                                to_process.append(descendant_info)
+                                continue
+                            descendant_pair, _ = self._find_remote_child_match_or_create(parent_pair, descendant_info)
+                        if descendant_info.folderish:
+                            self._dao.add_path_scanned(descendant_pair.remote_parent_path + '/'
+                                                       + descendant_pair.remote_ref)
+                finally:
+                    self._dao.end_transaction()
                 log.trace('Local processing of descendants of %s (%s) took %s ms', remote_info.name, remote_info.uid,
-                          self._get_elapsed_time_milliseconds(t1, t0))
-            # Scroll through a batch of descendants
-            log.trace('Scrolling through at most [%d] descendants of %s (%s)', batch_size, remote_info.name,
-                      remote_info.uid)
-            scroll_res = self._client.scroll_descendants(remote_info.uid, scroll_id, batch_size=batch_size)
-            t1 = datetime.now()
-            elapsed = self._get_elapsed_time_milliseconds(t0, t1)
-            descendants_info = scroll_res['descendants']
-            if not descendants_info:
-                log.trace('Remote scroll request retrieved no descendants of %s (%s), took %s ms', remote_info.name,
-                          remote_info.uid, elapsed)
-                break
-            log.trace('Remote scroll request retrieved %d descendants of %s (%s), took %s ms', len(descendants_info),
-                      remote_info.name, remote_info.uid, elapsed)
-            scroll_id = scroll_res['scroll_id']
-            # Results are not necessarily sorted
-            descendants_info = sorted(descendants_info, key=lambda x: x.path, reverse=False)
-            # Handle descendants
-            for descendant_info in descendants_info:
-                log.trace('Handling remote descendant: %r', descendant_info)
-                descendant_pair = None
-                if descendant_info.uid in descendants:
-                    descendant_pair = descendants.pop(descendant_info.uid)
-                    if self._check_modified(descendant_pair, descendant_info):
-                        descendant_pair.remote_state = 'modified'
-                    self._dao.update_remote_state(descendant_pair, descendant_info)
-                else:
-                    parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
-                    if parent_pair is None:
-                        log.trace('Cannot find parent pair of remote descendant, postponing processing of %s',
-                                  descendant_info)
-                        to_process.append(descendant_info)
-                        continue
-                    descendant_pair, _ = self._find_remote_child_match_or_create(parent_pair, descendant_info)
-                if descendant_info.folderish:
-                    self._dao.add_path_scanned(descendant_pair.remote_parent_path + '/' + descendant_pair.remote_ref)
-            # Check if synchronization thread was suspended
-            self._interact()
+                          self._get_elapsed_time_milliseconds(t0, datetime.now()))
+                # Check if synchronization thread was suspended
+                self._interact()
+        finally:
+            fetcher.stop()
+        self._scroll_batch_size = fetcher.batch_size
 
         if to_process:
             t0 = datetime.now()
             to_process = sorted(to_process, key=lambda x: x.path, reverse=False)
             log.trace('Processing [%d] postponed descendants of %s (%s)', len(to_process), remote_info.name,
                       remote_info.uid)
-            for descendant_info in to_process:
-                parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
-                if parent_pair is None:
-                    log.error("Cannot find parent pair of postponed remote descendant, ignoring %s", descendant_info)
-                    continue
-                descendant_pair, _ = self._find_remote_child_match_or_create(parent_pair, descendant_info)
-                if descendant_info.folderish:
-                    self._dao.add_path_scanned(descendant_pair.remote_parent_path + '/' + descendant_pair.remote_ref)
+            self._dao.begin_transaction()
+            try:
+                for descendant_info in to_process:
+                    parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
+                    if parent_pair is None:
+                        log.error("Cannot find parent pair of postponed remote descendant, ignoring %s", descendant_info)
+                        continue
+                    descendant_pair, _ = self._find_remote_child_match_or_create(parent_pair, descendant_info)
+                    if descendant_info.folderish:
+                        self._dao.add_path_scanned(descendant_pair.remote_parent_path + '/' + descendant_pair.remote_ref)
+            finally:
+                self._dao.end_transaction()
             t1 = datetime.now()
             log.trace('Postponed descendants processing took %s ms', self._get_elapsed_time_milliseconds(t0, t1))
 
         # Delete remaining
-        for deleted in descendants.values():
-            # TODO Should be DAO
-            # self._dao.mark_descendants_remotely_deleted(deleted)
-            self._dao.delete_remote_state(deleted)
-
-        self._dao.add_path_scanned(remote_parent_path)
+        self._dao.begin_transaction()
+        try:
+            for deleted in descendants.values():
+                # TODO Should be DAO
+                # self._dao.mark_descendants_remotely_deleted(deleted)
+                self._dao.delete_remote_state(deleted)
+            self._dao.add_path_scanned(remote_parent_path)
+        finally:
+            self._dao.end_transaction()
 
     def _get_elapsed_time_milliseconds(self, t0, t1):
         delta = t1 - t0
@@ -283,6 +536,8 @@ class RemoteWatcher(EngineWorker):
 
         If force_recursion is True, recursion is done even on
         non newly created children.
+        The children of several folders are fetched in parallel, a folder is
+        only fetched once its parent has been applied to the database.
         """
         remote_parent_path = self._init_scan_remote(doc_pair, remote_info)
         if remote_parent_path is None:
@@ -300,37 +555,93 @@ class RemoteWatcher(EngineWorker):
             log.trace("Skip remote scan as mark_unknown: %r", doc_pair)
             pass
 
+        # Folders being fetched by remote parent path
+        folders = dict()
+        folders[remote_parent_path] = doc_pair
+        # Folders not yet fetched
+        pending = [(remote_parent_path, remote_info.uid)]
+        crawler = None
+        try:
+            while folders:
+                if len(folders) == 1 and pending:
+                    # Only one folder to scan, no need for the crawler
+                    folder_path, uid = pending.pop()
+                    children_info = self._client.get_children_info(uid)
+                else:
+                    crawler = self._get_crawler()
+                    for folder_path, uid in pending:
+                        crawler.push(folder_path, uid)
+                    pending = []
+                    result = crawler.get()
+                    while result is None:
+                        self._interact()
+                        result = crawler.get()
+                    folder_path, children_info = result
+                folder_pair = folders.pop(folder_path)
+                to_scan = self._update_remote_children(folder_pair, folder_path, children_info, force_recursion)
+                self._dao.add_path_scanned(folder_path)
+                for child_pair, child_info in to_scan:
+                    if child_info.can_scroll_descendants:
+                        self._do_scan_remote(child_pair, child_info, force_recursion=force_recursion,
+                                             mark_unknown=False)
+                        continue
+                    child_path = self._init_scan_remote(child_pair, child_info)
+                    if child_path is None:
+                        continue
+                    folders[child_path] = child_pair
+                    pending.append((child_path, child_info.uid))
+                # Check if synchronization thread was suspended
+                self._interact()
+        finally:
+            if crawler is not None:
+                # Dont let the requests of an aborted scan to the next one
+                crawler.cancel()
+
+    def _update_remote_children(self, doc_pair, remote_parent_path, children_info, force_recursion=True):
         # Detect recently deleted children
         db_children = self._dao.get_remote_children(doc_pair.remote_ref)
-        children_info = self._client.get_children_info(remote_info.uid)
         children = dict()
         to_scan = []
         for child in db_children:
             children[child.remote_ref] = child
 
-        for child_info in children_info:
-            log.trace('Scanning remote child: %r', child_info)
-            child_pair = None
-            new_pair = False
-            if child_info.uid in children:
-                child_pair = children.pop(child_info.uid)
-                if self._check_modified(child_pair, child_info):
-                    child_pair.remote_state = 'modified'
-                self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
-            else:
-                child_pair, new_pair = self._find_remote_child_match_or_create(doc_pair, child_info)
-            if ((new_pair or force_recursion) and child_info.folderish):
-                    to_scan.append((child_pair, child_info))
-        # Delete remaining
-        for deleted in children.values():
-            # TODO Should be DAO
-            # self._dao.mark_descendants_remotely_deleted(deleted)
-            self._dao.delete_remote_state(deleted)
+        # Apply the children of this folder in one transaction
+        self._dao.begin_transaction()
+        try:
+            for child_info in children_info:
+                log.trace('Scanning remote child: %r', child_info)
+                child_pair = None
+                new_pair = False
+                if child_info.uid in children:
+                    child_pair = children.pop(child_info.uid)
+                    if self._check_modified(child_pair, child_info):
+                        child_pair.remote_state = 'modified'
+                    self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
+                else:
+                    child_pair, new_pair = self._find_remote_child_match_or_create(doc_pair, child_info)
+                if ((new_pair or force_recursion) and child_info.folderish):
+                        to_scan.append((child_pair, child_info))
+            # Delete remaining
+            for deleted in children.values():
+                # TODO Should be DAO
+                # self._dao.mark_descendants_remotely_deleted(deleted)
+                self._dao.delete_remote_state(deleted)
+        finally:
+            self._dao.end_transaction()
+        return to_scan
+
+    def _get_remote_scan_threads(self):
+        return int(self._dao.get_config('remote_scan_threads', self.REMOTE_SCAN_THREADS))
 
-        for folder in to_scan:
-            # TODO Optimize by multithreading this too ?
-            self._do_scan_remote(folder[0], folder[1], force_recursion=force_recursion, mark_unknown=False)
-        self._dao.add_path_scanned(remote_parent_path)
+    def _get_crawler(self):
+        if self._crawler is None:
+            self._crawler = RemoteFolderCrawler(self._get_crawler_client, self._get_remote_scan_threads())
+            self._crawler.start()
+        return self._crawler
+
+    def _get_crawler_client(self, index):
+        # Each thread needs its own connection
+        return self._engine.create_remote_client()
 
     def _init_scan_remote(self, doc_pair, remote_info):
         if remote_info is None:
@@ -391,8 +702,6 @@ class RemoteWatcher(EngineWorker):
                         self._engine.stop_processor_on(child_pair.local_path)
                     # Push the remote_Id
                     self._local_client.set_remote_id(local_path, child_info.uid)
-                    if child_pair.folderish:
-                        self._dao.queue_children(child_pair)
                 else:
                     child_pair.remote_state = 'modified'
                     self._dao.update_remote_state(child_pair, child_info, remote_parent_path=remote_parent_path)
@@ -525,6 +834,32 @@ class RemoteWatcher(EngineWorker):
         else:
             self._do_scan_remote(doc_pair, remote_info, force_recursion=force_recursion, moved=moved)
 
+    def _get_changes_refs(self, changes):
+        """Return the refs looked up by the changes: their documents and the parents of the new ones"""
+        refs = set()
+        for change in changes:
+            refs.add(change['fileSystemItemId'])
+            new_info = change.get('fileSystemItem')
+            if new_info is not None and new_info.parent_uid:
+                refs.add(new_info.parent_uid)
+        return refs
+
+    def _invalidate_states(self, states, doc_pair):
+        if doc_pair.folderish:
+            # The descendants are deleted too
+            states.clear()
+        else:
+            states.invalidate(doc_pair.remote_ref)
+
+    def _is_under_paths(self, path, parent_paths):
+        """Check if one of the ancestors of path is in parent_paths, given with a trailing '/'"""
+        index = path.find('/')
+        while index != -1:
+            if path[:index + 1] in parent_paths:
+                return True
+            index = path.find('/', index + 1)
+        return False
+
     def _update_remote_states(self):
         """Incrementally update the state of documents from a change summary"""
         summary = self._get_changes()
@@ -542,51 +877,63 @@ class RemoteWatcher(EngineWorker):
             log.debug("%d remote changes detected", n_changes)
             self._metrics['last_changes'] = n_changes
             self._metrics['empty_polls'] = 0
+            self._poll_scheduler.notify_activity()
             self.changesFound.emit(n_changes)
         else:
             self._metrics['empty_polls'] = self._metrics['empty_polls'] + 1
+            self._poll_scheduler.notify_empty_poll()
             self.noChangesFound.emit()
+        detection_time = time()
+        for change in sorted_changes:
+            # Event dates are in milliseconds
+            self._detection_latency.add(detection_time - change['eventDate'] / 1000.0)
 
         # Scan events and update the related pair states
+        # Refs of the processed changes, with their suffixes to match the refs without factory name
         refreshed = set()
         delete_queue = []
-        for change in sorted_changes:
+        # Only the deletions need a fresh match of the refs without factory name
+        states = RemoteStatesCache(self._dao, set([change['fileSystemItemId'] for change in sorted_changes
+                                                   if change.get('fileSystemItem')]))
+        for index, change in enumerate(sorted_changes):
 
             # Check if synchronization thread was suspended
             # TODO In case of pause or stop: save the last event id
             self._interact()
 
+            if index % BATCH_QUERY_SIZE == 0:
+                # Fetch the states of the next changes at once, by batch as the processors update them meanwhile
+                states.prefetch(self._get_changes_refs(sorted_changes[index:index + BATCH_QUERY_SIZE]))
             eventId = change.get('eventId')
             remote_ref = change['fileSystemItemId']
-            processed = False
-            for refreshed_ref in refreshed:
-                if refreshed_ref.endswith(remote_ref):
-                    processed = True
-                    break
-            if processed:
+            if remote_ref in refreshed:
                 # A more recent version was already processed
                 continue
-            fs_item = change.get('fileSystemItem')
-            new_info = self._client.file_to_info(fs_item) if fs_item else None
+            # Already converted to a RemoteFileInfo while decoding the summary
+            new_info = change.get('fileSystemItem')
             log.trace("Processing event: %r", change)
             # Possibly fetch multiple doc pairs as the same doc can be synchronized at 2 places,
             # typically if under a sync root and locally edited.
             # See https://jira.nuxeo.com/browse/NXDRIVE-125
-            doc_pairs = self._dao.get_states_from_remote(remote_ref)
+            doc_pairs = states.get_states(remote_ref)
             if not doc_pairs:
                 # Relax constraint on factory name in FileSystemItem id to
                 # match 'deleted' or 'securityUpdated' events.
                 # See https://jira.nuxeo.com/browse/NXDRIVE-167
-                doc_pair = self._dao.get_first_state_from_partial_remote(remote_ref)
+                doc_pair = states.get_first_partial_state(remote_ref)
                 if doc_pair is not None:
                     doc_pairs = [doc_pair]
 
             updated = False
             if doc_pairs:
                 for doc_pair in doc_pairs:
+                    # Fetched before the previous changes and their remote scans, get its current state
+                    doc_pair = self._dao.get_state_from_id(doc_pair.id)
+                    if doc_pair is None:
+                        continue
                     doc_pair_repr = doc_pair.local_path if doc_pair.local_path is not None else doc_pair.remote_name
                     if eventId == 'deleted':
-                        if fs_item is None:
+                        if new_info is None:
                             log.debug("Push doc_pair '%s' in delete queue",
                                       doc_pair_repr)
                             delete_queue.append(doc_pair)
@@ -595,13 +942,14 @@ class RemoteWatcher(EngineWorker):
                             # To ignore completely put updated to true
                             updated = True
                             break
-                    elif fs_item is None:
+                    elif new_info is None:
                         if eventId == 'securityUpdated':
                             log.debug("Security has been updated for"
                                       " doc_pair '%s' denying Read access,"
                                       " marking it as deleted",
                                       doc_pair_repr)
                             self._dao.delete_remote_state(doc_pair)
+                            self._invalidate_states(states, doc_pair)
                         else:
                             log.debug("Unknow event: '%s'", eventId)
                     else:
@@ -619,6 +967,7 @@ class RemoteWatcher(EngineWorker):
                             # If moved from a sync root to a non sync root, delete from local sync root
                             log.debug("Marking doc_pair '%s' as deleted", doc_pair_repr)
                             self._dao.delete_remote_state(doc_pair)
+                            self._invalidate_states(states, doc_pair)
                         else:
                             # Make new_info consistent with actual doc pair parent path for a doc member of a
                             # collection (typically the Locally Edited one) that is also under a sync root.
@@ -629,13 +978,8 @@ class RemoteWatcher(EngineWorker):
                             if remote_parent_factory == COLLECTION_SYNC_ROOT_FACTORY_NAME:
                                 new_info_parent_uid = doc_pair.remote_parent_ref
                                 new_info_path = (doc_pair.remote_parent_path + '/' + remote_ref)
-                                consistent_new_info = RemoteFileInfo(new_info.name, new_info.uid, new_info_parent_uid,
-                                                                     new_info_path, new_info.folderish,
-                                                                     new_info.last_modification_time,
-                                                                     new_info.last_contributor, new_info.digest,
-                                                                     new_info.digest_algorithm, new_info.download_url,
-                                                                     new_info.can_rename, new_info.can_delete,
-                                                                     new_info.can_update, new_info.can_create_child)
+                                consistent_new_info = new_info._replace(parent_uid=new_info_parent_uid,
+                                                                        path=new_info_path)
                             # Perform a regular document update on a document
                             # that has been updated, renamed or moved
                             log.debug("Refreshing remote state info"
@@ -656,22 +1000,28 @@ class RemoteWatcher(EngineWorker):
                             force_update = eventId == 'documentLocked' or eventId == 'documentUnlocked'
                             self._dao.update_remote_state(doc_pair, new_info, remote_parent_path=remote_parent_path,
                                                           force_update=force_update)
+                            states.invalidate(doc_pair.remote_ref)
+                            states.invalidate(new_info.uid)
                             if doc_pair.folderish:
                                 log.trace("Force scan recursive on %r : %d", doc_pair, (eventId == "securityUpdated"))
                                 self._force_remote_scan(doc_pair, consistent_new_info, remote_path=new_info.path,
                                                         force_recursion=(eventId == "securityUpdated"),
                                                         moved=(eventId == "documentMoved"))
+                                if eventId != "securityUpdated":
+                                    # The children have been scanned right away
+                                    states.clear()
 
                     updated = True
-                    refreshed.add(remote_ref)
+                    refreshed.update(get_remote_ref_suffixes(remote_ref))
 
             if new_info and not updated:
                 # Handle new document creations
                 created = False
-                parent_pairs = self._dao.get_states_from_remote(new_info.parent_uid)
+                parent_pairs = states.get_states(new_info.parent_uid)
                 for parent_pair in parent_pairs:
 
                     child_pair, new_pair = (self._find_remote_child_match_or_create(parent_pair, new_info))
+                    states.invalidate(new_info.uid)
                     if new_pair:
                         log.debug("Marked doc_pair '%s' as remote creation",
                                   child_pair.remote_name)
@@ -683,7 +1033,7 @@ class RemoteWatcher(EngineWorker):
                         self._force_remote_scan(child_pair, new_info, remote_path)
 
                     created = True
-                    refreshed.add(remote_ref)
+                    refreshed.update(get_remote_ref_suffixes(remote_ref))
                     break
 
                 if not created:
@@ -692,22 +1042,16 @@ class RemoteWatcher(EngineWorker):
         # Sort by path the deletion to only mark parent
         sorted_deleted = sorted(delete_queue,
                                 key=lambda x: x.local_path, reverse=False)
-        delete_processed = []
+        # Paths of the deleted folders, ending with a '/'
+        delete_processed = set()
         for delete_pair in sorted_deleted:
-            # Mark as deleted
-            skip = False
-            for processed in delete_processed:
-                path = processed.local_path
-                if path[-1] != "/":
-                    path = path + "/"
-                if delete_pair.local_path.startswith(path):
-                    skip = True
-                    break
-            if skip:
+            # Mark as deleted, unless one of its parent folders is
+            if self._is_under_paths(delete_pair.local_path, delete_processed):
                 continue
             # Verify the file is really deleted
             if self._client.get_fs_item(delete_pair.remote_ref) is not None:
                 continue
-            delete_processed.append(delete_pair)
+            path = delete_pair.local_path
+            delete_processed.add(path if path.endswith('/') else path + '/')
             log.debug("Marking doc_pair '%r' as deleted", delete_pair)
             self._dao.delete_remote_state(delete_pair)
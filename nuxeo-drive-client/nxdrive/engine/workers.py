@@ -2,6 +2,7 @@
 @author: Remi Cattiau
 '''
 from PyQt4.QtCore import QThread, QObject, pyqtSignal, pyqtSlot, QCoreApplication
+from PyQt4.QtCore import QAbstractEventDispatcher, QEventLoop, QTimer
 from threading import current_thread
 from time import sleep, time
 from nxdrive.engine.activity import Action, IdleAction
@@ -45,6 +46,7 @@ class Worker(QObject):
             name = type(self).__name__
         self._name = name
         self._running = False
+        self._wait_timer = None
         self._thread.terminated.connect(self._terminated)
         self.stopWorker.connect(self.quit)
 
@@ -64,6 +66,7 @@ class Worker(QObject):
     def stop(self):
         self._continue = False
         self.stopWorker.emit()
+        self.wake_up()
         if not self._thread.wait(5000):
             log.warn("Thread %d is not responding - terminate it", self._thread_id, exc_info=True)
             self._thread.terminate()
@@ -72,9 +75,33 @@ class Worker(QObject):
 
     def resume(self):
         self._pause = False
+        self.wake_up()
 
     def suspend(self):
         self._pause = True
+        self.wake_up()
+
+    def wake_up(self):
+        """Interrupt the current _wait of the worker, can be called from any thread"""
+        dispatcher = QAbstractEventDispatcher.instance(self._thread)
+        if dispatcher is not None:
+            dispatcher.wakeUp()
+
+    def _wait(self, timeout=None):
+        """Sleep until an event is posted to the worker thread, wake_up is called
+        or the timeout in seconds is reached"""
+        if timeout is not None:
+            if timeout <= 0:
+                QCoreApplication.processEvents()
+                return
+            if self._wait_timer is None:
+                # Created here to belong to the worker thread
+                self._wait_timer = QTimer()
+                self._wait_timer.setSingleShot(True)
+            self._wait_timer.start(int(timeout * 1000))
+        QCoreApplication.processEvents(QEventLoop.WaitForMoreEvents)
+        if timeout is not None:
+            self._wait_timer.stop()
 
     def _end_action(self):
         Action.finish_action()
@@ -87,8 +114,7 @@ class Worker(QObject):
         QCoreApplication.processEvents()
         # Handle thread pause
         while (self._pause and self._continue):
-            QCoreApplication.processEvents()
-            sleep(0.01)
+            self._wait()
         # Handle thread interruption
         if not self._continue:
             raise ThreadInterrupt()
@@ -96,7 +122,7 @@ class Worker(QObject):
     def _execute(self):
         while (1):
             self._interact()
-            sleep(0.01)
+            self._wait()
 
     def _terminated(self):
         log.debug("Thread %s(%r) terminated"
@@ -222,6 +248,7 @@ class PollWorker(Worker):
     @pyqtSlot()
     def force_poll(self):
         self._next_check = 0
+        self.wake_up()
 
     def _execute(self):
         while (self._enable):
@@ -230,7 +257,7 @@ class PollWorker(Worker):
                 if self._poll():
                     self._metrics['last_poll'] = int(time())
                 self._next_check = int(time()) + self._check_interval
-            sleep(0.01)
+            self._wait(self._next_check - time())
 
     def _poll(self):
         return True
@@ -244,7 +271,7 @@ class DummyWorker(Worker):
     def _execute(self):
         while (1):
             self._interact()
-            sleep(0.01)
+            self._wait()
 
 
 '''
@@ -17,7 +17,8 @@ class RemoteTestClient(RemoteFileSystemClient):
                  password=None, token=None, repository=DEFAULT_REPOSITORY_NAME,
                  ignored_prefixes=None, ignored_suffixes=None,
                  timeout=20, blob_timeout=None, cookie_jar=None,
-                 upload_tmp_dir=None, check_suspended=None):
+                 upload_tmp_dir=None, check_suspended=None,
+                 connection_pool=None, upload_store=None):
         self._download_remote_error = None
         self._upload_remote_error = None
         self._server_error = None
@@ -29,20 +30,20 @@ class RemoteTestClient(RemoteFileSystemClient):
             client_version, proxies, proxy_exceptions,
             password, token, repository, ignored_prefixes,
             ignored_suffixes, timeout, blob_timeout, cookie_jar,
-            upload_tmp_dir, check_suspended)
+            upload_tmp_dir, check_suspended, connection_pool, upload_store)
 
-    def do_get(self, url, file_out=None, digest=None, digest_algorithm=None):
+    def do_get(self, url, file_out=None, digest=None, digest_algorithm=None, digester=None):
         if self._download_remote_error is None:
             return super(RemoteTestClient, self).do_get(url, file_out=file_out, digest=digest,
-                                                        digest_algorithm=digest_algorithm)
+                                                        digest_algorithm=digest_algorithm, digester=digester)
         else:
             raise self._download_remote_error
 
     def upload(self, batch_id, file_path, filename=None, file_index=0,
-               mime_type=None):
+               mime_type=None, digester=None):
         if self._upload_remote_error is None:
             return super(RemoteTestClient, self).upload(batch_id, file_path, filename=filename, file_index=file_index,
-                                                        mime_type=mime_type)
+                                                        mime_type=mime_type, digester=digester)
         else:
             raise self._upload_remote_error
 
@@ -0,0 +1,56 @@
+"""Tests of the reusable buffers to hash and upload the files."""
+
+import hashlib
+import os
+import tempfile
+import unittest
+from nxdrive.client.buffer_pool import BufferPool, hash_file, read_chunks
+
+
+class BufferPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.content = os.urandom(9500)
+        fd, self.file_path = tempfile.mkstemp(prefix="nxdrive-buffer-pool-")
+        os.write(fd, self.content)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.file_path)
+
+    def test_reuse(self):
+        pool = BufferPool(buffer_size=1000, max_idle=1)
+        with pool.buffer() as first:
+            with pool.buffer() as second:
+                self.assertFalse(first is second)
+        self.assertEquals(pool.created, 2)
+        # Only one buffer is kept
+        with pool.buffer() as third:
+            self.assertTrue(third is first or third is second)
+            with pool.buffer():
+                pass
+        self.assertEquals(pool.created, 3)
+
+    def test_read_chunks(self):
+        pool = BufferPool(buffer_size=1000)
+        with open(self.file_path, "rb") as f:
+            chunks = [chunk.tobytes() for chunk in read_chunks(f, buffer_pool=pool)]
+        self.assertEquals([len(chunk) for chunk in chunks], [1000] * 9 + [500])
+        self.assertEquals("".join(chunks), self.content)
+        with open(self.file_path, "rb") as f:
+            f.seek(2000)
+            chunks = [chunk.tobytes() for chunk in read_chunks(f, length=2500, read_size=600, buffer_pool=pool)]
+        self.assertEquals([len(chunk) for chunk in chunks], [600, 600, 600, 600, 100])
+        self.assertEquals("".join(chunks), self.content[2000:4500])
+        # The buffer is given back to the pool
+        self.assertEquals(pool.created, 1)
+
+    def test_hash_file(self):
+        expected = hashlib.md5(self.content).hexdigest()
+        suspended = []
+        for use_mmap in (False, True):
+            digester = hashlib.md5()
+            hash_file(self.file_path, digester, check_suspended=suspended.append, use_mmap=use_mmap,
+                      mmap_threshold=1000, buffer_pool=BufferPool(buffer_size=1000))
+            self.assertEquals(digester.hexdigest(), expected)
+        self.assertEquals(len(suspended), 11)
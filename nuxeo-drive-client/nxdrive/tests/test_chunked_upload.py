@@ -0,0 +1,183 @@
+"""Tests of the resumable uploads by parallel chunks."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.common import StreamDigester
+from nxdrive.engine.dao.sqlite import EngineDAO
+
+OPERATIONS = {
+    "operations": [
+        {"id": "NuxeoDrive.GetChangeSummary", "params": [{"name": "lowerBound", "required": False}]},
+        {"id": "NuxeoDrive.CreateFile", "params": [{"name": "parentId", "required": True}]},
+    ]
+}
+UPLOAD_PATH = "/nuxeo/api/v1/upload"
+
+
+class BatchUploadHandler(BaseHTTPRequestHandler):
+    """Stand-in for the batch upload API of the server"""
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def do_GET(self):
+        if not self.path.startswith(UPLOAD_PATH):
+            return self._reply(200, OPERATIONS)
+        batch_id = self.path.split('/')[-2]
+        if batch_id not in self.server.batches:
+            return self._reply(404, {"status": 404, "message": "Unknown batch"})
+        self._reply(200, {"name": "file", "uploadType": "chunked",
+                          "uploadedChunkIds": sorted(self.server.batches[batch_id].get("chunks", {}).keys())})
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        if len(data) != int(self.headers['Content-Length']):
+            # Aborted by the client
+            self.close_connection = 1
+            return
+        server = self.server
+        if self.path == UPLOAD_PATH:
+            batch_id = "batch_%d" % len(server.batches)
+            server.batches[batch_id] = dict()
+            return self._reply(201, {"batchId": batch_id})
+        if "/execute/" in self.path:
+            batch_id = self.path.split('/')[-4]
+            batch = server.batches.pop(batch_id)
+            if "content" not in batch:
+                batch["content"] = "".join([batch["chunks"][index] for index in sorted(batch["chunks"])])
+            server.created.append(batch["content"])
+            return self._reply(200, {"id": "defaultFileSystemItemFactory#default#new", "parentId": "root",
+                                     "name": "file", "folder": False, "lastModificationDate": 1476748800000,
+                                     "digest": hashlib.md5(batch["content"]).hexdigest(), "digestAlgorithm": "MD5",
+                                     "downloadURL": "nxbigfile/default/new/blobholder:0/file", "canRename": True,
+                                     "canDelete": True, "canUpdate": True, "path": "/root/new"})
+        batch = server.batches[self.path.split('/')[-2]]
+        if self.headers.get("X-Upload-Type") != "chunked":
+            batch["content"] = data
+            return self._reply(201, {"batchId": self.path.split('/')[-2], "fileIdx": "0", "uploaded": "true"})
+        index = int(self.headers["X-Upload-Chunk-Index"])
+        time.sleep(server.chunk_delay)
+        with server.lock:
+            server.chunk_requests.append(index)
+            if index in server.failures:
+                server.failures.remove(index)
+                return self._reply(500, {"status": 500, "message": "Chunk upload failure"})
+            batch.setdefault("chunks", dict())[index] = data
+            complete = len(batch["chunks"]) == int(self.headers["X-Upload-Chunk-Count"])
+        self._reply(201 if complete else 308, {"uploaded": "true", "uploadType": "chunked",
+                                               "uploadedChunkIds": sorted(batch["chunks"].keys())})
+
+    def _reply(self, code, result):
+        body = json.dumps(result)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class BatchUploadServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ChunkedUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BatchUploadServer(('127.0.0.1', 0), BatchUploadHandler)
+        self.server.batches = dict()
+        self.server.created = []
+        self.server.chunk_requests = []
+        self.server.failures = set()
+        self.server.chunk_delay = 0
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.folder = tempfile.mkdtemp(prefix="nxdrive-chunked-upload-")
+        self.dao = EngineDAO(os.path.join(self.folder, "engine.db"))
+        self.dao.update_config("upload_chunk_size", 1000)
+        self.dao.update_config("upload_chunk_threads", 3)
+        self.client = RemoteFileSystemClient("http://127.0.0.1:%d/nuxeo/" % self.server.server_address[1],
+                                             "Administrator", "device", "2.2", proxies={}, password="Administrator",
+                                             upload_store=self.dao)
+        self.content = os.urandom(9500)
+        self.digest = hashlib.md5(self.content).hexdigest()
+        self.file_path = os.path.join(self.folder, "file.bin")
+        with open(self.file_path, "wb") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dao.dispose()
+        shutil.rmtree(self.folder)
+
+    def test_chunked_upload(self):
+        digester = StreamDigester("sha1")
+        info = self.client.stream_file("root", self.file_path, digester=digester)
+        self.assertEquals(info.digest, self.digest)
+        self.assertEquals(self.server.created, [self.content])
+        self.assertEquals(sorted(self.server.chunk_requests), range(10))
+        # The digests are computed in the same pass
+        self.assertEquals(digester.hexdigest("sha1"), hashlib.sha1(self.content).hexdigest())
+        self.assertEquals(self.dao.get_upload_chunks(self.digest, 1000), (None, set()))
+
+    def test_resume(self):
+        self.server.failures.add(4)
+        self.assertRaises(Exception, self.client.stream_file, "root", self.file_path)
+        batch_id, uploaded = self.dao.get_upload_chunks(self.digest, 1000)
+        self.assertEquals(batch_id, "batch_0")
+        self.assertFalse(4 in uploaded)
+        self.server.chunk_requests = []
+        self.client.stream_file("root", self.file_path)
+        self.assertEquals(self.server.created, [self.content])
+        # Only the missing chunks are sent again
+        self.assertEquals(sorted(self.server.chunk_requests), [index for index in range(10) if index not in uploaded])
+        self.assertEquals(self.dao.get_upload_chunks(self.digest, 1000), (None, set()))
+
+    def test_expired_batch(self):
+        self.dao.add_upload_chunk(self.digest, 1000, "expired_batch", 0)
+        self.client.stream_file("root", self.file_path)
+        self.assertEquals(self.server.created, [self.content])
+        self.assertEquals(sorted(self.server.chunk_requests), range(10))
+
+    def test_small_file(self):
+        with open(self.file_path, "wb") as f:
+            f.write(self.content[:1000])
+        self.client.stream_file("root", self.file_path)
+        self.assertEquals(self.server.created, [self.content[:1000]])
+        self.assertEquals(self.server.chunk_requests, [])
+
+    def test_same_content(self):
+        # Uploaded at the same time by two processors, each with its client
+        self.server.chunk_delay = 0.1
+        other_path = os.path.join(self.folder, "other.bin")
+        shutil.copy(self.file_path, other_path)
+        infos = dict()
+
+        def upload(file_path):
+            client = RemoteFileSystemClient(self.client.server_url, "Administrator", "device", "2.2", proxies={},
+                                            password="Administrator", upload_store=self.dao)
+            infos[file_path] = client.stream_file("root", file_path)
+        threads = [threading.Thread(target=upload, args=(path,)) for path in (self.file_path, other_path)]
+        threads[0].start()
+        # The second one starts once chunks of the first one are saved
+        time.sleep(0.15)
+        threads[1].start()
+        for thread in threads:
+            thread.join(10)
+        # Each one executes its own batch
+        self.assertEquals([info.digest for info in infos.values()], [self.digest] * 2)
+        self.assertEquals(self.server.created, [self.content] * 2)
+        self.assertEquals(self.dao.get_upload_chunks(self.digest, 1000), (None, set()))
@@ -0,0 +1,113 @@
+"""Tests of the keep-alive HTTP connections shared by the remote clients."""
+
+import httplib
+import threading
+import unittest
+import urllib2
+from time import sleep
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from nxdrive.client.connection_pool import ConnectionPool, get_pooled_handlers
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send the headers and the body at once, as a real server does
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.client_address)
+
+    def do_GET(self):
+        if self.path.startswith("/drop"):
+            return self._drop()
+        self._reply(self.path)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path.startswith("/drop"):
+            return self._drop()
+        self._reply(body)
+
+    def _drop(self):
+        # Handle the request but close the connection without response
+        self.server.dropped += 1
+        self.close_connection = 1
+
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.close_after_reply:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    close_after_reply = False
+    dropped = 0
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = KeepAliveServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.connections = []
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.pool = ConnectionPool(max_per_host=2)
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler({}), *get_pooled_handlers(self.pool))
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        for i in range(5):
+            self.assertEquals(self.opener.open(self.url + "/get_%d" % i).read(), "/get_%d" % i)
+            self.assertEquals(self.opener.open(urllib2.Request(self.url, "post_%d" % i)).read(), "post_%d" % i)
+        metrics = self.pool.get_metrics()
+        self.assertEquals(metrics["http_connections_created"], 1)
+        self.assertEquals(metrics["http_connections_reused"], 9)
+        self.assertEquals(metrics["http_connections_idle"], 1)
+        self.assertEquals(len(self.server.connections), 1)
+
+    def test_unread_response(self):
+        first = self.opener.open(self.url + "/first")
+        second = self.opener.open(self.url + "/second")
+        # Both connections are in use, the limit is reached
+        self.assertEquals(self.pool.get_metrics()["http_connections_active"], 2)
+        first.close()
+        self.assertEquals(second.read(), "/second")
+        self.assertEquals(self.opener.open(self.url + "/third").read(), "/third")
+        metrics = self.pool.get_metrics()
+        self.assertEquals(metrics["http_connections_active"], 0)
+        self.assertEquals(metrics["http_connections_reused"], 1)
+
+    def test_stale_connection(self):
+        self.server.close_after_reply = True
+        self.assertEquals(self.opener.open(self.url + "/first").read(), "/first")
+        sleep(0.1)
+        # The server closed the idle connection, the request is sent on a new one
+        self.assertEquals(self.opener.open(urllib2.Request(self.url, "second")).read(), "second")
+        self.assertEquals(self.pool.get_metrics()["http_connections_created"], 2)
+        self.assertEquals(len(self.server.connections), 2)
+
+    def test_lost_response(self):
+        self.assertEquals(self.opener.open(self.url + "/first").read(), "/first")
+        # The request may have been handled, it is not sent again
+        self.assertRaises(httplib.BadStatusLine, self.opener.open, urllib2.Request(self.url + "/drop", "post"))
+        self.assertEquals(self.server.dropped, 1)
+        self.assertEquals(self.opener.open(self.url + "/second").read(), "/second")
+        # Unless it has no side effect
+        self.assertRaises(httplib.BadStatusLine, self.opener.open, self.url + "/drop")
+        self.assertEquals(self.server.dropped, 3)
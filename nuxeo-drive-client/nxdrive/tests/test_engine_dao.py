@@ -5,11 +5,18 @@ Created on 31 mars 2015
 '''
 import unittest
 import os
+import sqlite3
 import sys
+import threading
 import nxdrive
 from nxdrive.engine.dao.sqlite import EngineDAO
 from nxdrive.engine.engine import Engine
+from nxdrive.engine.watcher.remote_watcher import RemoteStatesCache
 import tempfile
+import hashlib
+import shutil
+from copy import deepcopy
+from nxdrive.client.local_client import DigestCache, FileInfo
 
 
 class EngineDAOTest(unittest.TestCase):
@@ -239,3 +246,294 @@ class EngineDAOTest(unittest.TestCase):
         self.assertEquals(len(self._dao.get_filters()), 1)
         self._dao.add_filter(u"/otherFilter")
         self.assertEquals(len(self._dao.get_filters()), 2)
+
+    def test_indexes(self):
+        # Check that the hot DAO methods never scan the full States table
+        folder = self._dao.get_state_from_id(21)
+        self._dao.set_query_plan_check(True)
+        self._dao.get_state_from_local(folder.local_path)
+        self._dao.get_local_children(folder.local_path)
+        self._dao.get_remote_children(folder.remote_ref)
+        self._dao.get_states_from_remote(folder.remote_ref)
+        self._dao.get_count("pair_state='conflicted'")
+        self._dao.get_valid_duplicate_file("digest")
+        self._dao.release_processor(666)
+        self.assertNoScan(self._dao.get_query_plans(), 7)
+
+    def assertNoScan(self, plans, count):
+        self.assertEquals(len(plans), count)
+        for query, details in plans:
+            for detail in details:
+                self.assertFalse(detail.startswith("SCAN"), "%s: %s" % (query, detail))
+
+    def test_subtree_queries(self):
+        # Siblings sharing the same prefix like /SmallFolder/Test.txt must not be part of the subtree
+        folder = self._dao.get_state_from_id(21)
+        self._dao.set_query_plan_check(True)
+        self.assertEquals(len(self._dao.get_local_children(folder.local_path)), 22)
+        self.assertEquals(len(self._dao.get_states_from_partial_local(folder.local_path + '/')), 22)
+        self.assertEquals(len(self._dao.get_remote_descendants_from_ref(folder.remote_ref)), 22)
+        self._dao.update_local_parent_path(folder, u"Renamed", u"/SmallFolder")
+        self.assertEquals(len(self._dao.get_local_children(u"/SmallFolder/Renamed")), 22)
+        self.assertEquals(len(self._dao.get_local_children(folder.local_path)), 0)
+        self.assertIsNotNone(self._dao.get_state_from_local(u"/SmallFolder/Test.txt"))
+        self.assertIsNotNone(self._dao.get_state_from_local(u"/SmallFolder/Renamed/IMG_6693.JPG"))
+        self._dao.update_remote_parent_path(folder, u"/newParent")
+        remote_path = u"/newParent/" + folder.remote_ref
+        self.assertEquals(len(self._dao.get_remote_descendants(remote_path)), 22)
+        # The subtree lookups and rewrites only read the subtree
+        self.assertNoScan(self._dao.get_query_plans(), 13)
+
+    def test_transaction_queue(self):
+        class QueueManager(object):
+            def __init__(self):
+                self.pushed = []
+
+            def push_ref(self, row_id, folderish, pair_state, size=None, local_parent_path=None, depends_on=None):
+                self.pushed.append((row_id, pair_state))
+        manager = QueueManager()
+        self._dao.register_queue_manager(manager)
+        manager.pushed = []
+        self._dao.begin_transaction()
+        try:
+            self._dao.force_remote(self._dao.get_state_from_id(2))
+            self._dao.force_remote(self._dao.get_state_from_id(3))
+            self._dao.force_local(self._dao.get_state_from_id(2))
+            # Nothing is queued before the commit
+            self.assertEquals(len(manager.pushed), 0)
+        finally:
+            self._dao.end_transaction()
+        # Only the last state of each row is queued, in order
+        self.assertEquals(manager.pushed, [(2, 'locally_created'), (3, 'remotely_modified')])
+        self.assertEquals(self._dao.get_state_from_id(3).pair_state, 'remotely_modified')
+
+    def test_transaction_failure(self):
+        class QueueManager(object):
+            def __init__(self):
+                self.pushed = []
+
+            def push_ref(self, row_id, folderish, pair_state, size=None, local_parent_path=None, depends_on=None):
+                self.pushed.append((row_id, pair_state))
+
+        def commit():
+            raise sqlite3.OperationalError("disk I/O error")
+        manager = QueueManager()
+        self._dao.register_queue_manager(manager)
+        manager.pushed = []
+        pair_state = self._dao.get_state_from_id(3).pair_state
+        self._dao.begin_transaction()
+        con = self._dao._get_write_connection()
+        try:
+            self._dao.force_remote(self._dao.get_state_from_id(3))
+            con.commit = commit
+            self.assertRaises(sqlite3.OperationalError, self._dao.end_transaction)
+        finally:
+            del con.commit
+        # Neither the writes nor the queue of the failed transaction are left to the next one
+        self._dao.begin_transaction()
+        self._dao.end_transaction()
+        self.assertEquals(manager.pushed, [])
+        self.assertEquals(self._dao.get_state_from_id(3).pair_state, pair_state)
+
+    def test_transaction_isolation(self):
+        results = []
+
+        def processor():
+            results.append(self._dao.acquire_processor(42, 2))
+            results.append(self._dao.get_state_from_id(2).processor)
+            self._dao.dispose_thread()
+        self._dao.begin_transaction()
+        try:
+            self._dao.force_remote(self._dao.get_state_from_id(3))
+            thread = threading.Thread(target=processor)
+            thread.start()
+            thread.join(0.5)
+            # The writes of the other threads wait for the end of the transaction
+            self.assertTrue(thread.is_alive())
+            self.assertEquals(results, [])
+        finally:
+            self._dao.end_transaction()
+        thread.join()
+        # Then the thread reads its own writes
+        self.assertEquals(results, [True, 42])
+        self.assertEquals(self._dao.get_state_from_id(3).pair_state, 'remotely_modified')
+
+    def test_dependency_queue(self):
+        class QueueManager(object):
+            def __init__(self):
+                self.pushed = []
+                self.released = []
+
+            def push_ref(self, row_id, folderish, pair_state, size=None, local_parent_path=None, depends_on=None):
+                self.pushed.append((row_id, depends_on))
+
+            def release_children(self, parent_pair):
+                self.released.append(parent_pair.id)
+        manager = QueueManager()
+        self._dao.register_queue_manager(manager)
+        manager.pushed = []
+        folder = unicode(tempfile.mkdtemp(dir=self.tmpdir))
+        try:
+            os.mkdir(os.path.join(folder, "Dependencies"))
+            for name in ("first.txt", "second.txt"):
+                with open(os.path.join(folder, "Dependencies", name), "wb") as f:
+                    f.write(name)
+            parent_id = self._dao.insert_local_state(FileInfo(folder, u"/Dependencies", True, None), u"")
+            first_id = self._dao.insert_local_state(FileInfo(folder, u"/Dependencies/first.txt", False, None),
+                                                    u"/Dependencies")
+            # The child waits for its parent in creation
+            self.assertEquals(manager.pushed, [(parent_id, None), (first_id, parent_id)])
+            self._dao.begin_transaction()
+            try:
+                second_id = self._dao.insert_local_state(FileInfo(folder, u"/Dependencies/second.txt", False, None),
+                                                         u"/Dependencies")
+                self._dao.synchronize_state(self._dao.get_state_from_id(parent_id))
+                # Nothing is released before the parent is committed as synchronized
+                self.assertEquals(manager.released, [])
+            finally:
+                self._dao.end_transaction()
+            # Only the waiting children are released
+            self.assertEquals(manager.released, [parent_id])
+            # The parent was synchronized before the commit
+            self.assertEquals(manager.pushed[-1], (second_id, None))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_locally_created_folders(self):
+        folder = unicode(tempfile.mkdtemp(dir=self.tmpdir))
+        try:
+            paths = [u"/Tree", u"/Tree/B", u"/Tree/B/C", u"/Tree/D", u"/TreeSibling"]
+            for path in paths:
+                os.mkdir(folder + path)
+                self._dao.insert_local_state(FileInfo(folder, path, True, None), os.path.dirname(path))
+            with open(folder + u"/Tree/file.txt", "wb") as f:
+                f.write("content")
+            self._dao.insert_local_state(FileInfo(folder, u"/Tree/file.txt", False, None), u"/Tree")
+            tree = self._dao.get_state_from_local(u"/Tree")
+            self.assertEquals([pair.local_path for pair in self._dao.get_locally_created_folders(tree)],
+                              [u"/Tree/B", u"/Tree/B/C", u"/Tree/D"])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_digest_cache(self):
+        content = "Some content"
+        folder = tempfile.mkdtemp(u"-nxdrive-digest-cache", dir=self.tmpdir)
+        with open(os.path.join(folder, "file.txt"), 'wb') as f:
+            f.write(content)
+        md5 = hashlib.md5(content).hexdigest()
+        sha1 = hashlib.sha1(content).hexdigest()
+        try:
+            cache = DigestCache(self._dao, memory_size=1)
+            info = FileInfo(folder, u"/file.txt", False, None, digest_cache=cache)
+            self.assertEquals(info.get_digest(), md5)
+            self.assertEquals(info.get_digest('sha1'), sha1)
+            self.assertEquals((cache.hits, cache.misses), (0, 2))
+            # md5 has been evicted from memory but is still in the database
+            self.assertEquals(info.get_digest(), md5)
+            self.assertEquals(info.get_digest('sha1'), sha1)
+            self.assertEquals((cache.hits, cache.misses), (2, 2))
+            # Persisted for the next cache
+            cache = DigestCache(self._dao)
+            info = FileInfo(folder, u"/file.txt", False, None, digest_cache=cache)
+            self._dao.set_query_plan_check(True)
+            self.assertEquals(info.get_digest('sha1'), sha1)
+            self.assertEquals((cache.hits, cache.misses), (1, 0))
+            # The last access is recent enough, a hit does not write
+            self.assertEquals([query.split()[0] for query, _ in self._dao.get_query_plans()], ['SELECT'])
+            self._dao.set_query_plan_check(False)
+            # Another modification time is another key
+            os.utime(info.filepath, (0, 0))
+            self.assertEquals(info.get_digest('sha1'), sha1)
+            self.assertEquals((cache.hits, cache.misses), (1, 1))
+            self._dao.evict_digest_cache(0)
+            cache = DigestCache(self._dao)
+            info = FileInfo(folder, u"/file.txt", False, None, digest_cache=cache)
+            self.assertEquals(info.get_digest('sha1'), sha1)
+            self.assertEquals((cache.hits, cache.misses), (0, 1))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_state_counters(self):
+        def get_counts():
+            return (self._dao.get_sync_count(filetype="file"), self._dao.get_sync_count(filetype="folder"),
+                    self._dao.get_syncing_count(), self._dao.get_error_count(), self._dao.get_conflict_count(),
+                    self._dao.get_unsynchronized_count(), self._dao.get_global_size())
+
+        def get_real_counts():
+            c = self._dao._get_read_connection().cursor()
+            return (self._dao.get_count("pair_state='synchronized' AND folderish=0"),
+                    self._dao.get_count("pair_state='synchronized' AND folderish=1"),
+                    self._dao.get_count("pair_state!='synchronized' AND pair_state!='conflicted'"
+                                        + " AND pair_state!='unsynchronized' AND error_count < 3"),
+                    self._dao.get_count("error_count > 3"), self._dao.get_count("pair_state='conflicted'"),
+                    self._dao.get_count("pair_state='unsynchronized'"),
+                    c.execute("SELECT SUM(size) FROM States WHERE pair_state='synchronized'").fetchone()[0])
+
+        self.assertEquals(get_counts(), get_real_counts())
+        self.assertTrue(self._dao.check_state_counters())
+        # Kept up to date by the mutators
+        row = self._dao.get_errors()[0]
+        self._dao.reset_error(row)
+        row = self._dao.get_conflicts()[0]
+        self._dao.synchronize_state(row)
+        self._dao.remove_state(self._dao.get_state_from_id(2))
+        self.assertEquals(get_counts(), get_real_counts())
+        # A pair without state is not syncing
+        syncing = self._dao.get_syncing_count()
+        con = self._dao._get_write_connection()
+        con.execute("INSERT INTO States(local_path, local_parent_path, local_name, folderish, local_state,"
+                    + " remote_state, pair_state) VALUES ('/no_state', '', 'no_state', 0, 'unknown', 'unknown', NULL)")
+        con.commit()
+        self.assertEquals(self._dao.get_syncing_count(), syncing)
+        self.assertEquals(get_counts(), get_real_counts())
+        # Reconciled on demand
+        con = self._dao._get_write_connection()
+        con.execute("DELETE FROM StateCounters")
+        con.commit()
+        self.assertNotEquals(get_counts(), get_real_counts())
+        self.assertFalse(self._dao.check_state_counters())
+        self.assertEquals(get_counts(), get_real_counts())
+        self.assertTrue(self._dao.check_state_counters())
+
+    def test_rows(self):
+        row = self._dao.get_state_from_id(1)
+        self.assertEquals(row.id, 1)
+        self.assertEquals(row['local_path'], row.local_path)
+        self.assertEquals(row[0], row.id)
+        self.assertEquals(len(row.keys()), len(row))
+        self.assertEquals(row, self._dao.get_state_from_id(1))
+        # Columns and other attributes can be set
+        row.local_state = 'modified'
+        row.custom = 'value'
+        self.assertEquals((row.local_state, row['local_state'], row.custom), ('modified', 'modified', 'value'))
+        copied = deepcopy(row)
+        self.assertEquals((copied, copied.custom), (row, 'value'))
+        # Expressions are available by index and alias
+        c = self._dao._get_read_connection().cursor()
+        row = c.execute("SELECT COUNT(*), COUNT(*) as count FROM States").fetchone()
+        self.assertEquals(row[0], row.count)
+        self.assertRaises(IndexError, row.__getitem__, 'unknown')
+
+    def test_remote_batch_queries(self):
+        refs = [state.remote_ref for state in self._dao.get_states_from_partial_local('/')
+                if state.remote_ref is not None]
+        self.assertTrue(len(refs) > 0)
+        refs.append('unknown_ref')
+        states = self._dao.get_states_from_remotes(refs)
+        self.assertEquals(sorted(states.keys()), sorted(set(refs)))
+        for ref in refs:
+            self.assertEquals(states[ref], self._dao.get_states_from_remote(ref))
+        # The change summary can give the refs without their factory name
+        partial_refs = [ref.split('#', 1)[1] for ref in refs if '#' in ref] + ['unknown_ref']
+        states = self._dao.get_first_states_from_partial_remotes(partial_refs)
+        for ref in partial_refs:
+            self.assertEquals(states[ref], self._dao.get_first_state_from_partial_remote(ref))
+        # The whole table is only scanned once enough refs are looked up
+        for threshold, scans in ((len(partial_refs), 0), (2, 1)):
+            cache = RemoteStatesCache(self._dao, set(partial_refs))
+            cache.PARTIAL_SCAN_THRESHOLD = threshold
+            self._dao.set_query_plan_check(True)
+            for ref in partial_refs:
+                self.assertEquals(cache.get_first_partial_state(ref), states[ref])
+            self.assertEquals(len([query for query, _ in self._dao.get_query_plans()
+                                   if query.startswith("SELECT id, remote_ref")]), scans)
@@ -0,0 +1,115 @@
+"""Tests of the local copies sharing the blocks of the source."""
+
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+from nxdrive.client import file_copier
+from nxdrive.client.file_copier import FileCopier, COPY_CLONE, COPY_CHUNKED
+
+# Folder on a copy-on-write file system, like a Btrfs or XFS loopback image:
+#   truncate -s 512M /tmp/btrfs.img && mkfs.btrfs /tmp/btrfs.img && mount -o loop /tmp/btrfs.img /mnt/btrfs
+REFLINK_FOLDER = os.environ.get('NXDRIVE_TEST_REFLINK_FOLDER')
+# Folder on a file system without file cloning, like ext4, default to the temporary folder
+CHUNKED_FOLDER = os.environ.get('NXDRIVE_TEST_CHUNKED_FOLDER')
+
+
+class FileCopierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.content = os.urandom(9500)
+        self.folders = []
+
+    def tearDown(self):
+        for folder in self.folders:
+            shutil.rmtree(folder)
+
+    def create_source(self, base_folder=None):
+        folder = tempfile.mkdtemp(prefix="nxdrive-file-copier-", dir=base_folder)
+        self.folders.append(folder)
+        src = os.path.join(folder, "source.bin")
+        with open(src, "wb") as f:
+            f.write(self.content)
+        os.chmod(src, 0o640)
+        return folder, src
+
+    def assertCopied(self, src, dst):
+        with open(dst, "rb") as f:
+            self.assertEquals(f.read(), self.content)
+        self.assertEquals(os.stat(dst).st_mode, os.stat(src).st_mode)
+
+    def test_chunked_copy(self):
+        folder, src = self.create_source()
+        copier = FileCopier(buffer_size=1000)
+        copier._copy_chunks(src, os.path.join(folder, "copy.bin"))
+        with open(os.path.join(folder, "copy.bin"), "rb") as f:
+            self.assertEquals(f.read(), self.content)
+
+    def test_unsupported_volume(self):
+        calls = []
+
+        def clone_file(src, dst):
+            calls.append(dst)
+            raise IOError(errno.EOPNOTSUPP, "Operation not supported")
+
+        folder, src = self.create_source()
+        copier = FileCopier(buffer_size=1000)
+        original = file_copier.clone_file
+        file_copier.clone_file = clone_file
+        try:
+            for index in range(3):
+                dst = os.path.join(folder, "copy_%d.bin" % index)
+                self.assertEquals(copier.copy(src, dst), COPY_CHUNKED)
+                self.assertCopied(src, dst)
+        finally:
+            file_copier.clone_file = original
+        # The volume is not tried again
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(copier.get_strategy(os.stat(folder).st_dev), COPY_CHUNKED)
+        metrics = copier.get_metrics()
+        self.assertEquals(metrics["copy_chunked_files"], 3)
+        self.assertEquals(metrics["copy_chunked_bytes"], 3 * len(self.content))
+        self.assertEquals(metrics["copy_cloned_files"], 0)
+
+    def test_file_not_clonable(self):
+        def clone_file(src, dst):
+            raise IOError(errno.EXDEV, "Invalid cross-device link")
+
+        folder, src = self.create_source()
+        copier = FileCopier()
+        original = file_copier.clone_file
+        file_copier.clone_file = clone_file
+        try:
+            self.assertEquals(copier.copy(src, os.path.join(folder, "copy.bin")), COPY_CHUNKED)
+        finally:
+            file_copier.clone_file = original
+        # Other files of the volume may be cloned
+        self.assertEquals(copier.get_strategy(os.stat(folder).st_dev), None)
+
+    def test_chunked_volume(self):
+        # ext4 and most file systems cannot clone files
+        folder, src = self.create_source(CHUNKED_FOLDER)
+        copier = FileCopier()
+        if CHUNKED_FOLDER is None:
+            dst = os.path.join(folder, "copy.bin")
+            copier.copy(src, dst)
+            self.assertCopied(src, dst)
+            return
+        for index in range(2):
+            dst = os.path.join(folder, "copy_%d.bin" % index)
+            self.assertEquals(copier.copy(src, dst), COPY_CHUNKED)
+            self.assertCopied(src, dst)
+        self.assertEquals(copier.get_strategy(os.stat(folder).st_dev), COPY_CHUNKED)
+
+    def test_reflink_volume(self):
+        if REFLINK_FOLDER is None:
+            self.skipTest("NXDRIVE_TEST_REFLINK_FOLDER is not set")
+        folder, src = self.create_source(REFLINK_FOLDER)
+        copier = FileCopier()
+        for index in range(2):
+            dst = os.path.join(folder, "copy_%d.bin" % index)
+            self.assertEquals(copier.copy(src, dst), COPY_CLONE)
+            self.assertCopied(src, dst)
+        self.assertEquals(copier.get_strategy(os.stat(folder).st_dev), COPY_CLONE)
+        self.assertEquals(copier.get_metrics()["copy_cloned_files"], 2)
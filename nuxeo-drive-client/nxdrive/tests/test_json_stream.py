@@ -0,0 +1,61 @@
+"""Tests of the incremental decoding of the JSON responses."""
+
+import json
+import unittest
+from StringIO import StringIO
+from nxdrive.client import json_stream
+
+
+class JSONStreamTest(unittest.TestCase):
+
+    def get_summary(self, changes):
+        return {
+            "fileSystemChanges": [{"eventId": "documentModified", "eventDate": 1476748800000 + i,
+                                   "fileSystemItemId": "defaultFileSystemItemFactory#default#%d" % i,
+                                   "fileSystemItem": {"name": u"Fich\xe9 %d" % i, "digest": None,
+                                                      "canRename": i % 2 == 0, "size": 1.5 * i}}
+                                  for i in range(changes)],
+            "hasTooManyChanges": False,
+            "syncDate": 1476748800000,
+            "upperBound": 12345678,
+            "activeSynchronizationRootDefinitions": "default:root",
+        }
+
+    def test_same_as_json_loads(self):
+        data = json.dumps(self.get_summary(100), indent=1)
+        # Chunks smaller than a value to decode the truncated values again
+        for read_size in (1, 7, 100, 64 * 1024):
+            result = json_stream.load(StringIO(data), items_key="fileSystemChanges", read_size=read_size)
+            self.assertEquals(result, json.loads(data))
+            result = json_stream.load(StringIO(data), read_size=read_size)
+            self.assertEquals(result, json.loads(data))
+
+    def test_item_converter(self):
+        data = json.dumps(self.get_summary(10))
+        converted = []
+
+        def convert(change):
+            converted.append(change["eventDate"])
+            return change["fileSystemItemId"]
+        result = json_stream.load(StringIO(data), items_key="fileSystemChanges", item_converter=convert,
+                                  read_size=50)
+        self.assertEquals(converted, [1476748800000 + i for i in range(10)])
+        self.assertEquals(result["fileSystemChanges"],
+                          ["defaultFileSystemItemFactory#default#%d" % i for i in range(10)])
+        self.assertEquals(result["upperBound"], 12345678)
+        # No items
+        result = json_stream.load(StringIO('{"fileSystemItems": [ ], "scrollId": "1"}'),
+                                  items_key="fileSystemItems", item_converter=convert, read_size=3)
+        self.assertEquals(result, {"fileSystemItems": [], "scrollId": "1"})
+
+    def test_other_documents(self):
+        self.assertIsNone(json_stream.load(StringIO(''), items_key="fileSystemItems"))
+        self.assertIsNone(json_stream.load(StringIO('null'), items_key="fileSystemItems"))
+        self.assertEquals(json_stream.load(StringIO(' 123456 '), read_size=2), 123456)
+        self.assertEquals(json_stream.load(StringIO('[1, 2]'), items_key="fileSystemItems"), [1, 2])
+        self.assertEquals(json_stream.load(StringIO('{}'), items_key="fileSystemItems"), {})
+
+    def test_invalid_documents(self):
+        for data in ('{"fileSystemItems": [{"id": 1}, ', '{"fileSystemItems": [1 2]}', '{"a": 1} 2', '{"a" 1}'):
+            self.assertRaises(ValueError, json_stream.load, StringIO(data), items_key="fileSystemItems",
+                              read_size=4)
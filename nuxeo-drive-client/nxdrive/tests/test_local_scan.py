@@ -0,0 +1,93 @@
+"""Tests of the parallel local folder listing and of the background digests."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from Queue import Queue
+from time import sleep
+from nxdrive.client import LocalClient
+from nxdrive.engine.watcher.local_watcher import LocalFolderLister, LocalDigester
+from nxdrive.tests.common import SOME_TEXT_CONTENT
+from nxdrive.tests.common import SOME_TEXT_DIGEST
+
+
+class LocalScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(u'-nxdrive-local-scan')
+        self.client = LocalClient(self.folder)
+        for name in [u'a', u'b', u'c']:
+            folder = self.client.make_folder(u'/', name)
+            self.client.make_file(folder, u'File.txt', content=SOME_TEXT_CONTENT)
+        self.client.make_file(u'/', u'File.txt', content=SOME_TEXT_CONTENT)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_children_info(self):
+        children = self.client.get_children_info(u'/')
+        self.assertEquals([child.name for child in children], [u'File.txt', u'a', u'b', u'c'])
+        for child in children:
+            info = self.client.get_info(child.path)
+            self.assertEquals(child.folderish, info.folderish)
+            self.assertEquals(child.size, info.size)
+            self.assertEquals(child.last_modification_time, info.last_modification_time)
+        self.assertEquals(children[0].size, len(SOME_TEXT_CONTENT))
+        self.assertEquals(children[1].size, 0)
+
+    def test_lister(self):
+        lister = LocalFolderLister(self.client, threads=2)
+        lister.start()
+        try:
+            for path in reversed([u'/a', u'/b', u'/c']):
+                lister.push(path)
+            self.assertTrue(lister.is_pushed(u'/b'))
+            self.assertFalse(lister.is_pushed(u'/d'))
+            for path in [u'/a', u'/b', u'/c']:
+                children = lister.get(path, timeout=2)
+                self.assertEquals([child.path for child in children], [path + u'/File.txt'])
+                self.assertFalse(lister.is_pushed(path))
+            lister.push(u'/d')
+            self.assertRaises(OSError, lister.get, u'/d', 2)
+        finally:
+            lister.stop()
+
+    def test_lister_lookahead(self):
+        listed = []
+
+        class CountingClient(object):
+            def get_children_info(client, path):
+                listed.append(path)
+                return self.client.get_children_info(path)
+        lister = LocalFolderLister(CountingClient(), threads=2, max_listings=2)
+        lister.start()
+        try:
+            paths = [u'/a', u'/b', u'/c']
+            for path in reversed(paths):
+                lister.push(path)
+            sleep(0.5)
+            # The threads wait for the scan once two listings are done ahead
+            self.assertEquals(len(listed), 2)
+            for path in paths:
+                children = lister.get(path, timeout=2)
+                self.assertEquals([child.path for child in children], [path + u'/File.txt'])
+            # Each folder is listed once, by the threads or by the scan
+            sleep(0.5)
+            self.assertEquals(sorted(listed), paths)
+        finally:
+            lister.stop()
+
+    def test_digester(self):
+        digester = LocalDigester(threads=2)
+        digester.start()
+        try:
+            results = Queue()
+            for path in [u'/a/File.txt', u'/b/File.txt', u'/File.txt']:
+                digester.push(self.client.get_info(path), lambda info, digest: results.put((info.path, digest)))
+            digests = dict([results.get(timeout=2) for _ in range(3)])
+            self.assertEquals(digests[u'/a/File.txt'], SOME_TEXT_DIGEST)
+            self.assertEquals(digests[u'/b/File.txt'], SOME_TEXT_DIGEST)
+            self.assertEquals(digests[u'/File.txt'], SOME_TEXT_DIGEST)
+        finally:
+            digester.stop()
@@ -0,0 +1,136 @@
+"""Tests of the remote folder trees created by batches."""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from xml.etree import ElementTree
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.remote_file_system_client import CREATE_FOLDERS_OPERATION
+from nxdrive.engine.dao.sqlite import EngineDAO
+
+OPERATIONS = {
+    "operations": [
+        {"id": "NuxeoDrive.GetChangeSummary", "params": [{"name": "lowerBound", "required": False}]},
+        {"id": "NuxeoDrive.CreateFolder", "params": [{"name": "parentId", "required": True},
+                                                     {"name": "name", "required": True}]},
+        {"id": "NuxeoDrive.CreateFolders", "params": [{"name": "parentId", "required": True},
+                                                      {"name": "folders", "required": True}]},
+    ]
+}
+
+# Server-side contribution of the CreateFolders operation
+CONTRIBUTION = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, os.pardir, "resources", "server",
+                            "nuxeo-drive-create-folders-config.xml")
+
+
+class FolderHandler(BaseHTTPRequestHandler):
+    """Stand-in for the folder creation operations of the server"""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._reply(200, self.server.operations)
+
+    def do_POST(self):
+        params = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['params']
+        server = self.server
+        with server.lock:
+            server.calls.append(self.path.split('/')[-1])
+            if self.path.endswith("/NuxeoDrive.CreateFolder"):
+                return self._reply(200, self._create(params['parentId'], params['name']))
+            created = []
+            for folder in json.loads(params['folders']):
+                if 'parentIndex' in folder:
+                    parent_id = created[folder['parentIndex']]['id']
+                else:
+                    parent_id = folder['parentId']
+                created.append(self._create(parent_id, folder['name']))
+        self._reply(200, created)
+
+    def _create(self, parent_id, name):
+        folder_id = "defaultSyncRootFolderItemFactory#default#folder_%d" % len(self.server.folders)
+        self.server.folders[folder_id] = (parent_id, name)
+        return {"id": folder_id, "parentId": parent_id, "name": name, "folder": True,
+                "lastModificationDate": 1476748800000, "canRename": True, "canDelete": True,
+                "canCreateChild": True, "path": "/" + folder_id}
+
+    def _reply(self, code, result):
+        body = json.dumps(result)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FolderServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MakeFoldersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FolderServer(('127.0.0.1', 0), FolderHandler)
+        self.server.operations = OPERATIONS
+        self.server.folders = dict()
+        self.server.calls = []
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.folder = tempfile.mkdtemp(prefix="nxdrive-make-folders-")
+        self.dao = EngineDAO(os.path.join(self.folder, "engine.db"))
+        self.dao.update_config("folder_batch_size", 3)
+        # /A, /A/B, /A/B/C, /A/D, /A/D/E, /A/D/F, /A/D/F/G
+        self.tree = [(u"A", None), (u"B", 0), (u"C", 1), (u"D", 0), (u"E", 3), (u"F", 3), (u"G", 5)]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dao.dispose()
+        shutil.rmtree(self.folder)
+
+    def get_client(self):
+        return RemoteFileSystemClient("http://127.0.0.1:%d/nuxeo/" % self.server.server_address[1],
+                                      "Administrator", "device", "2.2", proxies={}, password="Administrator",
+                                      upload_store=self.dao)
+
+    def assertTree(self, infos):
+        self.assertEquals([info.name for info in infos], [name for name, _ in self.tree])
+        for info, (name, parent_index) in zip(infos, self.tree):
+            parent_id = "root" if parent_index is None else infos[parent_index].uid
+            self.assertEquals(self.server.folders[info.uid], (parent_id, name))
+            self.assertEquals(info.parent_uid, parent_id)
+
+    def test_batches(self):
+        client = self.get_client()
+        self.assertTrue(client.can_make_folders())
+        batches = list(client.make_folders("root", self.tree))
+        self.assertEquals([len(infos) for infos in batches], [3, 3, 1])
+        self.assertTree([info for infos in batches for info in infos])
+        self.assertEquals(self.server.calls, ["NuxeoDrive.CreateFolders"] * 3)
+
+    def test_without_operation(self):
+        self.server.operations = {"operations": OPERATIONS["operations"][:2]}
+        client = self.get_client()
+        self.assertFalse(client.can_make_folders())
+        batches = list(client.make_folders("root", self.tree))
+        self.assertEquals([len(infos) for infos in batches], [1] * 7)
+        self.assertTree([info for infos in batches for info in infos])
+        self.assertEquals(self.server.calls, ["NuxeoDrive.CreateFolder"] * 7)
+
+    def test_contribution(self):
+        # The stand-in operation has the signature of the server-side contribution
+        operation = ElementTree.parse(CONTRIBUTION).find(".//scriptedOperation")
+        self.assertEquals(operation.get("id"), CREATE_FOLDERS_OPERATION)
+        self.assertEquals([(param.get("name"), param.get("type")) for param in operation.findall("param")],
+                          [("parentId", "string"), ("folders", "string")])
+        self.assertEquals([param["name"] for param in OPERATIONS["operations"][2]["params"]],
+                          ["parentId", "folders"])
@@ -0,0 +1,49 @@
+"""Tests of the interval of the remote polls."""
+
+import unittest
+from nxdrive.engine.watcher.poll_scheduler import PollScheduler, LatencyHistogram
+
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def test_adaptive_interval(self):
+        scheduler = PollScheduler(30, min_interval=5, max_interval=300, active_period=60, idle_period=600)
+        self.assertEquals(scheduler.get_interval(cur_time=1000), 30)
+        # Faster polls after some activity
+        scheduler.notify_activity(cur_time=1000)
+        self.assertEquals(scheduler.get_interval(cur_time=1030), 5)
+        self.assertEquals(scheduler.get_interval(cur_time=1060), 30)
+        # Back off once idle for the idle period
+        scheduler.notify_empty_poll(cur_time=1500)
+        self.assertEquals(scheduler.get_interval(cur_time=1500), 30)
+        intervals = []
+        for cur_time in range(1600, 1800, 30):
+            scheduler.notify_empty_poll(cur_time=cur_time)
+            intervals.append(scheduler.get_interval(cur_time=cur_time))
+        self.assertEquals(intervals, [60, 120, 240, 300, 300, 300, 300])
+        scheduler.notify_activity(cur_time=2000)
+        self.assertEquals(scheduler.get_interval(cur_time=2001), 5)
+        self.assertEquals(scheduler.get_interval(cur_time=2100), 30)
+
+    def test_bounds(self):
+        # The bounds never exclude the configured interval
+        scheduler = PollScheduler(2, min_interval=5, max_interval=1)
+        self.assertEquals((scheduler.min_interval, scheduler.max_interval), (2, 2))
+        scheduler.notify_activity(cur_time=0)
+        self.assertEquals(scheduler.get_interval(cur_time=1), 2)
+        for cur_time in range(1000, 100000, 100):
+            scheduler.notify_empty_poll(cur_time=cur_time)
+        self.assertEquals(scheduler.get_interval(cur_time=100000), 2)
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_buckets(self):
+        histogram = LatencyHistogram(bounds=(1, 10, 60))
+        self.assertEquals(histogram.get_metrics()['average'], 0)
+        for latency in (-2, 0.5, 1, 5, 30, 61, 3600):
+            histogram.add(latency)
+        metrics = histogram.get_metrics()
+        self.assertEquals(metrics['buckets'], {'<=1': 3, '<=10': 1, '<=60': 1, '>60': 2})
+        self.assertEquals(metrics['count'], 7)
+        self.assertAlmostEquals(metrics['average'], 3697.5 / 7)
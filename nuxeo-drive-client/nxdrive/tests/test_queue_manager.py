@@ -0,0 +1,128 @@
+"""Tests of the queued pairs waiting for their parent or for another folder."""
+
+import unittest
+from threading import current_thread
+from nxdrive.engine.queue_manager import QueueManager, QueueItem
+
+
+class FakeDAO(object):
+
+    def get_config(self, name, default=None):
+        return default
+
+    def register_queue_manager(self, manager):
+        pass
+
+
+class FakePair(object):
+
+    def __init__(self, row_id, local_path):
+        self.id = row_id
+        self.local_path = local_path
+
+
+class FakeWorker(object):
+
+    def __init__(self, thread_id, doc_pair):
+        self._thread_id = thread_id
+        self._current_doc_pair = doc_pair
+
+    def get_metrics(self):
+        return dict()
+
+
+class FakeThread(object):
+
+    def __init__(self, worker):
+        self.worker = worker
+
+
+class FakeEngine(object):
+
+    def cancel_action_on(self, row_id):
+        pass
+
+
+class QueueManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = QueueManager(FakeEngine(), FakeDAO())
+
+    def get_all(self):
+        items = []
+        item = self.manager._get_item()
+        while item is not None:
+            items.append(item.id)
+            item = self.manager._get_item()
+        return items
+
+    def test_dependencies(self):
+        manager = self.manager
+        manager.push_ref(1, True, 'locally_created', local_parent_path=u'')
+        manager.push_ref(2, True, 'locally_created', local_parent_path=u'/A', depends_on=1)
+        manager.push_ref(3, False, 'locally_created', local_parent_path=u'/A/B', depends_on=2)
+        manager.push_ref(4, False, 'locally_created', local_parent_path=u'/A', depends_on=1)
+        manager.push_ref(5, True, 'remotely_created', local_parent_path=u'')
+        # Parent without row yet
+        manager.push_ref(6, False, 'remotely_created', local_parent_path=u'/C', depends_on=u'/C')
+        self.assertEquals(manager.get_waiting_count(), 4)
+        # The independent folders are both served
+        self.assertEquals(sorted(self.get_all()), [1, 5])
+        manager.release_children(FakePair(1, u'/A'))
+        self.assertEquals(self.get_all(), [2, 4])
+        # A pair pushed again without dependency does not wait anymore
+        manager.push_ref(3, False, 'locally_modified', local_parent_path=u'/A/B')
+        self.assertEquals(self.get_all(), [3])
+        manager.release_children(FakePair(2, u'/A/B'))
+        self.assertEquals(self.get_all(), [])
+        # The parent is removed with its descendants
+        manager.push_ref(9, True, 'remotely_created', local_parent_path=u'/D', depends_on=7)
+        manager.push_ref(10, False, 'remotely_created', local_parent_path=u'/D/E', depends_on=9)
+        self.assertEquals(manager.get_waiting_count(), 3)
+        manager.forget_children(FakePair(7, u'/D'))
+        self.assertEquals(manager.get_waiting_count(), 1)
+        manager.release_children(FakePair(8, u'/C'))
+        self.assertEquals(self.get_all(), [6])
+        metrics = manager.get_metrics()
+        self.assertEquals(metrics["waiting_children"], 0)
+        self.assertEquals(metrics["released_children"], 3)
+
+    def test_small_file_processor(self):
+        manager = self.manager
+        manager.push_ref(1, False, 'remotely_created', size=10 * 1024 * 1024)
+        manager.push_ref(2, False, 'remotely_created', size=10)
+        manager.push_ref(3, False, 'locally_created', size=20 * 1024 * 1024)
+        # A processor is reserved to the small files while there are some
+        self.assertEquals(manager._get_generic_processors(),
+                          manager._max_processors - manager._get_small_file_processors())
+        # It never takes the large files
+        self.assertEquals(manager._get_small_file().id, 2)
+        self.assertIsNone(manager._get_small_file())
+        # The other processors can use it once no small file is left
+        self.assertEquals(manager._get_generic_processors(), manager._max_processors)
+        self.assertEquals(sorted([manager._get_file().id, manager._get_file().id]), [1, 3])
+
+    def test_folder_conflicts(self):
+        manager = self.manager
+        self.assertTrue(manager.acquire_folder(FakePair(1, u'/A'), QueueItem(1, True, 'locally_moved')))
+        # The folders below or above the processed one wait for it
+        self.assertFalse(manager.acquire_folder(FakePair(2, u'/A/B'), QueueItem(2, True, 'locally_deleted')))
+        self.assertFalse(manager.acquire_folder(FakePair(3, u'/'), QueueItem(3, True, 'remotely_modified')))
+        # Not its siblings sharing the same prefix
+        self.assertTrue(manager.acquire_folder(FakePair(4, u'/AB'), QueueItem(4, True, 'locally_created')))
+        self.assertEquals(self.get_all(), [])
+        manager.release_folder(FakePair(1, u'/A'))
+        self.assertEquals(sorted(self.get_all()), [2, 3])
+        manager.release_folder(FakePair(4, u'/AB'))
+        self.assertTrue(manager.acquire_folder(FakePair(2, u'/A/B'), QueueItem(2, True, 'locally_deleted')))
+
+    def test_folder_lock(self):
+        manager = self.manager
+        # The generic processor locking the folder it processes does not wait for itself
+        manager._processors_pool.append(FakeThread(FakeWorker(current_thread().ident, FakePair(1, u'/A'))))
+        self.assertFalse(manager.has_file_processors_on(u'/A'))
+        manager.wait_file_processors_on(u'/A')
+        # But for the other ones processing below the folder
+        manager._processors_pool.append(FakeThread(FakeWorker(-1, FakePair(2, u'/A/file.txt'))))
+        self.assertTrue(manager.has_file_processors_on(u'/A'))
+        self.assertFalse(manager.has_file_processors_on(u'/B'))
@@ -0,0 +1,97 @@
+"""Tests of the remote folder children fetched in parallel."""
+
+import unittest
+from time import sleep, time
+from threading import current_thread
+from nxdrive.engine.watcher.remote_watcher import RemoteFolderCrawler
+
+
+class FakeChildrenClient(object):
+
+    def __init__(self, tree, delay=0):
+        self.tree = tree
+        self.delay = delay
+        self.threads = set()
+
+    def get_children_info(self, uid):
+        self.threads.add(current_thread().ident)
+        sleep(self.delay)
+        if uid not in self.tree:
+            raise ValueError("Unknown folder " + uid)
+        return self.tree[uid]
+
+
+class RemoteFolderCrawlerTest(unittest.TestCase):
+
+    def _crawl(self, crawler, root):
+        crawler.start()
+        found = []
+        try:
+            pending = set([root])
+            crawler.push(root, root)
+            while pending:
+                result = crawler.get(timeout=2)
+                self.assertIsNotNone(result)
+                uid, children = result
+                pending.remove(uid)
+                found.append(uid)
+                for child in children:
+                    pending.add(child)
+                    crawler.push(child, child)
+        finally:
+            crawler.stop()
+        return found
+
+    def test_crawl_parallel(self):
+        tree = {'root': ['a', 'b', 'c', 'd']}
+        for folder in ['a', 'b', 'c', 'd']:
+            tree[folder] = []
+        client = FakeChildrenClient(tree, delay=0.2)
+        crawler = RemoteFolderCrawler(lambda index: client, threads=4)
+        start = time()
+        found = self._crawl(crawler, 'root')
+        # The four subfolders are fetched at the same time
+        self.assertLess(time() - start, 0.7)
+        self.assertEquals(found[0], 'root')
+        self.assertEquals(sorted(found[1:]), ['a', 'b', 'c', 'd'])
+        self.assertEquals(len(client.threads), 4)
+
+    def test_error(self):
+        client = FakeChildrenClient(dict())
+        crawler = RemoteFolderCrawler(lambda index: client, threads=2)
+        crawler.start()
+        try:
+            crawler.push('unknown', 'unknown')
+            sleep(0.2)
+            self.assertRaises(ValueError, crawler.get)
+        finally:
+            crawler.stop()
+
+    def test_reuse(self):
+        tree = {'root': ['a'], 'a': [], 'other': []}
+        client = FakeChildrenClient(tree, delay=0.2)
+        created = []
+
+        def factory(index):
+            created.append(index)
+            return client
+        crawler = RemoteFolderCrawler(factory, threads=2)
+        crawler.start()
+        try:
+            # An aborted scan does not give its results to the next one
+            crawler.push('root', 'root')
+            crawler.cancel()
+            crawler.push('other', 'other')
+            self.assertEquals(crawler.get(timeout=2), ('other', []))
+            self.assertIsNone(crawler.get(timeout=0.5))
+            # The clients are kept between the scans
+            crawler.push('a', 'a')
+            self.assertEquals(crawler.get(timeout=2), ('a', []))
+            count = len(created)
+            self.assertLessEqual(count, 2)
+            crawler.reset_clients()
+            crawler.push('a', 'a')
+            self.assertEquals(crawler.get(timeout=2), ('a', []))
+            self.assertEquals(len(created), count + 1)
+        finally:
+            crawler.stop()
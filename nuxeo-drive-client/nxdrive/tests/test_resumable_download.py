@@ -0,0 +1,217 @@
+"""Tests of the interrupted downloads resumed with HTTP ranges."""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client.base_automation_client import CorruptedFile
+from nxdrive.client.base_automation_client import DOWNLOAD_KEY_FILE_SUFFIX
+from nxdrive.client.base_automation_client import clean_partial_downloads
+from nxdrive.client.common import StreamDigester
+from nxdrive.engine.dao.sqlite import EngineDAO
+
+OPERATIONS = {
+    "operations": [
+        {"id": "NuxeoDrive.GetChangeSummary", "params": [{"name": "lowerBound", "required": False}]},
+    ]
+}
+DOWNLOAD_PATH = "/nuxeo/nxbigfile/default/file/blobholder:0/file.bin"
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Stand-in for the blob download of the server, with optional byte ranges"""
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def do_GET(self):
+        server = self.server
+        if self.path != DOWNLOAD_PATH:
+            body = json.dumps(OPERATIONS)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        content = server.content
+        start, end = 0, len(content) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get("Range", ""))
+        with server.lock:
+            server.range_requests.append((int(match.group(1)), int(match.group(2)) if match.group(2) else None)
+                                         if match else None)
+            if match is not None and match.group(1) in server.failures:
+                server.failures.remove(match.group(1))
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        if match is not None and server.accept_ranges:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(end, int(match.group(2)))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(content))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes" if server.accept_ranges else "none")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        body = content[start:end + 1]
+        if server.truncate is not None:
+            # Network failure in the middle of the response
+            body = body[:server.truncate]
+            server.truncate = None
+            self.close_connection = 1
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ResumableDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RangeServer(('127.0.0.1', 0), RangeHandler)
+        self.server.content = os.urandom(9500)
+        self.server.accept_ranges = True
+        self.server.range_requests = []
+        self.server.failures = set()
+        self.server.truncate = None
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.folder = tempfile.mkdtemp(prefix="nxdrive-resumable-download-")
+        self.dao = EngineDAO(os.path.join(self.folder, "engine.db"))
+        self.dao.update_config("download_segment_size", 1000)
+        self.client = RemoteFileSystemClient("http://127.0.0.1:%d/nuxeo/" % self.server.server_address[1],
+                                             "Administrator", "device", "2.2", proxies={}, password="Administrator",
+                                             upload_store=self.dao)
+        self.url = self.client.server_url + DOWNLOAD_PATH[len("/nuxeo/"):]
+        self.digest = hashlib.md5(self.server.content).hexdigest()
+        self.file_out = os.path.join(self.folder, ".file.bin.nxpart")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dao.dispose()
+        shutil.rmtree(self.folder)
+
+    def download(self, digester=None):
+        return self.client.do_get(self.url, file_out=self.file_out, digest=self.digest, digester=digester)
+
+    def assertDownloaded(self):
+        with open(self.file_out, "rb") as f:
+            self.assertEquals(f.read(), self.server.content)
+        self.assertFalse(os.path.exists(self.file_out + DOWNLOAD_KEY_FILE_SUFFIX))
+
+    def test_resume(self):
+        self.server.truncate = 3000
+        self.assertRaises(Exception, self.download)
+        self.assertTrue(self.client.is_partial_download(self.file_out))
+        self.assertEquals(os.path.getsize(self.file_out), 3000)
+        self.server.range_requests = []
+        digester = StreamDigester("sha1")
+        self.download(digester=digester)
+        self.assertDownloaded()
+        # Only the missing bytes are requested, the digests cover the whole content
+        self.assertEquals(self.server.range_requests, [(3000, None)])
+        self.assertEquals(digester.hexdigest("sha1"), hashlib.sha1(self.server.content).hexdigest())
+
+    def test_range_not_supported(self):
+        self.server.accept_ranges = False
+        self.server.truncate = 3000
+        self.assertRaises(Exception, self.download)
+        self.download()
+        self.assertDownloaded()
+
+    def test_complete_partial(self):
+        with open(self.file_out, "wb") as f:
+            f.write(self.server.content)
+        with open(self.file_out + DOWNLOAD_KEY_FILE_SUFFIX, "wb") as f:
+            json.dump({"digest": self.digest, "size": len(self.server.content)}, f)
+        self.download()
+        self.assertDownloaded()
+        self.assertEquals(self.server.range_requests, [(9500, None)])
+
+    def test_other_content(self):
+        with open(self.file_out, "wb") as f:
+            f.write("other content")
+        with open(self.file_out + DOWNLOAD_KEY_FILE_SUFFIX, "wb") as f:
+            json.dump({"digest": hashlib.md5("other content").hexdigest(), "size": 13}, f)
+        self.download()
+        self.assertDownloaded()
+        self.assertEquals(self.server.range_requests, [None])
+
+    def test_corrupted(self):
+        self.server.truncate = 3000
+        self.assertRaises(Exception, self.download)
+        self.server.content = os.urandom(9500)
+        self.assertRaises(CorruptedFile, self.download)
+        self.assertFalse(os.path.exists(self.file_out))
+        self.assertFalse(os.path.exists(self.file_out + DOWNLOAD_KEY_FILE_SUFFIX))
+
+    def test_segmented(self):
+        self.dao.update_config("download_segment_threads", 3)
+        digester = StreamDigester("sha1")
+        self.download(digester=digester)
+        self.assertDownloaded()
+        self.assertEquals(sorted(self.server.range_requests),
+                          [(start, min(start + 999, 9499)) for start in range(0, 9500, 1000)])
+        self.assertEquals(digester.hexdigest("sha1"), hashlib.sha1(self.server.content).hexdigest())
+
+    def test_segmented_resume(self):
+        self.dao.update_config("download_segment_threads", 3)
+        self.server.failures.add("4000")
+        self.assertRaises(Exception, self.download)
+        self.assertTrue(self.client.is_partial_download(self.file_out))
+        self.server.range_requests = []
+        self.download()
+        self.assertDownloaded()
+        # The first segment tells the size, it is not requested again
+        self.assertTrue((4000, 4999) in self.server.range_requests)
+        self.assertFalse((0, 999) in self.server.range_requests)
+
+    def test_segmented_range_not_supported(self):
+        self.dao.update_config("download_segment_threads", 3)
+        self.server.accept_ranges = False
+        self.download()
+        self.assertDownloaded()
+        self.assertEquals(len(self.server.range_requests), 1)
+
+    def test_clean_partial_downloads(self):
+        self.server.truncate = 3000
+        self.assertRaises(Exception, self.download)
+        sub_folder = os.path.join(self.folder, "sub")
+        os.mkdir(sub_folder)
+        abandoned = [os.path.join(sub_folder, ".other.bin.nxpart"),
+                     os.path.join(sub_folder, ".gone.bin.nxpart" + DOWNLOAD_KEY_FILE_SUFFIX)]
+        for path in abandoned:
+            with open(path, "wb") as f:
+                f.write("partial")
+        # The download that can be resumed is kept, not the abandoned ones
+        self.assertEquals(clean_partial_downloads(self.folder), 2)
+        self.assertEquals(os.listdir(sub_folder), [])
+        self.assertTrue(self.client.is_partial_download(self.file_out))
+        # Until it is too old
+        self.assertEquals(clean_partial_downloads(self.folder, max_age=-1), 2)
+        self.assertFalse(os.path.exists(self.file_out))
+        self.assertFalse(os.path.exists(self.file_out + DOWNLOAD_KEY_FILE_SUFFIX))
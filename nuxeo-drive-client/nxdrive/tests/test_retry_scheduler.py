@@ -0,0 +1,59 @@
+"""Tests of the deadline heap of the pairs to retry later."""
+
+import unittest
+from nxdrive.engine.retry_scheduler import RetryScheduler, get_backoff
+
+
+class RetrySchedulerTest(unittest.TestCase):
+
+    def test_deadline_order(self):
+        scheduler = RetryScheduler()
+        scheduler.push(1, "Item1", 30)
+        scheduler.push(2, "Item2", 10)
+        scheduler.push(3, "Item3", 20)
+        self.assertEquals(scheduler.get_next_deadline(), 10)
+        self.assertIsNone(scheduler.pop(cur_time=5))
+        self.assertEquals(scheduler.pop(cur_time=25), "Item2")
+        self.assertEquals(scheduler.pop(cur_time=25), "Item3")
+        self.assertIsNone(scheduler.pop(cur_time=25))
+        self.assertEquals(len(scheduler), 1)
+        self.assertEquals(scheduler.pop(cur_time=30), "Item1")
+        self.assertIsNone(scheduler.get_next_deadline())
+
+    def test_replace_and_remove(self):
+        scheduler = RetryScheduler()
+        scheduler.push(1, "Item1", 10)
+        scheduler.push(2, "Item2", 20)
+        # Pushing the same id again replaces its deadline
+        scheduler.push(1, "Item1bis", 30)
+        self.assertEquals(len(scheduler), 2)
+        self.assertTrue(1 in scheduler)
+        self.assertEquals(scheduler.items(), ["Item2", "Item1bis"])
+        self.assertTrue(scheduler.remove(2))
+        self.assertFalse(scheduler.remove(2))
+        self.assertFalse(2 in scheduler)
+        self.assertIsNone(scheduler.pop(cur_time=25))
+        self.assertEquals(scheduler.pop(cur_time=30), "Item1bis")
+        self.assertEquals(len(scheduler), 0)
+
+    def test_reschedule_all(self):
+        scheduler = RetryScheduler()
+        for i in range(1000):
+            scheduler.push(i, i, 100 + i)
+        for i in range(0, 1000, 2):
+            scheduler.remove(i)
+        scheduler.reschedule_all(0)
+        self.assertEquals(scheduler.get_next_deadline(), 0)
+        items = []
+        item = scheduler.pop(cur_time=1)
+        while item is not None:
+            items.append(item)
+            item = scheduler.pop(cur_time=1)
+        self.assertEquals(items, range(1, 1000, 2))
+
+    def test_backoff(self):
+        for retry in range(1, 6):
+            delay = get_backoff(60, retry)
+            self.assertTrue(60 * 2 ** (retry - 1) * 0.9 <= delay <= 60 * 2 ** (retry - 1) * 1.1)
+        self.assertTrue(get_backoff(60, 10, max_interval=3600) <= 3600 * 1.1)
+        self.assertEquals(get_backoff(60, 3, jitter=0), 240)
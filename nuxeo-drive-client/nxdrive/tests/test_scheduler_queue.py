@@ -0,0 +1,57 @@
+"""Tests of the priority queue of the QueueManager."""
+
+import unittest
+from nxdrive.engine.queue_manager import QueueItem
+from nxdrive.engine.scheduler_queue import SchedulerQueue, HIGH_PRIORITY, LOW_PRIORITY
+
+
+class SchedulerQueueTest(unittest.TestCase):
+
+    def test_order(self):
+        queue = SchedulerQueue()
+        self.assertTrue(queue.put(QueueItem(1, False, 'locally_created')))
+        self.assertTrue(queue.put(QueueItem(2, False, 'locally_created'), priority=LOW_PRIORITY))
+        self.assertTrue(queue.put(QueueItem(3, False, 'locally_created')))
+        self.assertTrue(queue.put(QueueItem(4, False, 'locally_created'), priority=HIGH_PRIORITY))
+        self.assertEquals([item.id for item in queue.items()], [4, 1, 3, 2])
+        self.assertEquals([queue.get().id for _ in range(4)], [4, 1, 3, 2])
+        self.assertIsNone(queue.get())
+        self.assertTrue(queue.empty())
+
+    def test_merge(self):
+        queue = SchedulerQueue()
+        queue.put(QueueItem(1, False, 'locally_created'))
+        queue.put(QueueItem(2, False, 'locally_created'))
+        # Latest state is kept at the same place
+        self.assertFalse(queue.put(QueueItem(1, False, 'locally_modified')))
+        self.assertFalse(queue.put(QueueItem(1, False, 'locally_modified'), priority=LOW_PRIORITY))
+        self.assertEquals(queue.qsize(), 2)
+        self.assertEquals(queue.merged, 2)
+        item = queue.get()
+        self.assertEquals((item.id, item.pair_state), (1, 'locally_modified'))
+        # A better priority moves the item
+        queue.put(QueueItem(3, False, 'locally_created'))
+        self.assertFalse(queue.put(QueueItem(3, False, 'locally_modified'), priority=HIGH_PRIORITY))
+        self.assertEquals([item.id for item in queue.items()], [3, 2])
+        self.assertTrue(queue.remove(3))
+        self.assertFalse(3 in queue)
+        self.assertEquals(queue.get().id, 2)
+        self.assertIsNone(queue.get())
+
+    def test_lanes(self):
+        queue = SchedulerQueue(key=lambda item: item.size, lane=lambda item: 'small' if item.size < 10 else 'large')
+        queue.put(QueueItem(1, False, 'remotely_created', size=500))
+        queue.put(QueueItem(2, False, 'remotely_created', size=5))
+        queue.put(QueueItem(3, False, 'remotely_created', size=100))
+        queue.put(QueueItem(4, False, 'remotely_created', size=1))
+        self.assertEquals(queue.qsize(('small',)), 2)
+        self.assertEquals([item.id for item in queue.items()], [4, 2, 3, 1])
+        # A merged item follows its new size
+        self.assertFalse(queue.put(QueueItem(1, False, 'remotely_modified', size=2)))
+        self.assertEquals(queue.qsize(('small',)), 3)
+        self.assertEquals(queue.peek(('large',))[:2], (0, 100))
+        self.assertEquals([queue.get(('small',)).id for _ in range(3)], [4, 1, 2])
+        self.assertIsNone(queue.get(('small',)))
+        self.assertEquals(queue.get().id, 3)
+        waits = queue.get_waits()
+        self.assertEquals((waits['small'][0], waits['large'][0]), (3, 1))
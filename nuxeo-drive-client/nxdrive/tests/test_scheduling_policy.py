@@ -0,0 +1,61 @@
+"""Tests of the file scheduling policies."""
+
+import unittest
+from nxdrive.engine.queue_manager import QueueItem
+from nxdrive.engine.scheduler_queue import SchedulerQueue, DEFAULT_LANE
+from nxdrive.engine.scheduling_policy import get_scheduling_policy, get_file_lane, SMALL_FILE_LANE
+
+
+class SchedulingPolicyTest(unittest.TestCase):
+
+    def create_queues(self, policy):
+        local_queue = SchedulerQueue(key=policy.get_key, lane=get_file_lane)
+        remote_queue = SchedulerQueue(key=policy.get_key, lane=get_file_lane)
+        return local_queue, remote_queue
+
+    def serve(self, policy, queues, lanes=None):
+        served = []
+        queue = policy.select(queues, lanes)
+        while queue is not None:
+            served.append(queue.get(lanes).id)
+            queue = policy.select(queues, lanes)
+        return served
+
+    def test_file_lane(self):
+        self.assertEquals(get_file_lane(QueueItem(1, False, 'remotely_created', size=10)), SMALL_FILE_LANE)
+        self.assertEquals(get_file_lane(QueueItem(1, False, 'remotely_created', size=20 * 1024 ** 3)), DEFAULT_LANE)
+        self.assertEquals(get_file_lane(QueueItem(1, False, 'remotely_created')), DEFAULT_LANE)
+        # Nothing to transfer
+        self.assertEquals(get_file_lane(QueueItem(1, False, 'locally_deleted', size=20 * 1024 ** 3)), SMALL_FILE_LANE)
+
+    def test_fifo(self):
+        policy = get_scheduling_policy('fifo')
+        local_queue, remote_queue = self.create_queues(policy)
+        local_queue.put(QueueItem(1, False, 'locally_created', size=10))
+        remote_queue.put(QueueItem(2, False, 'remotely_created', size=5000000))
+        remote_queue.put(QueueItem(3, False, 'remotely_created', size=10))
+        # The longest queue first
+        self.assertEquals(self.serve(policy, [local_queue, remote_queue]), [2, 1, 3])
+
+    def test_shortest_job_first(self):
+        policy = get_scheduling_policy('sjf')
+        local_queue, remote_queue = self.create_queues(policy)
+        local_queue.put(QueueItem(1, False, 'locally_created', size=300))
+        remote_queue.put(QueueItem(2, False, 'remotely_created'))
+        remote_queue.put(QueueItem(3, False, 'remotely_created', size=5000000))
+        remote_queue.put(QueueItem(4, False, 'remotely_created', size=10))
+        local_queue.put(QueueItem(5, False, 'locally_created', size=20))
+        self.assertEquals(self.serve(policy, [local_queue, remote_queue], lanes=(SMALL_FILE_LANE,)), [4, 5, 1])
+        self.assertEquals(self.serve(policy, [local_queue, remote_queue]), [3, 2])
+
+    def test_folder_locality(self):
+        policy = get_scheduling_policy('folder')
+        local_queue, remote_queue = self.create_queues(policy)
+        remote_queue.put(QueueItem(1, False, 'remotely_created', size=10, local_parent_path='/b'))
+        local_queue.put(QueueItem(2, False, 'locally_created', size=10, local_parent_path='/a'))
+        remote_queue.put(QueueItem(3, False, 'remotely_created', size=10, local_parent_path='/b'))
+        remote_queue.put(QueueItem(4, False, 'remotely_created', size=10, local_parent_path='/a'))
+        self.assertEquals(self.serve(policy, [local_queue, remote_queue]), [2, 4, 1, 3])
+
+    def test_unknown_policy(self):
+        self.assertEquals(get_scheduling_policy('unknown').name, 'fifo')
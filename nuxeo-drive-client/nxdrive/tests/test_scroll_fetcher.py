@@ -0,0 +1,65 @@
+"""Tests of the remote scroll pages prefetched in background."""
+
+import unittest
+from time import sleep
+from nxdrive.engine.watcher.remote_watcher import ScrollFetcher
+
+
+class FakeScrollClient(object):
+
+    def __init__(self, total, delay=0):
+        self.total = total
+        self.delay = delay
+        self.calls = []
+
+    def scroll_descendants(self, uid, scroll_id, batch_size=100):
+        self.calls.append(batch_size)
+        sleep(self.delay)
+        start = scroll_id or 0
+        end = min(start + batch_size, self.total)
+        return {'scroll_id': end, 'descendants': range(start, end)}
+
+
+class ScrollFetcherTest(unittest.TestCase):
+
+    def _consume(self, fetcher):
+        result = []
+        while True:
+            page = fetcher.get(timeout=1)
+            self.assertIsNotNone(page)
+            if not page[0]:
+                return result
+            result.extend(page[0])
+
+    def test_fetch_all(self):
+        client = FakeScrollClient(1050)
+        fetcher = ScrollFetcher(client, 'uid', batch_size=100, max_batch_size=400)
+        fetcher.start()
+        self.assertEquals(self._consume(fetcher), range(1050))
+        # Fast server so the batch size grows up to the max
+        self.assertEquals(client.calls[:4], [100, 200, 400, 400])
+
+    def test_backpressure(self):
+        client = FakeScrollClient(1000)
+        fetcher = ScrollFetcher(client, 'uid', batch_size=100, max_batch_size=100, max_pages=2)
+        fetcher.start()
+        sleep(0.5)
+        # Two pages in the queue and one waiting to be put
+        self.assertEquals(len(client.calls), 3)
+        fetcher.stop()
+
+    def test_slow_server(self):
+        client = FakeScrollClient(300, delay=0.2)
+        fetcher = ScrollFetcher(client, 'uid', batch_size=100, min_batch_size=50, target_time=0.1)
+        fetcher.start()
+        self.assertEquals(self._consume(fetcher), range(300))
+        self.assertEquals(fetcher.batch_size, 50)
+
+    def test_error(self):
+        class BrokenClient(object):
+            def scroll_descendants(self, uid, scroll_id, batch_size=100):
+                raise ValueError("Broken")
+        fetcher = ScrollFetcher(BrokenClient(), 'uid')
+        fetcher.start()
+        sleep(0.2)
+        self.assertRaises(ValueError, fetcher.get)
@@ -0,0 +1,36 @@
+"""Tests of the digests computed while transferring the files."""
+
+import hashlib
+import shutil
+import tempfile
+import unittest
+from nxdrive.client import LocalClient, DigestCache
+from nxdrive.client.common import StreamDigester
+from nxdrive.tests.common import SOME_TEXT_CONTENT
+
+
+class StreamDigesterTest(unittest.TestCase):
+
+    def test_single_pass(self):
+        digester = StreamDigester('md5', 'sha1', 'md5', None)
+        for i in range(0, len(SOME_TEXT_CONTENT), 4):
+            digester.update(SOME_TEXT_CONTENT[i:i + 4])
+        self.assertEquals(digester.hexdigests(), {'md5': hashlib.md5(SOME_TEXT_CONTENT).hexdigest(),
+                                                  'sha1': hashlib.sha1(SOME_TEXT_CONTENT).hexdigest()})
+        self.assertEquals(digester.hexdigest('sha1'), hashlib.sha1(SOME_TEXT_CONTENT).hexdigest())
+        self.assertRaises(ValueError, digester.add, 'unknown')
+
+    def test_set_digests(self):
+        folder = tempfile.mkdtemp(u'-nxdrive-stream-digester')
+        try:
+            cache = DigestCache()
+            client = LocalClient(folder, digest_cache=cache)
+            client.make_file(u'/', u'File.txt', content=SOME_TEXT_CONTENT)
+            # Digests computed by a transfer are not computed again
+            client.set_digests(u'/File.txt', {'md5': 'fake md5', 'sha1': 'fake sha1'})
+            info = client.get_info(u'/File.txt')
+            self.assertEquals(info.get_digest(), 'fake md5')
+            self.assertEquals(info.get_digest('sha1'), 'fake sha1')
+            self.assertEquals(cache.hits, 2)
+        finally:
+            shutil.rmtree(folder)
@@ -214,6 +214,17 @@ def path_join(parent, child):
     return parent + '/' + child
 
 
+def get_remote_ref_suffixes(ref):
+    """Return the remote ref and its parts following each '#',
+    the change summary can give a FileSystemItem id without its factory name"""
+    suffixes = [ref]
+    index = ref.find('#')
+    while index != -1:
+        suffixes.append(ref[index + 1:])
+        index = ref.find('#', index + 1)
+    return suffixes
+
+
 def default_nuxeo_drive_folder():
     # TODO: Factorize with manager.get_default_nuxeo_drive_folder
     """Find a reasonable location for the root Nuxeo Drive folder
@@ -0,0 +1,245 @@
+'''
+Measure RemoteWatcher._update_remote_states on synthetic change summaries
+served by a local mock Automation server, and compare the previous quadratic
+filtering of the already processed changes and of the deletions
+
+Usage: python changes_benchmark.py [events,...] [legacy_limit]
+
+Each summary has as many existing files as events: documents modified once or twice,
+created, or deleted with their folder. The legacy filtering is only measured up to
+legacy_limit events as it grows with the square of the number of events.
+'''
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from time import time
+from PyQt4.QtCore import QCoreApplication, QObject, pyqtSignal
+from nxdrive.client import ConnectionPool, LocalClient, RemoteFileSystemClient
+from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.watcher.remote_watcher import RemoteWatcher
+from nxdrive.utils import get_remote_ref_suffixes
+
+FILES_PER_FOLDER = 100
+ROOT_REF = "defaultSyncRootFolderItemFactory#default#root"
+TOP_LEVEL_PATH = "/org.nuxeo.drive.service.impl.DefaultTopLevelFolderItemFactory#"
+OPERATIONS = {
+    "operations": [
+        {"id": "NuxeoDrive.GetChangeSummary", "params": [{"name": "lowerBound", "required": False}]},
+        {"id": "NuxeoDrive.GetFileSystemItem", "params": [{"name": "id", "required": True},
+                                                          {"name": "parentId", "required": False}]},
+    ]
+}
+
+
+def get_folder_ref(folder):
+    return "defaultFileSystemItemFactory#default#folder_%d" % folder
+
+
+def get_file_ref(index):
+    return "defaultFileSystemItemFactory#default#file_%d" % index
+
+
+def get_fs_item(ref, parent_ref, name, modified):
+    return {"id": ref, "parentId": parent_ref, "name": name, "folder": False,
+            "lastModificationDate": 1476748800000 + modified * 1000, "lastContributor": "Administrator",
+            "digest": "%032d" % modified, "digestAlgorithm": "md5",
+            "downloadURL": "nxbigfile/default/%s/blobholder:0/%s" % (ref, name),
+            "canRename": True, "canDelete": True, "canUpdate": True,
+            "path": TOP_LEVEL_PATH + "/" + ROOT_REF + "/" + parent_ref + "/" + ref}
+
+
+def create_states(dao, events):
+    con = dao._get_write_connection()
+    c = con.cursor()
+    query = ("INSERT INTO States(local_path, local_parent_path, local_name, remote_ref, remote_parent_ref,"
+             + " remote_parent_path, remote_name, local_digest, remote_digest, folderish, local_state, remote_state,"
+             + " pair_state, last_remote_updated) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'synchronized', 'synchronized',"
+             + " 'synchronized', '2016-10-18 00:00:00')")
+    c.execute(query, ("/Root", "", "Root", ROOT_REF, "org.nuxeo.drive.service.impl.DefaultTopLevelFolderItemFactory#",
+                      TOP_LEVEL_PATH, "Root", None, None, 1))
+    for folder in range((events + FILES_PER_FOLDER - 1) / FILES_PER_FOLDER):
+        c.execute(query, ("/Root/folder_%d" % folder, "/Root", "folder_%d" % folder, get_folder_ref(folder), ROOT_REF,
+                          TOP_LEVEL_PATH + "/" + ROOT_REF, "folder_%d" % folder, None, None, 1))
+    for index in range(events):
+        folder = index / FILES_PER_FOLDER
+        c.execute(query, ("/Root/folder_%d/file_%d" % (folder, index), "/Root/folder_%d" % folder, "file_%d" % index,
+                          get_file_ref(index), get_folder_ref(folder),
+                          TOP_LEVEL_PATH + "/" + ROOT_REF + "/" + get_folder_ref(folder), "file_%d" % index,
+                          "%032d" % 0, "%032d" % 0, 0))
+    con.commit()
+
+
+def create_summary(events):
+    changes = []
+    for index in range(events):
+        folder = index / FILES_PER_FOLDER
+        folder_ref = get_folder_ref(folder)
+        if folder % 5 == 0:
+            # Content of a deleted folder
+            changes.append({"eventId": "deleted", "eventDate": index, "fileSystemItemId": get_file_ref(index)})
+            if index % FILES_PER_FOLDER == 0:
+                changes.append({"eventId": "deleted", "eventDate": index, "fileSystemItemId": folder_ref})
+        elif index % 10 == 0:
+            ref = "defaultFileSystemItemFactory#default#new_%d" % index
+            changes.append({"eventId": "documentCreated", "eventDate": index, "fileSystemItemId": ref,
+                            "fileSystemItem": get_fs_item(ref, folder_ref, "new_%d" % index, index)})
+        else:
+            ref = get_file_ref(index)
+            changes.append({"eventId": "documentModified", "eventDate": events + index, "fileSystemItemId": ref,
+                            "fileSystemItem": get_fs_item(ref, folder_ref, "file_%d" % index, events + index)})
+            if index % 10 == 1:
+                # Older modification of the same document
+                changes.append({"eventId": "documentModified", "eventDate": index, "fileSystemItemId": ref,
+                                "fileSystemItem": get_fs_item(ref, folder_ref, "file_%d" % index, index)})
+    return {"fileSystemChanges": changes, "hasTooManyChanges": False, "syncDate": 1476748800000,
+            "upperBound": events, "activeSynchronizationRootDefinitions": "default:root"}
+
+
+class MockAutomationHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send the headers and the body at once, as a real server does
+    wbufsize = -1
+
+    def do_GET(self):
+        self._reply(json.dumps(OPERATIONS))
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        if self.path.endswith("NuxeoDrive.GetChangeSummary"):
+            self._reply(self.server.summary)
+        else:
+            # Every deleted document is really deleted
+            self._reply("null")
+
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockAutomationServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class EngineStub(QObject):
+    invalidClientsCache = pyqtSignal()
+
+    def __init__(self, local_client, remote_client):
+        super(EngineStub, self).__init__()
+        self._local_client = local_client
+        self._remote_client = remote_client
+
+    def get_local_client(self):
+        return self._local_client
+
+    def get_remote_client(self):
+        return self._remote_client
+
+    def stop_processor_on(self, path):
+        pass
+
+
+def legacy_filter(changes, delete_paths):
+    # Previous filtering of the processed changes and of the deletions
+    refreshed = set()
+    for change in changes:
+        remote_ref = change['fileSystemItemId']
+        processed = False
+        for refreshed_ref in refreshed:
+            if refreshed_ref.endswith(remote_ref):
+                processed = True
+                break
+        if not processed:
+            refreshed.add(remote_ref)
+    delete_processed = []
+    for local_path in sorted(delete_paths):
+        skip = False
+        for path in delete_processed:
+            if local_path.startswith(path + "/"):
+                skip = True
+                break
+        if not skip:
+            delete_processed.append(local_path)
+
+
+def new_filter(watcher, changes, delete_paths):
+    refreshed = set()
+    for change in changes:
+        remote_ref = change['fileSystemItemId']
+        if remote_ref not in refreshed:
+            refreshed.update(get_remote_ref_suffixes(remote_ref))
+    delete_processed = set()
+    for local_path in sorted(delete_paths):
+        if not watcher._is_under_paths(local_path, delete_processed):
+            delete_processed.add(local_path + "/")
+
+
+def measure(server, url, events, legacy_limit):
+    summary = create_summary(events)
+    server.summary = json.dumps(summary)
+    folder = tempfile.mkdtemp(prefix="nxdrive-changes-benchmark-")
+    pool = ConnectionPool()
+    try:
+        dao = EngineDAO(os.path.join(folder, "engine.db"))
+        create_states(dao, events)
+        os.mkdir(os.path.join(folder, "local"))
+        remote_client = RemoteFileSystemClient(url, "Administrator", "benchmark", "2.2", proxies={},
+                                               password="Administrator", connection_pool=pool)
+        engine = EngineStub(LocalClient(os.path.join(folder, "local")), remote_client)
+        watcher = RemoteWatcher(engine, dao, 30)
+        watcher._client = remote_client
+        watcher._continue = True
+        start = time()
+        watcher._update_remote_states()
+        elapsed = time() - start
+        print "%d events: _update_remote_states %.2fs (%.1fus/event), %d HTTP calls" % (
+            len(summary["fileSystemChanges"]), elapsed, elapsed * 1000000 / len(summary["fileSystemChanges"]),
+            pool.get_metrics()["http_connections_reused"] + pool.get_metrics()["http_connections_created"])
+        changes = sorted(summary["fileSystemChanges"], key=lambda x: x['eventDate'], reverse=True)
+        delete_paths = [state.local_path for state in dao.get_states_from_partial_local("/Root/")
+                        if state.pair_state == "remotely_deleted" or state.pair_state == "parent_remotely_deleted"]
+        start = time()
+        new_filter(watcher, changes, delete_paths)
+        print "    filtering: %.3fs" % (time() - start),
+        if events <= legacy_limit:
+            start = time()
+            legacy_filter(changes, delete_paths)
+            print "- previous filtering: %.3fs" % (time() - start)
+        else:
+            print "- previous filtering skipped"
+        dao.dispose()
+    finally:
+        pool.clear()
+        shutil.rmtree(folder)
+
+
+def run(sizes=(1000, 10000, 100000), legacy_limit=10000):
+    app = QCoreApplication(sys.argv)
+    server = MockAutomationServer(('127.0.0.1', 0), MockAutomationHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d/nuxeo/" % server.server_address[1]
+    try:
+        for events in sizes:
+            measure(server, url, events, legacy_limit)
+    finally:
+        server.shutdown()
+        server.server_close()
+    del app
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1].split(',')] if len(sys.argv) > 1 else (1000, 10000, 100000)
+    legacy_limit = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    run(sizes, legacy_limit)
@@ -0,0 +1,75 @@
+'''
+Measure the EngineDAO write throughput and read latency with concurrent processors
+
+Usage: python dao_benchmark.py [rows] [processors]
+'''
+import os
+import sys
+import shutil
+import tempfile
+import threading
+from time import time
+from nxdrive.engine.dao.sqlite import EngineDAO
+
+
+def create_rows(dao, rows):
+    con = dao._get_write_connection()
+    c = con.cursor()
+    for i in range(rows):
+        folder = "/folder_%d" % (i / 100)
+        c.execute("INSERT INTO States(local_path, local_parent_path, local_name, folderish, local_state,"
+                  + " remote_state, pair_state) VALUES(?, ?, ?, 0, 'created', 'unknown', 'locally_created')",
+                  (folder + "/file_%d" % i, folder, "file_%d" % i))
+    con.commit()
+    return [row[0] for row in c.execute("SELECT id FROM States").fetchall()]
+
+
+def processor(dao, thread_id, ids, latencies, writes):
+    for row_id in ids:
+        if not dao.acquire_processor(thread_id, row_id):
+            continue
+        start = time()
+        row = dao.get_state_from_id(row_id)
+        dao.get_local_children(row.local_parent_path)
+        latencies.append(time() - start)
+        dao.synchronize_state(row)
+        writes.append(1)
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def run(rows=10000, processors=10):
+    folder = tempfile.mkdtemp(prefix="nxdrive-dao-benchmark-")
+    try:
+        dao = EngineDAO(os.path.join(folder, "engine.db"))
+        ids = create_rows(dao, rows)
+        latencies = []
+        writes = []
+        threads = []
+        for i in range(processors):
+            threads.append(threading.Thread(target=processor,
+                                            args=(dao, i + 1, ids[i::processors], latencies, writes)))
+        start = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time() - start
+        print "%d processors synchronized %d rows in %.2fs" % (processors, len(writes), elapsed)
+        print "Write throughput: %.0f rows/s" % (len(writes) / elapsed)
+        print "Read latency: p50 %.2fms, p99 %.2fms" % (percentile(latencies, 0.5) * 1000,
+                                                        percentile(latencies, 0.99) * 1000)
+        dao.dispose()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    processors = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    run(rows, processors)
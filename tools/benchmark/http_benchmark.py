@@ -0,0 +1,115 @@
+'''
+Measure the remote client call latency with and without the keep-alive connection pool
+against a local mock Automation server
+
+Usage: python http_benchmark.py [calls] [threads] [handshake_ms]
+
+handshake_ms is the time spent by the mock server on each new connection,
+to simulate the TLS handshake and the network round trips.
+'''
+import json
+import sys
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from time import sleep, time
+from nxdrive.client import ConnectionPool
+from nxdrive.client import RemoteFileSystemClient
+
+OPERATIONS = {
+    "operations": [
+        {"id": "NuxeoDrive.GetChangeSummary", "params": [{"name": "lowerBound", "required": False}]},
+        {"id": "NuxeoDrive.GetFileSystemItem", "params": [{"name": "id", "required": True},
+                                                          {"name": "parentId", "required": False}]},
+    ]
+}
+
+FS_ITEM = {
+    "id": "defaultFileSystemItemFactory#default#1234", "parentId": "org.nuxeo.drive.service.impl.DefaultTopLevelFolderItemFactory#",
+    "name": "Document.txt", "folder": False, "lastModificationDate": 1476748800000, "lastContributor": "Administrator",
+    "digest": "8d6e9f7e6b0b1dcb8b0ab0a31fbc9f0b", "digestAlgorithm": "md5", "downloadURL": "nxbigfile/default/1234/blobholder:0/Document.txt",
+    "canRename": True, "canDelete": True, "canUpdate": True, "path": "/1234",
+}
+
+
+class MockAutomationHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send the headers and the body at once, as a real server does
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(1)
+        sleep(self.server.handshake)
+
+    def do_GET(self):
+        self._reply(OPERATIONS)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self._reply(FS_ITEM)
+
+    def _reply(self, content):
+        body = json.dumps(content)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockAutomationServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def caller(client, calls):
+    for _ in range(calls):
+        client.get_info("defaultFileSystemItemFactory#default#1234")
+
+
+def measure(server, url, calls, threads, pool):
+    del server.connections[:]
+    clients = [RemoteFileSystemClient(url, "Administrator", "benchmark", "2.2", proxies={},
+                                      password="Administrator", connection_pool=pool)
+               for _ in range(threads)]
+    workers = [threading.Thread(target=caller, args=(client, calls / threads)) for client in clients]
+    start = time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time() - start
+    total = calls / threads * threads
+    print "%s: %d calls in %.2fs (%.2fms/call), %d connections opened" % (
+        "Pooled" if pool is not None else "Not pooled", total, elapsed, elapsed * 1000 / total,
+        len(server.connections))
+    if pool is not None:
+        print "Pool metrics: %r" % pool.get_metrics()
+
+
+def run(calls=1000, threads=4, handshake=0.005):
+    server = MockAutomationServer(('127.0.0.1', 0), MockAutomationHandler)
+    server.connections = []
+    server.handshake = handshake
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d/nuxeo/" % server.server_address[1]
+    try:
+        measure(server, url, calls, threads, None)
+        pool = ConnectionPool(max_per_host=threads)
+        measure(server, url, calls, threads, pool)
+        pool.clear()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    handshake = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.005
+    run(calls, threads, handshake)
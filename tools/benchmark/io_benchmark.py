@@ -0,0 +1,122 @@
+'''
+Measure the throughput of the local I/O paths of the transfers: hashing a file, streaming
+an upload body and writing a download. The hashing and the upload allocating a string per
+read are compared to the reused buffers of the buffer pool, the download writes are
+measured for two read sizes as the HTTP responses cannot read into a buffer
+
+Usage: python io_benchmark.py [size_mb]
+
+The file is read from the page cache, so the results are the CPU cost of the I/O paths:
+MB/s is the wall clock throughput, MB/s per core the throughput per second of CPU time.
+'''
+import hashlib
+import io
+import os
+import sys
+import tempfile
+from time import time
+from nxdrive.client.buffer_pool import hash_file, read_chunks
+from nxdrive.client.common import FILE_BUFFER_SIZE
+
+# Former upload buffer: the file system block size
+BLOCK_SIZE = 4096
+# Reads of a slow download
+SMALL_READ_SIZE = 64 * 1024
+
+
+class FakeResponse(object):
+    """Response body allocating a string per read, like the socket reads"""
+
+    def __init__(self, content):
+        self._content = content
+        self._offset = 0
+
+    def read(self, size):
+        data = self._content[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+
+def measure(name, size, function, repeat=3):
+    """Print the best throughput of several runs"""
+    elapsed = cpu = None
+    for _ in range(repeat):
+        start = time()
+        start_cpu = sum(os.times()[:2])
+        function()
+        elapsed = min(elapsed, time() - start) if elapsed is not None else time() - start
+        run_cpu = sum(os.times()[:2]) - start_cpu
+        cpu = min(cpu, run_cpu) if cpu is not None else run_cpu
+    elapsed = max(elapsed, 1e-6)
+    cpu = max(cpu, 1e-2)
+    mb = size / 1024.0 / 1024.0
+    print "%-32s %8.0f MB/s %8.0f MB/s per core" % (name, mb / elapsed, mb / cpu)
+
+
+def legacy_hash(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            buffer_ = f.read(FILE_BUFFER_SIZE)
+            if buffer_ == '':
+                break
+            h.update(buffer_)
+
+
+def legacy_upload(path, read_size, sink):
+    with open(path, 'rb') as f:
+        while True:
+            r = f.read(read_size)
+            if not r:
+                break
+            sink.write(r)
+
+
+def pooled_upload(path, sink):
+    with open(path, 'rb') as f:
+        for chunk in read_chunks(f):
+            sink.write(chunk)
+
+
+def download(content, path, read_size):
+    response = FakeResponse(content)
+    with open(path, 'wb') as f:
+        while True:
+            buffer_ = response.read(read_size)
+            if buffer_ == '':
+                break
+            f.write(buffer_)
+
+
+def run(size_mb=256):
+    size = size_mb * 1024 * 1024
+    folder = tempfile.mkdtemp(prefix="nxdrive-io-benchmark-")
+    path = os.path.join(folder, "content.bin")
+    out_path = os.path.join(folder, "download.bin")
+    try:
+        content = os.urandom(size)
+        with open(path, 'wb') as f:
+            f.write(content)
+        # Load the file in the page cache
+        legacy_hash(path)
+        print "%dMB file" % size_mb
+        measure("hash read()", size, lambda: legacy_hash(path))
+        measure("hash readinto()", size, lambda: hash_file(path, hashlib.md5()))
+        measure("hash mmap", size, lambda: hash_file(path, hashlib.md5(), use_mmap=True, mmap_threshold=0))
+        with io.open(os.devnull, 'wb', buffering=0) as sink:
+            measure("upload read() %dKB" % (BLOCK_SIZE / 1024), size,
+                    lambda: legacy_upload(path, BLOCK_SIZE, sink))
+            measure("upload read() %dKB" % (FILE_BUFFER_SIZE / 1024), size,
+                    lambda: legacy_upload(path, FILE_BUFFER_SIZE, sink))
+            measure("upload readinto() %dKB" % (FILE_BUFFER_SIZE / 1024), size, lambda: pooled_upload(path, sink))
+        for read_size in (FILE_BUFFER_SIZE, SMALL_READ_SIZE):
+            measure("download write %dKB reads" % (read_size / 1024), size,
+                    lambda: download(content, out_path, read_size))
+    finally:
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+        os.rmdir(folder)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 256)
@@ -0,0 +1,82 @@
+'''
+Measure the decoding of a large change summary: time and peak RSS of reading the whole body,
+json.loads it then convert the items, against the incremental decoding converting each item
+as soon as it is decoded
+
+Usage: python json_benchmark.py [events]
+
+Each mode runs in its own process so its peak RSS is not hidden by the previous one.
+'''
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from time import time
+from nxdrive.client import json_stream
+from nxdrive.client.remote_file_system_client import RemoteFileSystemClient
+
+ROOT_REF = "defaultSyncRootFolderItemFactory#default#root"
+
+
+def create_summary(path, events):
+    changes = []
+    for index in range(events):
+        ref = "defaultFileSystemItemFactory#default#file_%d" % index
+        changes.append({"eventId": "documentModified", "eventDate": index, "fileSystemItemId": ref,
+                        "docUuid": "%036d" % index, "repositoryId": "default",
+                        "fileSystemItem": {"id": ref, "parentId": ROOT_REF, "name": "file_%d.txt" % index,
+                                           "folder": False, "lastModificationDate": 1476748800000 + index,
+                                           "lastContributor": "Administrator", "digest": "%032d" % index,
+                                           "digestAlgorithm": "MD5", "canRename": True, "canDelete": True,
+                                           "canUpdate": True, "lockInfo": None,
+                                           "downloadURL": "nxbigfile/default/%s/blobholder:0/file_%d.txt" % (
+                                               ref, index),
+                                           "path": "/" + ROOT_REF + "/" + ref}})
+    with open(path, "wb") as f:
+        json.dump({"fileSystemChanges": changes, "hasTooManyChanges": False, "syncDate": 1476748800000,
+                   "upperBound": events, "activeSynchronizationRootDefinitions": "default:root"}, f)
+
+
+def change_to_info(change):
+    # Same as RemoteFileSystemClient._change_to_info, without a client
+    if change.get('fileSystemItem') is not None:
+        change['fileSystemItem'] = RemoteFileSystemClient.file_to_info.im_func(None, change['fileSystemItem'])
+    return change
+
+
+def decode(mode, path):
+    start = time()
+    with open(path, "rb") as f:
+        if mode == "legacy":
+            summary = json.loads(f.read())
+            changes = [change_to_info(change) for change in summary['fileSystemChanges']]
+        else:
+            summary = json_stream.load(f, items_key='fileSystemChanges', item_converter=change_to_info)
+            changes = summary['fileSystemChanges']
+    elapsed = time() - start
+    # ru_maxrss is in kilobytes on Linux, in bytes on Mac OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    print "%s: %d changes decoded in %.2fs, peak RSS %.1fMB" % (mode, len(changes), elapsed, rss / 1024.0)
+
+
+def run(events=100000):
+    fd, path = tempfile.mkstemp(prefix="nxdrive-json-benchmark-", suffix=".json")
+    os.close(fd)
+    try:
+        create_summary(path, events)
+        print "%d events, %.1fMB body" % (events, os.path.getsize(path) / 1024.0 / 1024.0)
+        for mode in ("legacy", "stream"):
+            subprocess.check_call([sys.executable, __file__, "--decode", mode, path])
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--decode":
+        decode(sys.argv[2], sys.argv[3])
+    else:
+        run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
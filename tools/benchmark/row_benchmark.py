@@ -0,0 +1,98 @@
+'''
+Measure the cost of the EngineDAO rows: get_local_children plus the attribute accesses
+done by LocalWatcher._scan_recursive, with the previous sqlite3.Row based rows and the slotted rows
+
+Usage: python row_benchmark.py [rows] [loops]
+'''
+import os
+import sqlite3
+import sys
+import shutil
+import tempfile
+from time import time
+from nxdrive.engine.dao.sqlite import EngineDAO, StateRow
+
+
+class LegacyCustomRow(sqlite3.Row):
+    """Row implementation before the slotted rows, for comparison"""
+
+    def __init__(self, arg1, arg2):
+        super(LegacyCustomRow, self).__init__(arg1, arg2)
+        self._custom = dict()
+
+    def __getattr__(self, name):
+        if name in self._custom:
+            return self._custom[name]
+        return self[name]
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            super(LegacyCustomRow, self).__setattr__(name, value)
+        else:
+            self._custom[name] = value
+
+
+def create_rows(dao, rows):
+    con = dao._get_write_connection()
+    c = con.cursor()
+    for i in range(rows):
+        c.execute("INSERT INTO States(local_path, local_parent_path, local_name, remote_ref, remote_name,"
+                  + " local_digest, folderish, local_state, remote_state, pair_state)"
+                  + " VALUES(?, '/folder', ?, ?, ?, ?, 0, 'synchronized', 'synchronized', 'synchronized')",
+                  ("/folder/file_%d" % i, "file_%d" % i, "remote_%d" % i, "file_%d" % i, "%032d" % i))
+    con.commit()
+
+
+def get_local_children(dao, factory):
+    c = dao._get_read_connection(factory=factory).cursor()
+    return c.execute("SELECT * FROM States WHERE local_parent_path=?", ('/folder',)).fetchall()
+
+
+def scan(children):
+    # Same accesses as _scan_recursive for each child of a scanned folder
+    to_scan = dict([(child.local_name, child) for child in children])
+    for doc_pair in to_scan.values():
+        if doc_pair.processor != 0 or doc_pair.local_state == 'deleted':
+            continue
+        if doc_pair.remote_ref is not None and doc_pair.local_digest is not None:
+            doc_pair.local_path, doc_pair.local_name, doc_pair.local_path, doc_pair.local_path
+        doc_pair.local_state, doc_pair.local_path, doc_pair.remote_name
+
+
+def get_row_size(row):
+    # The values are shared, only count the row and its own containers
+    if isinstance(row, sqlite3.Row):
+        return sys.getsizeof(row) + sys.getsizeof(tuple(row)) + sys.getsizeof(row._custom)
+    return sys.getsizeof(row)
+
+
+def measure(dao, factory, loops):
+    fetch = access = 0
+    for _ in range(loops):
+        start = time()
+        children = get_local_children(dao, factory)
+        fetch += time() - start
+        start = time()
+        scan(children)
+        access += time() - start
+    count = len(children) * loops
+    print "%s: get_local_children %.2fus/row, scan accesses %.2fus/row, %d bytes/row" % (
+        factory.__name__, fetch * 1000000 / count, access * 1000000 / count, get_row_size(children[0]))
+
+
+def run(rows=10000, loops=20):
+    folder = tempfile.mkdtemp(prefix="nxdrive-row-benchmark-")
+    try:
+        dao = EngineDAO(os.path.join(folder, "engine.db"))
+        create_rows(dao, rows)
+        measure(dao, LegacyCustomRow, loops)
+        measure(dao, StateRow, loops)
+        dao.dispose()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    loops = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    run(rows, loops)